@@ -0,0 +1,553 @@
+import os
+import re
+import json
+import time
+import yaml
+import shutil
+import hashlib
+import argparse
+import tempfile
+import threading
+import requests
+import numpy as np
+import pandas as pd
+from types import SimpleNamespace
+from typing import Dict, List
+from embedding_backends import create_embedding_backend
+from embedding_cache import EmbeddingCache
+from gemini_client import GeminiClient
+from instrumentation import configure_logging, metrics
+from local_index import WIKIDATA_ENTITY_PREFIX
+from rate_limit import TokenBucket
+from wikidata import MatcherMode, WikidataMatcher
+
+GROUND_TRUTH_FILES = ["/experiments/gt.csv", "/wikidata/gt.csv"]
+FIXTURES_DIR = "/experiments/fixtures"
+CONFIG_DIR = "/config"
+SEMANTIC_MATCH_THRESHOLD = 0.8
+REFERENCE_EMBEDDING_BACKEND = "sentence-transformers"
+# Scores extraction and matching quality whatever embedding model or backend
+# is benchmarked, as in the notebook evaluation
+JUDGE_EMBEDDING_MODEL = "all-MiniLM-L6-v2"
+GEMINI_FIXTURE = "gemini_responses.json"
+WIKIDATA_FIXTURE = "wikidata_responses.json"
+
+
+class RecordedGenAI:
+    """Stands in for genai.Client, answering from responses recorded per prompt.
+
+    With a `live_client`, prompts without a recording are sent to the API and
+    their responses are recorded; without one, they are collected in `missing`.
+    """
+
+    def __init__(self, fixture_file: str, live_client=None):
+        self.fixture_file = fixture_file
+        self.live_client = live_client
+        self.models = self
+        self.responses = {}
+        self.missing = set()
+        if os.path.exists(fixture_file):
+            with open(fixture_file, "r", encoding="utf-8") as f:
+                self.responses = json.load(f)
+        self.lock = threading.Lock()
+
+    def generate_content(self, model: str, contents: str, config: dict):
+        key = hashlib.sha256(f"{model}\0{contents}".encode("utf-8")).hexdigest()
+        if key not in self.responses:
+            if self.live_client is None:
+                with self.lock:
+                    self.missing.add(key)
+                raise KeyError(f"No recorded response for prompt {key[:12]}, run with --record")
+            response = self.live_client.models.generate_content(
+                model=model, contents=contents, config=config
+            )
+            with self.lock:
+                self.responses[key] = response.text
+        return SimpleNamespace(text=self.responses[key])
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.fixture_file), exist_ok=True)
+        with open(self.fixture_file, "w", encoding="utf-8") as f:
+            json.dump(self.responses, f, indent=2, ensure_ascii=False)
+
+
+class RecordedWikidataSession:
+    """Stands in for the matcher's requests.Session, answering from raw responses.
+
+    Search responses are recorded per request and SPARQL bindings per QID, so
+    a replay finds them however its QIDs are batched. With a `live_session`,
+    requests without a recording are sent to Wikidata and recorded; without
+    one, they fail like an unreachable endpoint and are collected in `missing`.
+    """
+
+    def __init__(self, fixture_file: str, live_session: requests.Session = None):
+        self.fixture_file = fixture_file
+        self.live_session = live_session
+        self.responses = {"search": {}, "sparql": {}}
+        self.missing = set()
+        if os.path.exists(fixture_file):
+            with open(fixture_file, "r", encoding="utf-8") as f:
+                self.responses = json.load(f)
+        self.lock = threading.Lock()
+
+    def get(self, url: str, params: dict, timeout: float):
+        key = json.dumps(params, sort_keys=True, ensure_ascii=False)
+        if key not in self.responses["search"]:
+            response = self.__live_request("get", url, timeout, key, params=params)
+            with self.lock:
+                self.responses["search"][key] = response.json()
+        return self.__response(self.responses["search"][key])
+
+    def post(self, url: str, data: dict, timeout: float):
+        values = re.search(r"VALUES \?item \{([^}]*)\}", data["query"]).group(1)
+        qids = re.findall(r"wd:(\S+)", values)
+        unrecorded = [qid for qid in qids if qid not in self.responses["sparql"]]
+        if unrecorded:
+            response = self.__live_request("post", url, timeout, *unrecorded, data=data)
+            bindings = {qid: [] for qid in qids}
+            for item in response.json()["results"]["bindings"]:
+                qid = item["item"]["value"].replace(WIKIDATA_ENTITY_PREFIX, "")
+                bindings.setdefault(qid, []).append(item)
+            with self.lock:
+                self.responses["sparql"].update(bindings)
+        return self.__response(
+            {"results": {"bindings": [b for qid in qids for b in self.responses["sparql"][qid]]}}
+        )
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.fixture_file), exist_ok=True)
+        with open(self.fixture_file, "w", encoding="utf-8") as f:
+            json.dump(self.responses, f, indent=2, ensure_ascii=False)
+
+    def __live_request(self, method: str, url: str, timeout: float, *keys, **kwargs):
+        if self.live_session is None:
+            with self.lock:
+                self.missing.update(keys)
+            raise requests.ConnectionError("No recorded Wikidata response, run with --record")
+        response = getattr(self.live_session, method)(url, timeout=timeout, **kwargs)
+        # Failures are retried by the matcher and never recorded
+        response.raise_for_status()
+        return response
+
+    @staticmethod
+    def __response(data: dict):
+        return SimpleNamespace(status_code=200, json=lambda: data)
+
+
+class Benchmark:
+    """Throughput, per-stage latency and quality of extraction and matching.
+
+    Gemini and Wikidata answer from recorded raw responses, and every
+    measurement starts from an empty Gemini response cache and an empty
+    Wikidata cache, so each matching decision is made by the configured
+    matcher. Embeddings and the local index are kept in a temporary directory
+    of the run. Quality is scored with a fixed judge model. With an
+    `embedding_backend` other than the reference one, the extracted concepts
+    are also matched locally with both backends to measure how often their
+    decisions agree.
+    """
+
+    def __init__(
+        self, fixtures_dir: str, config_dir: str, record: bool, embedding_backend: str = None
+    ):
+        self.fixtures_dir = fixtures_dir
+        self.config_dir = config_dir
+        self.record = record
+        self.embedding_backend = embedding_backend
+        self.work_dir = tempfile.mkdtemp(prefix="curriculum_lens_benchmark_")
+
+        live_client, live_session = None, None
+        if record:
+            live_client = GeminiClient(
+                self.__write_config(
+                    "gemini_config.yaml",
+                    os.path.join(self.work_dir, "gemini_config.yaml"),
+                    {"response_cache_file": os.path.join(self.work_dir, "live_response_cache.sqlite")},
+                )
+            ).client
+            live_session = requests.Session()
+            live_session.headers["User-Agent"] = WikidataMatcher.load_config(
+                self.__config("wikidata_config.yaml")
+            ).user_agent
+        self.genai = RecordedGenAI(os.path.join(fixtures_dir, GEMINI_FIXTURE), live_client)
+        self.wikidata_session = RecordedWikidataSession(
+            os.path.join(fixtures_dir, WIKIDATA_FIXTURE), live_session
+        )
+        # Loaded embedding backends, reused across datasets
+        self.embedding_backends = {}
+        judge = create_embedding_backend(REFERENCE_EMBEDDING_BACKEND, JUDGE_EMBEDDING_MODEL, None)
+        self.judge_embeddings = EmbeddingCache(
+            lambda: judge, judge.cache_name, os.path.join(self.work_dir, "judge_embeddings")
+        )
+
+    def run(self, ground_truth_files: List[str]) -> dict:
+        results = {
+            "meta": {
+                "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                "recorded": self.record,
+                "fixtures_dir": self.fixtures_dir,
+            },
+            "datasets": {},
+        }
+        try:
+            # Loads the model and builds the local index outside the measurements
+            _, wikidata_matcher = self.__create_clients("warm_up")
+            if wikidata_matcher.mode == MatcherMode.LOCAL:
+                wikidata_matcher.local_index
+            for gt_file in ground_truth_files:
+                print(f"Benchmarking {gt_file}...")
+                results["datasets"][gt_file] = self.run_dataset(pd.read_csv(gt_file))
+        finally:
+            if self.record:
+                self.genai.save()
+                self.wikidata_session.save()
+            shutil.rmtree(self.work_dir, ignore_errors=True)
+        return results
+
+    def run_dataset(self, gt_df: pd.DataFrame) -> dict:
+        courses = list(zip(gt_df["course_name"], gt_df["program_content"]))
+        metrics.reset()
+
+        # Batched pass, as run by the pipeline
+        gemini_client, wikidata_matcher = self.__create_clients("throughput")
+        start = time.time()
+        extracted = list(gemini_client.extract_covered_concepts_batch(courses))
+        extraction_time = time.time() - start
+        self.__check_recordings()
+        pairs = [
+            (concept, course_name)
+            for (course_name, _), concepts in zip(courses, extracted)
+            for concept in concepts or []
+        ]
+        if self.record:
+            self.__record_wikidata(pairs)
+        start = time.time()
+        entities = wikidata_matcher.search_entities(pairs) if pairs else []
+        matching_time = time.time() - start
+        wall_time = extraction_time + matching_time
+        self.__check_recordings()
+
+        # Course-by-course pass for per-stage latencies
+        gemini_client, wikidata_matcher = self.__create_clients("latency")
+        latencies = {"extraction": [], "matching": []}
+        for course_name, content in courses:
+            start = time.time()
+            concepts = gemini_client.extract_covered_concepts(course_name, content) or []
+            latencies["extraction"].append(time.time() - start)
+            start = time.time()
+            if concepts:
+                wikidata_matcher.search_entities([(c, course_name) for c in concepts])
+            latencies["matching"].append(time.time() - start)
+        self.__check_recordings()
+
+        labels = {}
+        for (concept, course_name), entity in zip(pairs, entities):
+            if entity:
+                labels.setdefault(course_name, []).append(entity.label.lower())
+
+        extraction_scores = []
+        matching_scores = []
+        for (course_name, _), concepts, gt_concepts in zip(
+            courses, extracted, gt_df["educational_concepts"]
+        ):
+            gt_concepts = [c.strip() for c in str(gt_concepts).split(";") if c.strip()]
+            extraction_scores.append(self.semantic_match(gt_concepts, concepts or []))
+            matching_scores.append(
+                self.semantic_match(gt_concepts, labels.get(course_name, []))
+            )
+
+        return {
+            "courses": len(courses),
+            "failed_extractions": sum(concepts is None for concepts in extracted),
+            "throughput": {
+                "wall_time_seconds": wall_time,
+                "courses_per_second": len(courses) / max(wall_time, 1e-9),
+                "extraction_seconds": extraction_time,
+                "matching_seconds": matching_time,
+            },
+            "latency": {
+                stage: self.percentiles(values) for stage, values in latencies.items()
+            },
+            "quality": {
+                "extraction": self.metrics(extraction_scores),
+                "matching": {
+                    **self.metrics(matching_scores),
+                    "match_rate": sum(e is not None for e in entities) / max(len(entities), 1),
+                },
+            },
+            "metrics": metrics.report(),
+            **(
+                {"backend_agreement": self.backend_agreement(pairs)}
+                if self.embedding_backend not in (None, REFERENCE_EMBEDDING_BACKEND)
+                else {}
+            ),
+        }
+
+    def backend_agreement(self, pairs: List[tuple]) -> dict:
+        """Matches `pairs` with the reference and the benchmarked embedding backend.
+
+        Both resolve every pair against the local index, starting from an
+        empty Wikidata cache, so each decision is made by the backend itself.
+        The configured embedding model is used by both.
+        """
+        decisions = {}
+        query_embeddings = {}
+        queries = list(dict.fromkeys(concept for concept, _ in pairs))
+        for backend in [REFERENCE_EMBEDDING_BACKEND, self.embedding_backend]:
+            run_name = f"agreement_{backend}"
+            _, wikidata_matcher = self.__create_clients(
+                run_name,
+                {
+                    "embedding_backend": backend,
+                    "mode": "local",
+                    "online_fallback": False,
+                },
+            )
+            entities = wikidata_matcher.search_entities(pairs) if pairs else []
+            decisions[backend] = [entity.qid if entity else None for entity in entities]
+            query_embeddings[backend] = wikidata_matcher.embeddings.encode(queries)
+
+        reference, benchmarked = decisions[REFERENCE_EMBEDDING_BACKEND], decisions[self.embedding_backend]
+        return {
+            "reference": REFERENCE_EMBEDDING_BACKEND,
+            "backend": self.embedding_backend,
+            "decisions": len(pairs),
+            "agreement": sum(a == b for a, b in zip(reference, benchmarked)) / max(len(pairs), 1),
+            "reference_match_rate": sum(q is not None for q in reference) / max(len(pairs), 1),
+            "match_rate": sum(q is not None for q in benchmarked) / max(len(pairs), 1),
+            "embedding_cosine": float(
+                np.mean(
+                    np.sum(
+                        query_embeddings[REFERENCE_EMBEDDING_BACKEND]
+                        * query_embeddings[self.embedding_backend],
+                        axis=1,
+                    )
+                )
+            )
+            if queries
+            else 1.0,
+        }
+
+    def semantic_match(self, gt_concepts: List[str], gen_concepts: List[str]) -> tuple:
+        """Greedy embedding match of generated concepts to ground-truth concepts.
+
+        Mirrors the notebook evaluation: alternatives are separated by ':' and
+        optional parts are marked with [...]. Concepts are embedded with the
+        judge model, so scores compare across benchmarked configurations.
+        Returns (TP, FP, FN).
+        """
+        if not gt_concepts or not gen_concepts:
+            return 0, len(gen_concepts), len(gt_concepts)
+
+        variants, variant_to_gt = [], []
+        for gt_idx, concept in enumerate(gt_concepts):
+            for variant in self.expand_gt_concept(concept):
+                variants.append(variant)
+                variant_to_gt.append(gt_idx)
+
+        embeddings = self.judge_embeddings.encode(variants + gen_concepts)
+        similarities = embeddings[len(variants) :] @ embeddings[: len(variants)].T
+
+        matched_gt = set()
+        for gen_similarities in similarities:
+            best = int(np.argmax(gen_similarities))
+            gt_idx = variant_to_gt[best]
+            if gen_similarities[best] >= SEMANTIC_MATCH_THRESHOLD and gt_idx not in matched_gt:
+                matched_gt.add(gt_idx)
+
+        tp = len(matched_gt)
+        return tp, len(gen_concepts) - tp, len(gt_concepts) - tp
+
+    @staticmethod
+    def expand_gt_concept(concept: str) -> List[str]:
+        variants = []
+        for option in concept.split(":"):
+            # Even parts are mandatory, odd parts are optional
+            parts = re.split(r"\[(.*?)\]", option)
+            combos = [[]]
+            for i, part in enumerate(parts):
+                if i % 2 == 0:
+                    combos = [c + [part.strip()] for c in combos]
+                else:
+                    combos += [c + [part.strip()] for c in combos]
+            variants += [" ".join(filter(None, c)).strip() for c in combos]
+        return [v for v in dict.fromkeys(variants) if v]
+
+    @staticmethod
+    def metrics(scores: List[tuple]) -> Dict[str, float]:
+        tp, fp, fn = (sum(s[i] for s in scores) for i in range(3))
+        precision = tp / (tp + fp) if (tp + fp) > 0 else 0.0
+        recall = tp / (tp + fn) if (tp + fn) > 0 else 0.0
+        f1 = 2 * precision * recall / (precision + recall) if (precision + recall) > 0 else 0.0
+        return {"precision": precision, "recall": recall, "f1": f1}
+
+    @staticmethod
+    def percentiles(values: List[float]) -> Dict[str, float]:
+        if not values:
+            return {}
+        return {
+            "mean": float(np.mean(values)),
+            "p50": float(np.percentile(values, 50)),
+            "p90": float(np.percentile(values, 90)),
+            "p99": float(np.percentile(values, 99)),
+        }
+
+    def __create_clients(self, run_name: str, wikidata_overrides: dict = None):
+        run_dir = os.path.join(self.work_dir, run_name)
+        os.makedirs(run_dir, exist_ok=True)
+
+        gemini_config_file = self.__write_config(
+            "gemini_config.yaml",
+            os.path.join(run_dir, "gemini_config.yaml"),
+            {"response_cache_file": os.path.join(run_dir, "gemini_response_cache.sqlite")}
+            # Replayed answers do not change on retry
+            | ({} if self.record else {"backoff_base_seconds": 0, "max_nr_of_trials": 1}),
+        )
+        gemini_client = GeminiClient(
+            gemini_config_file,
+            client=self.genai,
+            rate_limiter=None if self.record else TokenBucket(1e9, 1_000_000),
+        )
+
+        # Every run starts from an empty Wikidata cache; embeddings and the
+        # local index stay in the benchmark's own directory
+        overrides = {
+            "cache_backend": "sqlite",
+            "cache_file": os.path.join(run_dir, "wikidata_cache.sqlite"),
+            "legacy_cache_file": "",
+            "embedding_cache_dir": os.path.join(self.work_dir, "embeddings"),
+            "index_dir": os.path.join(self.work_dir, "wikidata_index"),
+        }
+        if not self.record:
+            overrides["backoff_base_seconds"] = 0
+        if self.embedding_backend:
+            overrides["embedding_backend"] = self.embedding_backend
+        overrides |= wikidata_overrides or {}
+        wikidata_config_file = self.__write_config(
+            "wikidata_config.yaml", os.path.join(run_dir, "wikidata_config.yaml"), overrides
+        )
+        backend = overrides.get("embedding_backend")
+        wikidata_matcher = WikidataMatcher(
+            wikidata_config_file,
+            embedding_backend=self.embedding_backends.get(backend),
+            rate_limiter=None if self.record else TokenBucket(1e9, 1_000_000),
+            session=self.wikidata_session,
+        )
+        self.embedding_backends[backend] = wikidata_matcher.embedding_backend
+        return gemini_client, wikidata_matcher
+
+    def __record_wikidata(self, pairs: List[tuple]):
+        """Records the online search of every concept, whichever tier resolves it.
+
+        Replays can then send any concept online, whatever the matcher settings.
+        """
+        _, wikidata_matcher = self.__create_clients("record", {"mode": "online"})
+        queries = list(dict.fromkeys(concept for concept, _ in pairs))
+        if queries:
+            wikidata_matcher._search_wikidata_batch(queries)
+
+    def __check_recordings(self):
+        # Scores of a replay with missing answers would be meaningless
+        for name, recording in [("prompts", self.genai), ("Wikidata requests", self.wikidata_session)]:
+            if recording.missing:
+                raise SystemExit(
+                    f"{len(recording.missing)} {name} have no recorded response in "
+                    f"{recording.fixture_file}, run with --record"
+                )
+
+    def __write_config(self, name: str, output_file: str, overrides: dict) -> str:
+        with open(self.__config(name), "r") as f:
+            config = yaml.safe_load(f)
+        with open(output_file, "w") as f:
+            yaml.safe_dump(config | overrides, f)
+        return output_file
+
+    def __config(self, name: str) -> str:
+        return os.path.join(self.config_dir, name)
+
+
+def compare(before: dict, after: dict, prefix: str = ""):
+    """Prints every numeric result that is present in both runs."""
+    for key, value in after.items():
+        if key not in before or key == "buckets":
+            continue
+        if isinstance(value, dict):
+            compare(before[key], value, f"{prefix}{key}.")
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            change = (value - before[key]) / before[key] * 100 if before[key] else float("nan")
+            print(f"{prefix}{key:<40} {before[key]:>12.4f} -> {value:>12.4f} ({change:+.1f}%)")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark concept extraction and Wikidata matching against ground truth."
+    )
+    parser.add_argument("ground_truth", nargs="*", default=GROUND_TRUTH_FILES)
+    parser.add_argument("--fixtures-dir", default=FIXTURES_DIR)
+    parser.add_argument("--config-dir", default=CONFIG_DIR)
+    parser.add_argument("-o", "--output", default="benchmark_results.json")
+    parser.add_argument(
+        "--record",
+        action="store_true",
+        help="call Gemini and Wikidata for prompts missing from the fixtures and record them",
+    )
+    parser.add_argument("--compare", metavar="BEFORE_JSON", help="results of an earlier run")
+    parser.add_argument(
+        "--embedding-backend",
+        choices=["sentence-transformers", "onnx"],
+        help="override the configured backend; onnx is also checked against the reference",
+    )
+    parser.add_argument(
+        "--agreement-tolerance",
+        type=float,
+        default=0.02,
+        help="largest share of matching decisions allowed to differ from the reference backend",
+    )
+    parser.add_argument("--log-level", default="WARNING")
+    args = parser.parse_args()
+    configure_logging(args.log_level)
+
+    fixtures_dir, record = args.fixtures_dir, args.record
+    if not record and not os.path.exists(os.path.join(fixtures_dir, GEMINI_FIXTURE)):
+        fixtures_dir = tempfile.mkdtemp(prefix="curriculum_lens_fixtures_")
+        record = True
+        print(
+            f"No fixtures in {args.fixtures_dir}, recording Gemini and Wikidata responses "
+            f"into {fixtures_dir}; this needs a Gemini API key and network access. "
+            f"Copy them to {args.fixtures_dir} to replay offline."
+        )
+
+    results = Benchmark(fixtures_dir, args.config_dir, record, args.embedding_backend).run(
+        args.ground_truth
+    )
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(results, f, indent=2)
+    print(f"Results written to {args.output}")
+
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as f:
+            compare(json.load(f), results)
+
+    failed = {
+        gt_file: dataset["failed_extractions"]
+        for gt_file, dataset in results["datasets"].items()
+        if dataset["failed_extractions"]
+    }
+    if failed and not record:
+        raise SystemExit(f"Extractions failed on replay: {failed}")
+
+    within_tolerance = True
+    for gt_file, dataset in results["datasets"].items():
+        if "backend_agreement" in dataset:
+            agreement = dataset["backend_agreement"]
+            print(
+                f"{gt_file}: {agreement['backend']} agrees with {agreement['reference']} "
+                f"on {agreement['agreement']:.1%} of {agreement['decisions']} decisions"
+            )
+            within_tolerance &= 1 - agreement["agreement"] <= args.agreement_tolerance
+    if not within_tolerance:
+        raise SystemExit(f"Matching decisions differ by more than {args.agreement_tolerance:.1%}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,16 +1,99 @@
 import os
+import ast
+import time
+import logging
 import pandas as pd
-from sentence_transformers import SentenceTransformer
-from gemini_client import GeminiClient
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+from gemini_client import ExtractionTaskType, GeminiClient
+from instrumentation import metrics
 from wikidata import WikidataMatcher
 from knowledge_graph import KnowledgeGraph
+from manifest import PipelineStage, StageManifest
+from streaming import ParquetTableWriter, pipelined
+
+COVERED_CONCEPTS_COLUMNS = ["course_name", "covered_concepts"]
+PREREQUISITES_CONCEPTS_COLUMNS = ["course_name", "prerequisites_concepts"]
+MATCHED_CONCEPTS_COLUMNS = [
+    "course_name",
+    "concept",
+    "wikidata_qid",
+    "wikidata_label",
+    "wikidata_description",
+    "wikidata_url",
+]
+
+logger = logging.getLogger(__name__)
+
+
+def parse_concepts(concepts):
+    """Reads a concept list that the CSV outputs store as its Python repr."""
+    if isinstance(concepts, str):
+        return list(ast.literal_eval(concepts))
+    return concepts
+
+
+def matched_row(concept: str, course_name: str, entity) -> dict:
+    """One row of the `*_matched` outputs."""
+    return {
+        "course_name": course_name,
+        "concept": concept,
+        "wikidata_qid": entity.qid if entity else None,
+        "wikidata_label": entity.label if entity else None,
+        "wikidata_description": entity.description if entity else None,
+        "wikidata_url": entity.url if entity else None,
+    }
+
+
+def has_content(content) -> bool:
+    """Whether a curriculum cell holds text to extract concepts from."""
+    return isinstance(content, str) and content.strip() != ""
+
+
+def extraction_rows(course_name: str, concepts: List[str], concepts_column: str) -> List[dict]:
+    """The rows of a course in an extraction output, as written by both pipeline modes.
+
+    A course without prerequisites, answered with no concepts or "none", has no row.
+    """
+    if concepts_column == "prerequisites_concepts" and (not concepts or concepts[0] == "none"):
+        return []
+    return [{"course_name": course_name, concepts_column: concepts}]
+
+
+def matched_rows(rows: List[dict], concepts_column: str, entities: Dict[tuple, object]) -> List[dict]:
+    """One matched row per extracted concept, duplicates included, in extraction order.
+
+    `entities` maps every (concept, course_name) pair to its entity or None.
+    """
+    return [
+        matched_row(concept, row["course_name"], entities[(concept, row["course_name"])])
+        for row in rows
+        if isinstance(row[concepts_column], list)
+        for concept in row[concepts_column]
+    ]
 
 
 class EducationalConceptExtractor:
-    def __init__(self, curriculum_file: str):
+    def __init__(
+        self,
+        curriculum_file: str,
+        gemini_client: GeminiClient = None,
+        wikidata_matcher: WikidataMatcher = None,
+        graph_driver=None,
+        graph_batch_size: int = 1000,
+        streaming: bool = False,
+        chunk_size: int = 50,
+        progress: Callable[[dict], None] = None,
+    ):
+        start = time.time()
         self.curriculum_file = curriculum_file
-        self.gemini_client = GeminiClient()
-        self.wikidata_matcher = WikidataMatcher()
+        self.gemini_client = gemini_client or GeminiClient()
+        self.wikidata_matcher = wikidata_matcher or WikidataMatcher()
+        self.graph_driver = graph_driver
+        self.graph_batch_size = graph_batch_size
+        # Receives a "course" event for every course a stage finished and a
+        # "stage" event for every finished stage
+        self.progress = progress or (lambda event: None)
+        self.timings = {}
 
         self.covered_concepts_file = (
             f"{curriculum_file.removesuffix('.csv')}_covered_concepts.csv"
@@ -24,160 +107,465 @@ class EducationalConceptExtractor:
         self.matched_prerequisites_concepts_file = (
             f"{curriculum_file.removesuffix('.csv')}_prerequisites_concepts_matched.csv"
         )
+        self.manifest = StageManifest(
+            f"{curriculum_file.removesuffix('.csv')}_manifest.json"
+        )
+        self.curriculum = None if streaming else pd.read_csv(self.curriculum_file, index_col=0)
+        self.timings["startup"] = time.time() - start
 
-        self.__extract_covered_concepts()
-        self.__match_covered_concepts_to_wikidata()
-        self.__extract_prerequisites_concepts()
-        self.__match_prerequisites_concepts_to_wikidata()
+        if streaming:
+            self.__stream(chunk_size)
+            return
 
-        self.kg = KnowledgeGraph(
-            self.matched_covered_concepts_file, self.matched_prerequisites_concepts_file, self.curriculum_file
-        )
+        curriculum_name = os.path.basename(curriculum_file).removesuffix(".csv")
+        for stage_name, run_stage in [
+            ("covered extraction", self.__extract_covered_concepts),
+            ("prerequisites extraction", self.__extract_prerequisites_concepts),
+            ("matching", self.__match_concepts_to_wikidata),
+            ("graph load", self.__load_knowledge_graph),
+        ]:
+            start = time.time()
+            metric_name = stage_name.replace(" ", "_")
+            with metrics.profile(f"{curriculum_name}.{metric_name}"):
+                with metrics.timer(f"stage.{metric_name}"):
+                    run_stage()
+            self.timings[stage_name] = time.time() - start
+            self.progress(
+                {"event": "stage", "stage": stage_name, "seconds": self.timings[stage_name]}
+            )
 
     def __extract_covered_concepts(self):
-        if os.path.exists(self.covered_concepts_file):
-            print(f"Covered concepts already extracted. Skipping extraction.")
-            return pd.read_csv(self.covered_concepts_file)
+        self.__prefetch_extractions()
+        contents = dict(zip(self.curriculum["course_name"], self.curriculum["program_content"]))
+        hashes = {
+            course_name: self.__extraction_hash(course_name, content)
+            for course_name, content in contents.items()
+        }
 
-        df = pd.read_csv(self.curriculum_file, index_col=0)
-        extracted_concepts = []
+        def extract(course_names: List[str]):
+            courses = [(course_name, contents[course_name]) for course_name in course_names]
+            for (course_name, _), covered_concepts in zip(
+                courses, self.gemini_client.extract_covered_concepts_batch(courses)
+            ):
+                logger.debug("Extracted concepts for %s: %s", course_name, covered_concepts)
+                if covered_concepts is None:
+                    yield course_name, None
+                    continue
+                yield course_name, extraction_rows(
+                    course_name, covered_concepts, "covered_concepts"
+                )
+            self.gemini_client.response_cache.flush()
+            logger.info("Gemini response cache: %s", self.gemini_client.response_cache.stats())
 
-        for _, row in df.iterrows():
-            course_name, course_content = row["course_name"], row["program_content"]
-            covered_concepts = self.gemini_client.extract_covered_concepts(
-                course_name, course_content
-            )
-            extracted_concepts.append(
-                {"course_name": course_name, "covered_concepts": covered_concepts}
-            )
-            print(f"Extracted concepts for {course_name}: {covered_concepts}")
-            print(f"Total time: {self.gemini_client.total_time}")
+        return self.__run_stage(
+            PipelineStage.COVERED_EXTRACTION,
+            self.covered_concepts_file,
+            COVERED_CONCEPTS_COLUMNS,
+            hashes,
+            extract,
+        )
 
-        concepts_df = pd.DataFrame(extracted_concepts)
-        concepts_df.to_csv(self.covered_concepts_file, index=False)
-        return concepts_df
-    
     def __extract_prerequisites_concepts(self):
-        if os.path.exists(self.prerequisites_concepts_file):
-            print(f"Prerequisites concepts already extracted. Skipping extraction.")
-            return pd.read_csv(self.prerequisites_concepts_file)
+        contents = dict(zip(self.curriculum["course_name"], self.curriculum["prerequisites"]))
+        hashes = {
+            course_name: self.__extraction_hash(course_name, content)
+            for course_name, content in contents.items()
+        }
 
-        df = pd.read_csv(self.curriculum_file, index_col=0)
-        extracted_concepts = []
+        def extract(course_names: List[str]):
+            courses = []
+            for course_name in course_names:
+                course_content = contents[course_name]
+                if not has_content(course_content):
+                    logger.debug("No prerequisites concepts for %s", course_name)
+                    yield course_name, []
+                    continue
+                courses.append((course_name, course_content))
 
-        for _, row in df.iterrows():
-            course_name, course_content = row["course_name"], row["prerequisites"]
-            if pd.isna(course_content) or isinstance(course_content, float) or course_content.strip() == "":
-                print(f"NO prerequisites concepts for {course_name}")
+            for (course_name, _), prerequisites_concepts in zip(
+                courses, self.gemini_client.extract_prerequisite_concepts_batch(courses)
+            ):
+                if prerequisites_concepts is None:
+                    yield course_name, None
+                    continue
+                logger.debug(
+                    "Extracted prerequisites concepts for %s: %s", course_name, prerequisites_concepts
+                )
+                yield course_name, extraction_rows(
+                    course_name, prerequisites_concepts, "prerequisites_concepts"
+                )
+            self.gemini_client.response_cache.flush()
+            logger.info("Gemini response cache: %s", self.gemini_client.response_cache.stats())
+
+        return self.__run_stage(
+            PipelineStage.PREREQUISITES_EXTRACTION,
+            self.prerequisites_concepts_file,
+            PREREQUISITES_CONCEPTS_COLUMNS,
+            hashes,
+            extract,
+        )
+
+    def __prefetch_extractions(self):
+        """Sends the covered and prerequisite extractions of outdated courses together.
+
+        Only has an effect with packed prompts of both task types; the
+        extraction stages then find their answers in the response cache.
+        """
+        config = self.gemini_client.config
+        if not (config.packing and config.pack_task_types):
+            return
+
+        tasks = []
+        for stage, output_file, column, task_type in [
+            (
+                PipelineStage.COVERED_EXTRACTION,
+                self.covered_concepts_file,
+                "program_content",
+                ExtractionTaskType.COVERED_CONCEPTS,
+            ),
+            (
+                PipelineStage.PREREQUISITES_EXTRACTION,
+                self.prerequisites_concepts_file,
+                "prerequisites",
+                ExtractionTaskType.PREREQUISITE_CONCEPTS,
+            ),
+        ]:
+            if os.path.exists(output_file) and not self.manifest.has_stage(stage):
+                # Output written before the manifest existed is adopted as is
                 continue
+            for course_name, content in zip(self.curriculum["course_name"], self.curriculum[column]):
+                if not has_content(content):
+                    continue
+                if not self.manifest.is_current(
+                    stage, course_name, self.__extraction_hash(course_name, content)
+                ):
+                    tasks.append((course_name, content, task_type))
+        self.gemini_client.prefetch(tasks)
+
+    def __match_concepts_to_wikidata(self):
+        """Matches the covered and prerequisite concepts of both stages in one pass.
+
+        Every distinct (concept, course) pair is resolved once and the results
+        are merged back onto the rows of each stage.
+        """
+        stages = [
+            (
+                PipelineStage.COVERED_MATCHING,
+                self.matched_covered_concepts_file,
+                pd.read_csv(self.covered_concepts_file),
+                "covered_concepts",
+            ),
+            (
+                PipelineStage.PREREQUISITES_MATCHING,
+                self.matched_prerequisites_concepts_file,
+                pd.read_csv(self.prerequisites_concepts_file),
+                "prerequisites_concepts",
+            ),
+        ]
 
-            prerequisites_concepts = self.gemini_client.extract_prerequisite_concepts(
-                course_name, course_content
+        matching_settings = self.wikidata_matcher.matching_settings()
+        pending_stages = []
+        for stage, output_file, concepts_df, concepts_column in stages:
+            concepts_df = concepts_df[["course_name", concepts_column]].rename(
+                columns={concepts_column: "concept"}
             )
-            if len(prerequisites_concepts)==0 or prerequisites_concepts[0]=="none":
-                print(f"NO prerequisites concepts for {course_name}")
-                continue
+            concepts_df["concept"] = concepts_df["concept"].map(parse_concepts)
+            hashes = {
+                course_name: StageManifest.content_hash(concepts, matching_settings)
+                for course_name, concepts in zip(
+                    concepts_df["course_name"], concepts_df["concept"]
+                )
+            }
+            pending = self.__prepare_stage(
+                stage, output_file, MATCHED_CONCEPTS_COLUMNS, hashes
+            )
+            pending_df = concepts_df[concepts_df["course_name"].isin(pending)]
+            pending_stages.append((stage, output_file, hashes, pending, pending_df))
 
-            extracted_concepts.append(
-                {"course_name": course_name, "prerequisites_concepts": prerequisites_concepts}
+        pairs_df = (
+            pd.concat([pending_df for *_, pending_df in pending_stages])
+            .explode("concept")
+            .dropna(subset=["concept"])
+            .drop_duplicates()
+        )
+        entities = (
+            self.wikidata_matcher.search_entities(
+                list(zip(pairs_df["concept"], pairs_df["course_name"]))
             )
-            print(f"Extracted prerequisites concepts for {course_name}: {prerequisites_concepts}")
-            print(f"Total time: {self.gemini_client.total_time}")
+            if len(pairs_df)
+            else []
+        )
+        self.wikidata_matcher.save_embeddings()
+        entities = dict(zip(zip(pairs_df["concept"], pairs_df["course_name"]), entities))
+
+        for stage, output_file, hashes, pending, pending_df in pending_stages:
+            rows_by_course = {}
+            for row in matched_rows(pending_df.to_dict("records"), "concept", entities):
+                rows_by_course.setdefault(row["course_name"], []).append(row)
+            self.__complete_stage(
+                stage,
+                output_file,
+                MATCHED_CONCEPTS_COLUMNS,
+                hashes,
+                (
+                    (course_name, rows_by_course.get(course_name, []))
+                    for course_name in pending
+                ),
+            )
+
+    def __load_knowledge_graph(self):
+        # Always synced: Memgraph keeps no data across restarts, and a graph
+        # that is already up to date costs one read and no writes
+        self.kg = KnowledgeGraph(
+            self.matched_covered_concepts_file,
+            self.matched_prerequisites_concepts_file,
+            self.curriculum_file,
+            driver=self.graph_driver,
+            batch_size=self.graph_batch_size,
+        )
+        self.kg.close()
 
-        concepts_df = pd.DataFrame(extracted_concepts)
-        concepts_df.to_csv(self.prerequisites_concepts_file, index=False)
-        return concepts_df
+    def __stream(self, chunk_size: int):
+        """Streams the curriculum through extraction, matching and graph load.
 
-    def __match_covered_concepts_to_wikidata(self):
-        if os.path.exists(self.matched_covered_concepts_file):
-            print(f"Concepts already matched to Wikidata. Skipping matching.")
-            return pd.read_csv(self.matched_covered_concepts_file)
+        Chunks of `chunk_size` courses flow between the stages through bounded
+        queues, so matching and loading start on the first chunk while later
+        ones are still extracted, and memory stays flat however large the
+        curriculum is. Results are appended to Parquet files with list columns.
+        Streaming does not use the stage manifest: every run recomputes all
+        courses, answered mostly from the response and Wikidata caches. The
+        graph is written chunk by chunk; what the run no longer produced is
+        removed at the end, so it matches a non-streamed load.
+        """
+        prefix = self.curriculum_file.removesuffix(".csv")
+        for stage_name in ["covered extraction", "prerequisites extraction", "matching", "graph load"]:
+            self.timings[stage_name] = 0.0
 
-        concepts_df = pd.read_csv(self.covered_concepts_file)
+        def extract(chunk: pd.DataFrame) -> Tuple[pd.DataFrame, List[dict], List[dict]]:
+            start = time.time()
+            courses = list(zip(chunk["course_name"], chunk["program_content"]))
+            covered_rows = [
+                row
+                for (course_name, _), concepts in zip(
+                    courses, self.gemini_client.extract_covered_concepts_batch(courses)
+                )
+                if self.__extracted(course_name, concepts)
+                for row in extraction_rows(course_name, concepts, "covered_concepts")
+            ]
+            self.timings["covered extraction"] += time.time() - start
 
-        matched_rows = []
+            start = time.time()
+            courses = [
+                (course_name, content)
+                for course_name, content in zip(chunk["course_name"], chunk["prerequisites"])
+                if has_content(content)
+            ]
+            prerequisites_rows = [
+                row
+                for (course_name, _), concepts in zip(
+                    courses, self.gemini_client.extract_prerequisite_concepts_batch(courses)
+                )
+                if self.__extracted(course_name, concepts)
+                for row in extraction_rows(course_name, concepts, "prerequisites_concepts")
+            ]
+            self.timings["prerequisites extraction"] += time.time() - start
+            return chunk, covered_rows, prerequisites_rows
 
-        for _, row in concepts_df.iterrows():
-            course_name = row["course_name"]
-            concepts = (
-                eval(row["covered_concepts"])
-                if isinstance(row["covered_concepts"], str)
-                else row["covered_concepts"]
+        def match(extracted):
+            start = time.time()
+            chunk, covered_rows, prerequisites_rows = extracted
+            # The distinct (concept, course_name) pairs of both stages, resolved together
+            pairs = list(
+                dict.fromkeys(
+                    (concept, row["course_name"])
+                    for rows, concepts_column in [
+                        (covered_rows, "covered_concepts"),
+                        (prerequisites_rows, "prerequisites_concepts"),
+                    ]
+                    for row in rows
+                    for concept in row[concepts_column]
+                )
+            )
+            entities = dict(
+                zip(pairs, self.wikidata_matcher.search_entities(pairs) if pairs else [])
+            )
+            matched_covered = matched_rows(covered_rows, "covered_concepts", entities)
+            matched_prerequisites = matched_rows(
+                prerequisites_rows, "prerequisites_concepts", entities
             )
+            self.timings["matching"] += time.time() - start
+            return chunk, covered_rows, prerequisites_rows, matched_covered, matched_prerequisites
 
-            for concept in concepts:
-                entity = self.wikidata_matcher.search_entity(concept, course_name)
-                print(entity)
-
-                if entity:
-                    matched_rows.append(
-                        {
-                            "course_name": course_name,
-                            "concept": concept,
-                            "wikidata_qid": entity.qid,
-                            "wikidata_label": entity.label,
-                            "wikidata_description": entity.description,
-                            "wikidata_url": entity.url,
-                        }
-                    )
-                else:
-                    matched_rows.append(
-                        {
-                            "course_name": course_name,
-                            "concept": concept,
-                            "wikidata_qid": None,
-                            "wikidata_label": None,
-                            "wikidata_description": None,
-                            "wikidata_url": None,
-                        }
+        chunks = pd.read_csv(self.curriculum_file, index_col=0, chunksize=chunk_size)
+        results = pipelined(map(match, pipelined(map(extract, chunks))))
+
+        graph = KnowledgeGraph(
+            driver=self.graph_driver,
+            batch_size=self.graph_batch_size,
+            curriculum=os.path.basename(self.curriculum_file).removesuffix(".csv"),
+        )
+        # Only the keys of the loaded edges are kept, for the final cleanup
+        loaded_edges = set()
+        with ParquetTableWriter(
+            f"{prefix}_covered_concepts.parquet", COVERED_CONCEPTS_COLUMNS, ["covered_concepts"]
+        ) as covered_writer, ParquetTableWriter(
+            f"{prefix}_prerequisites_concepts.parquet",
+            PREREQUISITES_CONCEPTS_COLUMNS,
+            ["prerequisites_concepts"],
+        ) as prerequisites_writer, ParquetTableWriter(
+            f"{prefix}_covered_concepts_matched.parquet", MATCHED_CONCEPTS_COLUMNS
+        ) as matched_covered_writer, ParquetTableWriter(
+            f"{prefix}_prerequisites_concepts_matched.parquet", MATCHED_CONCEPTS_COLUMNS
+        ) as matched_prerequisites_writer:
+            for chunk, covered, prerequisites, matched_covered, matched_prerequisites in results:
+                covered_writer.write(covered)
+                prerequisites_writer.write(prerequisites)
+                matched_covered_writer.write(matched_covered)
+                matched_prerequisites_writer.write(matched_prerequisites)
+
+                start = time.time()
+                graph.add_concept_rows(matched_covered, "COVERS")
+                graph.add_concept_rows(matched_prerequisites, "HAS_PREREQUISITE")
+                for rows, relationship in [
+                    (matched_covered, "COVERS"),
+                    (matched_prerequisites, "HAS_PREREQUISITE"),
+                ]:
+                    loaded_edges.update(
+                        (row["course_name"], relationship, row["wikidata_qid"])
+                        for row in rows
+                        if row["wikidata_qid"]
                     )
+                details = chunk[["course_name", "semester", "ects"]]
+                graph.add_course_detail_rows(
+                    details.astype(object).where(details.notna(), None).to_dict("records")
+                )
+                self.timings["graph load"] += time.time() - start
+                for stage, rows in [
+                    (PipelineStage.COVERED_MATCHING, matched_covered),
+                    (PipelineStage.PREREQUISITES_MATCHING, matched_prerequisites),
+                ]:
+                    rows_by_course = {}
+                    for row in rows:
+                        rows_by_course.setdefault(row["course_name"], []).append(row)
+                    for course_name, course_rows in rows_by_course.items():
+                        self.__report_course(stage, course_name, course_rows)
+                logger.info("Streamed %d courses.", len(chunk), extra={"courses": len(chunk)})
 
-        matched_df = pd.DataFrame(matched_rows)
-        matched_df.to_csv(self.matched_covered_concepts_file, index=False)
-    
-    def __match_prerequisites_concepts_to_wikidata(self):
-        if os.path.exists(self.matched_prerequisites_concepts_file):
-            print(f"Concepts already matched to Wikidata. Skipping matching.")
-            return pd.read_csv(self.matched_prerequisites_concepts_file)
+        start = time.time()
+        graph.remove_stale(loaded_edges)
+        self.timings["graph load"] += time.time() - start
+        graph.close()
+        self.wikidata_matcher.save_embeddings()
+        for stage_name in ["covered extraction", "prerequisites extraction", "matching", "graph load"]:
+            self.progress(
+                {"event": "stage", "stage": stage_name, "seconds": self.timings[stage_name]}
+            )
 
-        concepts_df = pd.read_csv(self.prerequisites_concepts_file)
+    def __report_course(self, stage: PipelineStage, course_name: str, rows: List[dict]):
+        self.progress(
+            {"event": "course", "stage": stage.value, "course_name": course_name, "rows": rows}
+        )
 
-        matched_rows = []
+    def __extracted(self, course_name: str, concepts: Optional[List[str]]) -> bool:
+        if concepts is None:
+            logger.warning("Extraction failed for %s, skipping it.", course_name)
+            metrics.increment("streaming.failed_courses")
+            return False
+        return True
 
-        for _, row in concepts_df.iterrows():
-            course_name = row["course_name"]
-            concepts = (
-                eval(row["prerequisites_concepts"])
-                if isinstance(row["prerequisites_concepts"], str)
-                else row["prerequisites_concepts"]
-            )
+    def __run_stage(
+        self,
+        stage: PipelineStage,
+        output_file: str,
+        columns: List[str],
+        hashes: Dict[str, str],
+        compute: Callable[[List[str]], Iterator[Tuple[str, Optional[List[dict]]]]],
+    ) -> pd.DataFrame:
+        pending = self.__prepare_stage(stage, output_file, columns, hashes)
+        return self.__complete_stage(
+            stage, output_file, columns, hashes, compute(pending)
+        )
 
-            for concept in concepts:
-                entity = self.wikidata_matcher.search_entity(concept, course_name)
-                print(entity)
-
-                if entity:
-                    matched_rows.append(
-                        {
-                            "course_name": course_name,
-                            "concept": concept,
-                            "wikidata_qid": entity.qid,
-                            "wikidata_label": entity.label,
-                            "wikidata_description": entity.description,
-                            "wikidata_url": entity.url,
-                        }
-                    )
-                else:
-                    matched_rows.append(
-                        {
-                            "course_name": course_name,
-                            "concept": concept,
-                            "wikidata_qid": None,
-                            "wikidata_label": None,
-                            "wikidata_description": None,
-                            "wikidata_url": None,
-                        }
+    def __prepare_stage(
+        self,
+        stage: PipelineStage,
+        output_file: str,
+        columns: List[str],
+        hashes: Dict[str, str],
+    ) -> List[str]:
+        """Drops outdated rows from `output_file` and returns the courses to recompute."""
+        if os.path.exists(output_file):
+            existing_df = pd.read_csv(output_file)
+            if not self.manifest.has_stage(stage):
+                # Output written before the manifest existed covers the whole
+                # curriculum, including courses that produced no rows
+                for course_name, content_hash in hashes.items():
+                    self.manifest.record(stage, course_name, content_hash)
+        else:
+            existing_df = pd.DataFrame(columns=columns)
+            self.manifest.reset(stage)
+
+        up_to_date = {
+            course_name
+            for course_name, content_hash in hashes.items()
+            if self.manifest.is_current(stage, course_name, content_hash)
+        }
+        pending = [course_name for course_name in hashes if course_name not in up_to_date]
+        logger.info(
+            "%s: reusing %d courses, recomputing %d.",
+            stage.value,
+            len(up_to_date),
+            len(pending),
+            extra={"stage": stage.value, "reused": len(up_to_date), "pending": len(pending)},
+        )
+
+        existing_df = existing_df[existing_df["course_name"].isin(up_to_date)][columns]
+        existing_df.to_csv(output_file, index=False)
+        self.manifest.retain(stage, up_to_date)
+        return pending
+
+    def __complete_stage(
+        self,
+        stage: PipelineStage,
+        output_file: str,
+        columns: List[str],
+        hashes: Dict[str, str],
+        results: Iterator[Tuple[str, Optional[List[dict]]]],
+    ) -> pd.DataFrame:
+        """Appends the rows of each finished course to `output_file` as they arrive.
+
+        An interrupted stage therefore resumes where it stopped.
+        """
+        try:
+            for course_name, rows in results:
+                if rows is None:
+                    logger.warning(
+                        "%s: failed for %s, will retry on the next run.", stage.value, course_name
                     )
+                    metrics.increment(f"stage.{stage.value}.failed_courses")
+                    continue
+                pd.DataFrame(rows, columns=columns).to_csv(
+                    output_file, mode="a", header=False, index=False
+                )
+                self.manifest.record(stage, course_name, hashes[course_name])
+                self.__report_course(stage, course_name, rows)
+        finally:
+            self.manifest.save()
 
-        matched_df = pd.DataFrame(matched_rows)
-        matched_df.to_csv(self.matched_prerequisites_concepts_file, index=False)
\ No newline at end of file
+        # Keep the curriculum order regardless of which courses were recomputed
+        order = {course_name: i for i, course_name in enumerate(hashes)}
+        stage_df = pd.read_csv(output_file).sort_values(
+            "course_name", key=lambda s: s.map(order), kind="stable"
+        )
+        stage_df.to_csv(output_file, index=False)
+        return stage_df
+
+    def __extraction_hash(self, course_name: str, content) -> str:
+        config = self.gemini_client.config
+        return StageManifest.content_hash(
+            course_name,
+            None if pd.isna(content) else content,
+            config.model,
+            config.temperature,
+            config.prompt_version,
+        )
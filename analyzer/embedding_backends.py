@@ -0,0 +1,223 @@
+import os
+import json
+import time
+import logging
+import argparse
+import threading
+import numpy as np
+from typing import List
+from instrumentation import configure_logging, metrics
+
+logger = logging.getLogger(__name__)
+
+ONNX_MODEL_FILE = "model_int8.onnx"
+ONNX_SETTINGS_FILE = "embedding_backend.json"
+
+
+class SentenceTransformerBackend:
+    """Full-precision PyTorch embeddings through sentence-transformers."""
+
+    # A loaded model is shared copy-on-write with forked workers
+    preload_before_fork = True
+
+    def __init__(self, model_name: str, threads: int = 0):
+        self.model_name = model_name
+        self.cache_name = model_name
+        self.threads = threads
+        self._model = None
+        self.lock = threading.Lock()
+
+    def load(self):
+        with self.lock:
+            if self._model is None:
+                from sentence_transformers import SentenceTransformer
+
+                start = time.time()
+                with metrics.timer("embeddings.model_load"):
+                    self._model = SentenceTransformer(self.model_name)
+                self.set_threads(self.threads)
+                logger.info("Loaded embedding model %s in %.2fs", self.model_name, time.time() - start)
+        return self._model
+
+    def set_threads(self, threads: int):
+        self.threads = threads
+        if threads:
+            import torch
+
+            torch.set_num_threads(threads)
+
+    def encode(self, texts: List[str]) -> np.ndarray:
+        return self.load().encode(texts)
+
+
+class OnnxEmbeddingBackend:
+    """Int8-quantized ONNX Runtime embeddings, exported by `export_onnx_model`.
+
+    Needs only onnxruntime and tokenizers at run time, not PyTorch.
+    """
+
+    # ONNX Runtime thread pools do not survive a fork; every worker opens its
+    # own session, which takes a fraction of a second
+    preload_before_fork = False
+
+    def __init__(self, model_name: str, model_dir: str, threads: int = 0, batch_size: int = 64):
+        self.model_name = model_name
+        # Quantized vectors differ slightly from the full-precision ones
+        self.cache_name = f"{model_name}-onnx-int8"
+        self.model_dir = model_dir
+        self.threads = threads
+        self.batch_size = batch_size
+        self._session = None
+        self.lock = threading.Lock()
+
+    def load(self):
+        with self.lock:
+            if self._session is None:
+                import onnxruntime as ort
+                from tokenizers import Tokenizer
+
+                start = time.time()
+                with metrics.timer("embeddings.model_load"):
+                    with open(os.path.join(self.model_dir, ONNX_SETTINGS_FILE)) as f:
+                        self.settings = json.load(f)
+                    self.tokenizer = Tokenizer.from_file(
+                        os.path.join(self.model_dir, "tokenizer.json")
+                    )
+                    self.tokenizer.enable_truncation(self.settings["max_seq_length"])
+                    self.tokenizer.enable_padding(pad_id=self.settings["pad_token_id"])
+
+                    options = ort.SessionOptions()
+                    options.intra_op_num_threads = self.threads
+                    options.inter_op_num_threads = 1
+                    self._session = ort.InferenceSession(
+                        os.path.join(self.model_dir, ONNX_MODEL_FILE),
+                        options,
+                        providers=["CPUExecutionProvider"],
+                    )
+                    self.input_names = [i.name for i in self._session.get_inputs()]
+                logger.info(
+                    "Loaded ONNX embedding model %s in %.2fs", self.model_dir, time.time() - start
+                )
+        return self._session
+
+    def set_threads(self, threads: int):
+        if self._session is not None and threads != self.threads:
+            raise RuntimeError("The ONNX session is already open; set threads before encoding.")
+        self.threads = threads
+
+    def encode(self, texts: List[str]) -> np.ndarray:
+        session = self.load()
+        embeddings = []
+        for i in range(0, len(texts), self.batch_size):
+            encodings = self.tokenizer.encode_batch(texts[i : i + self.batch_size])
+            inputs = {
+                "input_ids": np.array([e.ids for e in encodings], dtype=np.int64),
+                "attention_mask": np.array([e.attention_mask for e in encodings], dtype=np.int64),
+                "token_type_ids": np.array([e.type_ids for e in encodings], dtype=np.int64),
+            }
+            token_embeddings = session.run(
+                None, {name: inputs[name] for name in self.input_names}
+            )[0]
+            embeddings.append(self.__pool(token_embeddings, inputs["attention_mask"]))
+        if not embeddings:
+            return np.empty((0, self.settings["dimension"]), dtype=np.float32)
+        return np.vstack(embeddings)
+
+    def __pool(self, token_embeddings: np.ndarray, attention_mask: np.ndarray) -> np.ndarray:
+        if self.settings["pooling"] == "cls":
+            return token_embeddings[:, 0]
+        mask = attention_mask[:, :, None].astype(np.float32)
+        if self.settings["pooling"] == "max":
+            return np.where(mask > 0, token_embeddings, -1e9).max(axis=1)
+        return (token_embeddings * mask).sum(axis=1) / np.maximum(mask.sum(axis=1), 1e-9)
+
+
+def create_embedding_backend(backend: str, model_name: str, onnx_model_dir: str, threads: int = 0):
+    """Returns an unloaded backend; models load on the first `encode`."""
+    if backend == "sentence-transformers":
+        return SentenceTransformerBackend(model_name, threads)
+    if backend == "onnx":
+        return OnnxEmbeddingBackend(model_name, onnx_model_dir, threads)
+    raise ValueError(f"Unknown embedding backend {backend!r}")
+
+
+def export_onnx_model(model_name: str, output_dir: str, opset: int = 17):
+    """Exports a sentence-transformers model to an int8-quantized ONNX model.
+
+    Needs PyTorch and sentence-transformers, so it runs once at build time;
+    the output directory is all `OnnxEmbeddingBackend` needs.
+    """
+    import torch
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+    from sentence_transformers import SentenceTransformer
+
+    model = SentenceTransformer(model_name, device="cpu")
+    transformer = model[0]
+    pooling = next(
+        (module for module in model if hasattr(module, "get_pooling_mode_str")), None
+    )
+    os.makedirs(output_dir, exist_ok=True)
+    transformer.tokenizer.save_pretrained(output_dir)
+
+    dummy = transformer.tokenizer(["an example sentence"], return_tensors="pt")
+    input_names = [
+        name for name in ["input_ids", "attention_mask", "token_type_ids"] if name in dummy
+    ]
+
+    class TokenEmbeddings(torch.nn.Module):
+        def __init__(self, auto_model):
+            super().__init__()
+            self.auto_model = auto_model
+
+        def forward(self, *inputs):
+            return self.auto_model(**dict(zip(input_names, inputs))).last_hidden_state
+
+    full_precision_file = os.path.join(output_dir, "model.onnx")
+    with torch.no_grad():
+        torch.onnx.export(
+            TokenEmbeddings(transformer.auto_model.eval()),
+            tuple(dummy[name] for name in input_names),
+            full_precision_file,
+            input_names=input_names,
+            output_names=["token_embeddings"],
+            dynamic_axes={
+                **{name: {0: "batch", 1: "sequence"} for name in input_names},
+                "token_embeddings": {0: "batch", 1: "sequence"},
+            },
+            opset_version=opset,
+            dynamo=False,
+        )
+    quantize_dynamic(
+        full_precision_file, os.path.join(output_dir, ONNX_MODEL_FILE), weight_type=QuantType.QInt8
+    )
+    os.remove(full_precision_file)
+
+    with open(os.path.join(output_dir, ONNX_SETTINGS_FILE), "w") as f:
+        json.dump(
+            {
+                "model_name": model_name,
+                "pooling": pooling.get_pooling_mode_str() if pooling else "mean",
+                "max_seq_length": model.max_seq_length,
+                "pad_token_id": transformer.tokenizer.pad_token_id,
+                "dimension": model.encode(["an example sentence"]).shape[1],
+            },
+            f,
+            indent=2,
+        )
+    logger.info("Exported %s to %s", model_name, output_dir)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Export a sentence-transformers model for the ONNX embedding backend."
+    )
+    parser.add_argument("model_name", help="e.g. all-MiniLM-L6-v2")
+    parser.add_argument("output_dir", help="onnx_model_dir of the Wikidata config")
+    args = parser.parse_args()
+
+    configure_logging("INFO")
+    export_onnx_model(args.model_name, args.output_dir)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+import os
+import re
+import fcntl
+import numpy as np
+from typing import Callable, List
+from instrumentation import metrics
+
+# Precomputed vectors are only reused when the configured model reproduces
+# them, which also holds for a quantized copy of the same model
+PRECOMPUTED_MIN_SIMILARITY = 0.99
+
+
+class EmbeddingCache:
+    """Persistent text -> embedding store for a single embedding model.
+
+    Vectors are kept L2-normalized, so cosine similarity is a plain dot product.
+    """
+
+    def __init__(
+        self,
+        load_model: Callable[[], object],
+        model_name: str,
+        cache_dir: str = "/data/embeddings",
+    ):
+        # Both the model and the stored vectors are loaded on first use
+        self.load_model = load_model
+        self.model_name = model_name
+        # Safe to use in file names, for files derived from this model's vectors
+        self.model_key = re.sub(r"[^A-Za-z0-9_.-]", "_", model_name)
+        self.cache_file = os.path.join(cache_dir, f"{self.model_key}.npz")
+        self._vectors = None
+        self.dirty = False
+
+    @property
+    def vectors(self) -> dict:
+        if self._vectors is None:
+            self._vectors = self.load()
+        return self._vectors
+
+    def load(self) -> dict:
+        if not os.path.exists(self.cache_file):
+            return {}
+        with np.load(self.cache_file, allow_pickle=False) as data:
+            texts = data["texts"].tolist()
+            vectors = data["vectors"].astype(np.float32)
+        return dict(zip(texts, vectors))
+
+    def save(self):
+        """Writes new embeddings, merged with what other processes saved meanwhile."""
+        if not self.dirty or not self.vectors:
+            return
+        os.makedirs(os.path.dirname(self.cache_file), exist_ok=True)
+        with open(f"{self.cache_file}.lock", "w") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            vectors = {**self.load(), **self.vectors}
+            tmp_file = f"{self.cache_file.removesuffix('.npz')}.tmp.npz"
+            np.savez(
+                tmp_file,
+                texts=np.array(list(vectors.keys()), dtype=str),
+                vectors=np.stack(list(vectors.values())),
+            )
+            os.replace(tmp_file, self.cache_file)
+        self._vectors = vectors
+        self.dirty = False
+
+    def encode(self, texts: List[str]) -> np.ndarray:
+        """Returns a (len(texts), dim) matrix of normalized embeddings.
+
+        Only texts missing from the store are sent to the model, in one batch.
+        """
+        missing = list(dict.fromkeys(t for t in texts if t not in self.vectors))
+        metrics.increment("cache.embeddings.hits", len(texts) - len(missing))
+        metrics.increment("cache.embeddings.misses", len(missing))
+        if missing:
+            with metrics.timer("embeddings.encode"):
+                embeddings = np.asarray(self.load_model().encode(missing), dtype=np.float32)
+            embeddings /= np.maximum(
+                np.linalg.norm(embeddings, axis=1, keepdims=True), 1e-12
+            )
+            self.vectors.update(zip(missing, embeddings))
+            self.dirty = True
+
+        return np.stack([self.vectors[t] for t in texts])
+
+    def encode_with_precomputed(self, texts: List[str], precomputed_file: str) -> np.ndarray:
+        """Like `encode`, reusing a precomputed matrix for the leading texts.
+
+        Row i of `precomputed_file` embeds texts[i]. The rows are ignored when
+        the configured model does not reproduce them.
+        """
+        precomputed = np.load(precomputed_file).astype(np.float32)
+        if not texts or len(precomputed) > len(texts):
+            return self.encode(texts) if texts else precomputed[:0]
+        first = self.encode(texts[:1])[0]
+        if precomputed.shape[1:] != first.shape or precomputed[0] @ first < PRECOMPUTED_MIN_SIMILARITY:
+            return self.encode(texts)
+        if len(precomputed) == len(texts):
+            return precomputed
+        return np.vstack([precomputed, self.encode(texts[len(precomputed) :])])
@@ -0,0 +1,163 @@
+import re
+import array
+import unicodedata
+import numpy as np
+from typing import Callable, Dict, List, Optional, Set, Tuple
+
+# Keys shorter than this only match exactly; a typo in a short word is
+# usually another word
+MIN_FUZZY_LENGTH = 6
+
+# Tokens this short are left as they are: news, https, maps
+MIN_SINGULAR_LENGTH = 6
+
+# Words ending like plurals that are not
+_INVARIANT = {"series", "species"}
+
+# Stands for a normalized key that maps to more than one value
+_AMBIGUOUS = object()
+
+
+def normalize_concept(text: str) -> str:
+    """Folds case, accents, punctuation, hyphenation and English plurals.
+
+    "+" and "#" are kept, so C, C++ and C# stay apart, and acronyms (two or
+    more capitals, as in APIs or CSS) are not singularized.
+    """
+    text = unicodedata.normalize("NFKD", text)
+    text = "".join(c for c in text if not unicodedata.combining(c))
+    return " ".join(
+        token.casefold() if sum(c.isupper() for c in token) >= 2 else _singular(token.casefold())
+        for token in re.sub(r"[^\w+#]+|_+", " ", text).split()
+    )
+
+
+def _singular(token: str) -> str:
+    if len(token) < MIN_SINGULAR_LENGTH or not token.isalpha() or token in _INVARIANT:
+        return token
+    if token.endswith("ies"):
+        return token[:-3] + "y"
+    if token.endswith(("sses", "shes", "ches", "xes")):
+        return token[:-2]
+    if token.endswith("s") and not token.endswith(("ss", "us", "is", "ics")):
+        return token[:-1]
+    return token
+
+
+def is_misspelling(key: str, target: str, vocabulary: Set[str]) -> bool:
+    """Whether normalized `key` is `target` with typos in words outside `vocabulary`.
+
+    Both have the same words, except for unknown words of `key` within one
+    edit of the target's word, or two for words of 8 or more letters.
+    """
+    tokens, target_tokens = key.split(), target.split()
+    if len(tokens) != len(target_tokens) or tokens == target_tokens:
+        return False
+    return all(
+        token == target_token
+        or (
+            token not in vocabulary
+            and _edit_distance(token, target_token) <= (2 if len(target_token) >= 8 else 1)
+        )
+        for token, target_token in zip(tokens, target_tokens)
+    )
+
+
+def _edit_distance(a: str, b: str) -> int:
+    """Levenshtein distance, counting a swap of adjacent letters as one edit."""
+    previous2, previous = None, list(range(len(b) + 1))
+    for i in range(1, len(a) + 1):
+        current = [i] + [0] * len(b)
+        for j in range(1, len(b) + 1):
+            current[j] = min(
+                previous[j] + 1,
+                current[j - 1] + 1,
+                previous[j - 1] + (a[i - 1] != b[j - 1]),
+            )
+            if i > 1 and j > 1 and a[i - 1] == b[j - 2] and a[i - 2] == b[j - 1]:
+                current[j] = min(current[j], previous2[j - 2] + 1)
+        previous2, previous = previous, current
+    return previous[-1]
+
+
+def _trigrams(key: str) -> List[str]:
+    padded = f"  {key} "
+    return list(dict.fromkeys(padded[i : i + 3] for i in range(len(padded) - 2)))
+
+
+class FuzzyConceptIndex:
+    """Maps concept strings to values by normalized form or by trigram similarity.
+
+    A lookup first tries the normalized key, then the key with the highest
+    Dice similarity of character trigrams, if it reaches `threshold`. Keys
+    that map to different values are ambiguous and never returned.
+    """
+
+    def __init__(self, threshold: float, tokens: Set[str] = None):
+        self.threshold = threshold
+        self.keys: List[str] = []
+        self.values: Dict[str, object] = {}
+        self.postings: Dict[str, array.array] = {}
+        self.trigram_counts = array.array("i")
+        # Words of all keys, possibly shared with other indexes
+        self.tokens = set() if tokens is None else tokens
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+    def add(self, text: str, value, same=lambda a, b: a == b):
+        key = normalize_concept(text)
+        if not key:
+            return
+        if key in self.values:
+            if self.values[key] is not _AMBIGUOUS and not same(self.values[key], value):
+                self.values[key] = _AMBIGUOUS
+            return
+
+        self.values[key] = value
+        self.tokens.update(key.split())
+        trigrams = _trigrams(key)
+        for trigram in trigrams:
+            self.postings.setdefault(trigram, array.array("i")).append(len(self.keys))
+        self.keys.append(key)
+        self.trigram_counts.append(len(trigrams))
+
+    def get(self, text: str) -> Optional[object]:
+        """The value of the normalized form of `text`, if unambiguous."""
+        value = self.values.get(normalize_concept(text))
+        return None if value is _AMBIGUOUS else value
+
+    def search(
+        self, text: str, accept: Callable[[str, str], bool] = None
+    ) -> Tuple[Optional[object], float]:
+        """The unambiguous value of the most similar key and its similarity.
+
+        With `accept`, the most similar key above the threshold for which
+        accept(normalized text, key) holds.
+        """
+        key = normalize_concept(text)
+        if len(key) < MIN_FUZZY_LENGTH or not self.keys:
+            return None, 0.0
+        trigrams = _trigrams(key)
+        postings = [
+            np.frombuffer(self.postings[t], dtype=np.int32) for t in trigrams if t in self.postings
+        ]
+        if not postings:
+            return None, 0.0
+
+        # Dice similarity over the keys sharing any trigram
+        shared = np.bincount(np.concatenate(postings), minlength=len(self.keys))
+        ids = np.flatnonzero(shared)
+        counts = np.frombuffer(self.trigram_counts, dtype=np.int32)[ids]
+        similarities = 2 * shared[ids] / (len(trigrams) + counts)
+        best_similarity = float(similarities.max())
+        for i in np.argsort(-similarities, kind="stable"):
+            if similarities[i] < self.threshold:
+                break
+            candidate = self.keys[ids[i]]
+            value = self.values[candidate]
+            if value is not _AMBIGUOUS and (accept is None or accept(key, candidate)):
+                return value, float(similarities[i])
+            if accept is None:
+                break
+        return None, best_similarity
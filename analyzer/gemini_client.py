@@ -1,9 +1,25 @@
+import re
+import json
 import yaml
 import time
+import logging
+import threading
 from enum import Enum
 from dataclasses import dataclass
-from google import genai
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterator, List, Optional, Tuple
 import os
+from instrumentation import metrics
+from rate_limit import TokenBucket, backoff_delay
+from response_cache import ResponseCache
+
+logger = logging.getLogger(__name__)
+
+PACKED_PROMPT = "packed_concepts"
+# Where the single-course templates switch from instructions to the course itself
+EXAMPLE_MARKER = "## Your example to analyze:"
+# Rough size of a token, used to keep packed prompts within the token budget
+CHARS_PER_TOKEN = 4
 
 
 @dataclass
@@ -13,6 +29,17 @@ class GeminiConfig:
     max_nr_of_trials: int
     prompt_version: str
     prompts_file: str
+    concurrency: int
+    requests_per_minute: float
+    burst: int
+    backoff_base_seconds: float
+    backoff_max_seconds: float
+    response_cache_file: str
+    response_cache_max_entries: int
+    packing: bool
+    pack_task_types: bool
+    pack_token_budget: int
+    pack_max_courses: int
 
 
 class ExtractionTaskType(Enum):
@@ -21,13 +48,35 @@ class ExtractionTaskType(Enum):
 
 
 class GeminiClient:
-    def __init__(self):
-        self.config_file_path = "/config/gemini_config.yaml"
-        self.config = self.__load_config()
-        with open("/config/gemini_key.txt", "r") as f:
-            self.client = genai.Client(api_key=f.readline())
-        self.prompts_dir = "prompts"
-        self.total_time = 0
+    def __init__(
+        self,
+        config_file_path: str = "/config/gemini_config.yaml",
+        client=None,
+        rate_limiter: TokenBucket = None,
+    ):
+        self.config_file_path = config_file_path
+        self.config = self.load_config(config_file_path)
+        # The API client is only built once a request actually misses the cache
+        self._client = client
+        self.prompts_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "prompts")
+        self.rate_limiter = rate_limiter or TokenBucket(
+            self.config.requests_per_minute, self.config.burst
+        )
+        self.lock = threading.Lock()
+        self.response_cache = ResponseCache(
+            self.config.response_cache_file, self.config.response_cache_max_entries
+        )
+        self.prompt_templates = {}
+
+    @property
+    def client(self):
+        with self.lock:
+            if self._client is None:
+                from google import genai
+
+                with open("/config/gemini_key.txt", "r") as f:
+                    self._client = genai.Client(api_key=f.readline())
+            return self._client
 
     def extract_covered_concepts(self, course_name: str, description: str):
         return self.__generate_content(
@@ -39,36 +88,286 @@ class GeminiClient:
             course_name, description, ExtractionTaskType.PREREQUISITE_CONCEPTS
         )
 
+    def extract_covered_concepts_batch(
+        self, courses: List[Tuple[str, str]]
+    ) -> Iterator[List[str]]:
+        return self.__generate_contents(courses, ExtractionTaskType.COVERED_CONCEPTS)
+
+    def extract_prerequisite_concepts_batch(
+        self, courses: List[Tuple[str, str]]
+    ) -> Iterator[List[str]]:
+        return self.__generate_contents(
+            courses, ExtractionTaskType.PREREQUISITE_CONCEPTS
+        )
+
+    def prefetch(self, tasks: List[Tuple[str, str, ExtractionTaskType]]):
+        """Extracts (course_name, description, task_type) tasks ahead of time.
+
+        With `pack_task_types`, both tasks of a course share packed requests.
+        The results land in the response cache, where the per-task batch
+        calls find them.
+        """
+        if self.config.packing and self.config.pack_task_types:
+            for _ in self.__generate_packed(tasks):
+                pass
+
+    def __generate_contents(
+        self, courses: List[Tuple[str, str]], task_type: ExtractionTaskType
+    ) -> Iterator[List[str]]:
+        """Runs extraction for (course_name, description) pairs concurrently.
+
+        Results are yielded lazily, in the same order as `courses`.
+        """
+        if self.config.packing:
+            yield from self.__generate_packed(
+                [(course_name, description, task_type) for course_name, description in courses]
+            )
+            return
+
+        with ThreadPoolExecutor(max_workers=self.config.concurrency) as executor:
+            yield from executor.map(
+                lambda course: self.__generate_content(*course, task_type), courses
+            )
+
+    @metrics.timed("gemini.generate_content")
     def __generate_content(
         self, course_name: str, description: str, task_type: ExtractionTaskType
     ) -> str:
+        prompt = self.__create_prompt(course_name, description, task_type)
+        cache_key = self.__cache_key(prompt)
+        cached_response = self.response_cache.get(cache_key)
+        if cached_response is not None:
+            return self.__normalize_concepts(cached_response)
+
+        response = self.__request(
+            prompt, {"temperature": self.config.temperature}, course_name, task_type.value
+        )
+        if response is None:
+            return None
+        if isinstance(response.text, str):
+            self.response_cache.put(cache_key, response.text)
+        return self.__normalize_concepts(response.text)
+
+    def __generate_packed(
+        self, tasks: List[Tuple[str, str, ExtractionTaskType]]
+    ) -> Iterator[Optional[List[str]]]:
+        """Runs extraction tasks packed several courses to a request.
+
+        Each answer is stored in the response cache under its single-course
+        prompt, in the `;`-separated format. Tasks missing from a packed
+        response fall back to single-course calls. Results are yielded in the
+        same order as `tasks`.
+        """
+        cache_keys = [
+            self.__cache_key(self.__create_prompt(*task)) for task in tasks
+        ]
+        results = [None] * len(tasks)
+        pending = []
+        for i, cache_key in enumerate(cache_keys):
+            cached_response = self.response_cache.get(cache_key)
+            if cached_response is not None:
+                results[i] = self.__normalize_concepts(cached_response)
+            else:
+                pending.append(i)
+
+        def run_pack(pack: List[int]) -> List[Tuple[int, Optional[List[str]]]]:
+            answers = self.__request_pack([tasks[i] for i in pack])
+            pack_results = []
+            for i, answer in zip(pack, answers):
+                if answer is None:
+                    metrics.increment("gemini.packed_fallbacks")
+                    pack_results.append((i, self.__generate_content(*tasks[i])))
+                    continue
+                response = "; ".join(answer)
+                self.response_cache.put(cache_keys[i], response)
+                pack_results.append((i, self.__normalize_concepts(response)))
+            return pack_results
+
+        waiting = set(pending)
+        next_result = 0
+        with ThreadPoolExecutor(max_workers=self.config.concurrency) as executor:
+            for pack_results in executor.map(run_pack, self.__pack(tasks, pending)):
+                for i, result in pack_results:
+                    results[i] = result
+                    waiting.discard(i)
+                # Yield every result whose predecessors are all known
+                while next_result < len(tasks) and next_result not in waiting:
+                    yield results[next_result]
+                    next_result += 1
+        yield from results[next_result:]
+
+    def __pack(
+        self, tasks: List[Tuple[str, str, ExtractionTaskType]], pending: List[int]
+    ) -> List[List[int]]:
+        """Groups task indices into packs within the token budget.
+
+        Tasks of the same course always share a pack.
+        """
+        by_course = {}
+        for i in pending:
+            by_course.setdefault(tasks[i][0], []).append(i)
+
+        packs, pack, pack_tokens = [], [], 0
+        for course_name, indices in by_course.items():
+            tokens = sum(
+                len(course_name) + len(tasks[i][1]) for i in indices
+            ) // CHARS_PER_TOKEN
+            courses_in_pack = len({tasks[i][0] for i in pack})
+            if pack and (
+                pack_tokens + tokens > self.config.pack_token_budget
+                or courses_in_pack >= self.config.pack_max_courses
+            ):
+                packs.append(pack)
+                pack, pack_tokens = [], 0
+            pack += indices
+            pack_tokens += tokens
+        if pack:
+            packs.append(pack)
+        return packs
+
+    def __request_pack(
+        self, tasks: List[Tuple[str, str, ExtractionTaskType]]
+    ) -> List[Optional[List[str]]]:
+        """Sends one packed request; returns each task's concepts, or None where
+        the response could not be used."""
+        course_ids = {}
+        for course_name, _, _ in tasks:
+            course_ids.setdefault(course_name, len(course_ids) + 1)
+        task_types = list(dict.fromkeys(task_type for *_, task_type in tasks))
+
+        courses = {}
+        for course_name, description, task_type in tasks:
+            courses.setdefault(course_name, [f"### Course {course_ids[course_name]}: {course_name}"])
+            courses[course_name].append(
+                f'Input of task "{task_type.value}":\n"""\n{description}\n"""'
+            )
+        prompt = (
+            self.__read_prompt_template(PACKED_PROMPT)
+            .replace(
+                "<tasks>",
+                "\n\n".join(
+                    f'# Task "{task_type.value}"\n'
+                    + self.__read_prompt_template(task_type.value).split(EXAMPLE_MARKER)[0].strip()
+                    for task_type in task_types
+                ),
+            )
+            .replace("<courses>", "\n\n".join("\n".join(c) for c in courses.values()))
+        )
+
+        metrics.increment("gemini.packed_requests")
+        metrics.observe("gemini.pack_size", len(course_ids))
+        response = self.__request(
+            prompt,
+            {
+                "temperature": self.config.temperature,
+                "response_mime_type": "application/json",
+                "response_schema": self.__packed_schema(task_types),
+            },
+            f"{len(course_ids)} packed courses",
+            "packed",
+        )
+        answers = self.__parse_packed_response(response.text if response else None)
+        return [
+            answers.get((course_ids[course_name], task_type.value))
+            for course_name, _, task_type in tasks
+        ]
+
+    @staticmethod
+    def __packed_schema(task_types: List[ExtractionTaskType]) -> dict:
+        return {
+            "type": "ARRAY",
+            "items": {
+                "type": "OBJECT",
+                "properties": {
+                    "id": {"type": "INTEGER"},
+                    **{
+                        task_type.value: {"type": "ARRAY", "items": {"type": "STRING"}}
+                        for task_type in task_types
+                    },
+                },
+                "required": ["id"],
+            },
+        }
+
+    @staticmethod
+    def __parse_packed_response(text: Optional[str]) -> Dict[Tuple[int, str], List[str]]:
+        """Maps (course id, task) to concepts; malformed entries are left out."""
+        if not isinstance(text, str):
+            return {}
+        text = re.sub(r"^```(?:json)?\s*|\s*```$", "", text.strip())
+        try:
+            data = json.loads(text)
+        except json.JSONDecodeError:
+            logger.warning("Could not parse packed Gemini response, falling back.")
+            return {}
+
+        answers = {}
+        for entry in data if isinstance(data, list) else []:
+            if not isinstance(entry, dict) or not str(entry.get("id", "")).isdigit():
+                continue
+            for task, concepts in entry.items():
+                if isinstance(concepts, list) and all(isinstance(c, str) for c in concepts):
+                    answers[(int(entry["id"]), task)] = concepts
+        return answers
+
+    def __request(self, prompt: str, generation_config: dict, course_name: str, task: str):
+        """Sends one rate-limited request, retrying with backoff.
+
+        Returns the response, or None once all trials failed.
+        """
         nr_of_trials = 0
         while nr_of_trials < self.config.max_nr_of_trials:
             try:
-                start = time.time()
-                response = self.client.models.generate_content(
-                    model=self.config.model,
-                    contents=self.__create_prompt(course_name, description, task_type),
-                    config={"temperature": self.config.temperature},
-                )
-                self.total_time += time.time()-start
-                return self.__normalize_concepts(response.text)
+                with metrics.timer("gemini.rate_limit_wait"):
+                    self.rate_limiter.acquire()
+                metrics.increment("gemini.requests")
+                with metrics.timer("gemini.api_call"):
+                    return self.client.models.generate_content(
+                        model=self.config.model,
+                        contents=prompt,
+                        config=generation_config,
+                    )
             except Exception as e:
                 nr_of_trials += 1
-                print(e)
-                time.sleep(30)
+                metrics.increment("gemini.errors")
+                logger.warning(
+                    "Gemini request for %s failed (trial %d/%d): %s",
+                    course_name,
+                    nr_of_trials,
+                    self.config.max_nr_of_trials,
+                    e,
+                    extra={"course_name": course_name, "task": task},
+                )
+                if nr_of_trials < self.config.max_nr_of_trials:
+                    time.sleep(
+                        backoff_delay(
+                            nr_of_trials,
+                            self.config.backoff_base_seconds,
+                            self.config.backoff_max_seconds,
+                        )
+                    )
+        return None
+
+    def __cache_key(self, prompt: str) -> str:
+        return ResponseCache.key(
+            prompt,
+            self.config.model,
+            self.config.temperature,
+            self.config.prompt_version,
+        )
 
     def __create_prompt(
         self, course_name: str, description: str, task_type: ExtractionTaskType
     ):
-        prompt_template = self.__read_prompt_template(task_type)
+        prompt_template = self.__read_prompt_template(task_type.value)
         return prompt_template.replace("<course_name>", course_name).replace(
             "<description>", description
         )
 
-    def __read_prompt_template(self, task_type: ExtractionTaskType) -> str:
+    def __read_prompt_template(self, task_key: str) -> str:
         version = self.config.prompt_version
-        task_key = task_type.value
+        if (version, task_key) in self.prompt_templates:
+            return self.prompt_templates[(version, task_key)]
 
         prompt_path = os.path.join(self.prompts_dir, version, f"{task_key}.txt")
 
@@ -76,11 +375,13 @@ class GeminiClient:
             raise FileNotFoundError(f"Prompt template not found: {prompt_path}")
 
         with open(prompt_path, "r", encoding="utf-8") as f:
-            return f.read()
+            self.prompt_templates[(version, task_key)] = f.read()
+        return self.prompt_templates[(version, task_key)]
 
 
-    def __load_config(self) -> GeminiConfig:
-        with open(self.config_file_path, "r") as f:
+    @staticmethod
+    def load_config(config_file_path: str) -> GeminiConfig:
+        with open(config_file_path, "r") as f:
             data = yaml.safe_load(f)
         return GeminiConfig(**data)
     
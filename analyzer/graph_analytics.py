@@ -0,0 +1,295 @@
+import os
+import time
+import argparse
+import numpy as np
+import pandas as pd
+from typing import Optional
+
+PAGERANK_DAMPING = 0.85
+PAGERANK_TOLERANCE = 1e-10
+PAGERANK_MAX_ITERATIONS = 100
+
+
+class CsrMatrix:
+    """Compressed sparse row matrix, just enough for adjacency queries.
+
+    Row `i` holds the column ids `indices[indptr[i]:indptr[i + 1]]`, sorted,
+    with the matching `data` weights.
+    """
+
+    def __init__(self, indptr: np.ndarray, indices: np.ndarray, data: np.ndarray, shape: tuple):
+        self.indptr = indptr
+        self.indices = indices
+        self.data = data
+        self.shape = shape
+
+    @staticmethod
+    def from_edges(
+        rows: np.ndarray, cols: np.ndarray, shape: tuple, weights: np.ndarray = None
+    ) -> "CsrMatrix":
+        """Builds the matrix from (row, col) edges; duplicate edges add up."""
+        weights = np.ones(len(rows)) if weights is None else np.asarray(weights, dtype=float)
+        keys = np.asarray(rows, dtype=np.int64) * shape[1] + np.asarray(cols, dtype=np.int64)
+        keys, inverse = np.unique(keys, return_inverse=True)
+        data = np.bincount(inverse, weights=weights, minlength=len(keys))
+        rows, indices = np.divmod(keys, shape[1])
+        indptr = np.zeros(shape[0] + 1, dtype=np.int64)
+        np.cumsum(np.bincount(rows, minlength=shape[0]), out=indptr[1:])
+        return CsrMatrix(indptr, indices, data, shape)
+
+    def transpose(self) -> "CsrMatrix":
+        rows = np.repeat(np.arange(self.shape[0]), np.diff(self.indptr))
+        return CsrMatrix.from_edges(
+            self.indices, rows, (self.shape[1], self.shape[0]), self.data
+        )
+
+    def row_degrees(self) -> np.ndarray:
+        return np.diff(self.indptr)
+
+    def row_sums(self) -> np.ndarray:
+        return np.add.reduceat(
+            np.append(self.data, 0.0), np.minimum(self.indptr[:-1], len(self.data))
+        ) * (self.row_degrees() > 0)
+
+    def matvec(self, x: np.ndarray) -> np.ndarray:
+        products = np.append(self.data * x[self.indices], 0.0)
+        return np.add.reduceat(
+            products, np.minimum(self.indptr[:-1], len(self.data))
+        ) * (self.row_degrees() > 0)
+
+    def row_min(self, values: np.ndarray, empty: float = np.inf) -> np.ndarray:
+        """Minimum of `values[col]` over the columns of each row."""
+        reduced = np.minimum.reduceat(
+            np.append(values[self.indices], empty),
+            np.minimum(self.indptr[:-1], len(self.indices)),
+        )
+        return np.where(self.row_degrees() > 0, reduced, empty)
+
+    def row(self, i: int) -> np.ndarray:
+        return self.indices[self.indptr[i] : self.indptr[i + 1]]
+
+
+class CurriculumGraph:
+    """In-memory view of one curriculum's knowledge graph.
+
+    Built from the `*_matched.csv` outputs and the curriculum CSV, with the
+    same COVERS / HAS_PREREQUISITE relationships, terms and ECTS as the
+    Memgraph graph, held as CSR adjacency matrices over integer ids.
+    """
+
+    def __init__(
+        self,
+        covered_concepts_file: str,
+        prerequisites_concepts_file: str,
+        curriculum_file: str,
+    ):
+        curriculum = pd.read_csv(curriculum_file, usecols=["course_name", "semester", "ects"])
+        covered = self.__read_matches(covered_concepts_file)
+        prerequisites = self.__read_matches(prerequisites_concepts_file)
+
+        courses = pd.Index(
+            pd.concat(
+                [curriculum["course_name"], covered["course_name"], prerequisites["course_name"]]
+            ).unique()
+        )
+        concepts = pd.concat([covered, prerequisites]).drop_duplicates("wikidata_qid")
+        self.courses = pd.DataFrame({"course_name": courses})
+        details = curriculum.drop_duplicates("course_name").set_index("course_name")
+        self.courses["term"] = courses.map(details["semester"]).astype(float)
+        self.courses["ects"] = courses.map(details["ects"]).astype(float)
+        self.concepts = concepts[["wikidata_qid", "wikidata_label"]].reset_index(drop=True)
+        concept_ids = pd.Index(self.concepts["wikidata_qid"])
+
+        shape = (len(self.courses), len(self.concepts))
+        # course -> concept
+        self.covers = CsrMatrix.from_edges(
+            courses.get_indexer(covered["course_name"]),
+            concept_ids.get_indexer(covered["wikidata_qid"]),
+            shape,
+        )
+        self.requires = CsrMatrix.from_edges(
+            courses.get_indexer(prerequisites["course_name"]),
+            concept_ids.get_indexer(prerequisites["wikidata_qid"]),
+            shape,
+        )
+        # concept -> course
+        self.covered_by = self.covers.transpose()
+        self.required_by = self.requires.transpose()
+
+    @staticmethod
+    def from_curriculum(curriculum_file: str) -> "CurriculumGraph":
+        """Loads the graph from the outputs the pipeline wrote next to `curriculum_file`.
+
+        Parquet outputs of a streaming run are used when there are no CSV outputs.
+        Raises FileNotFoundError when the pipeline has not matched the curriculum yet.
+        """
+        prefix = curriculum_file.removesuffix(".csv")
+        matched_files = []
+        for stage in ["covered", "prerequisites"]:
+            matched_file = f"{prefix}_{stage}_concepts_matched.csv"
+            if not os.path.exists(matched_file):
+                matched_file = matched_file.removesuffix(".csv") + ".parquet"
+            matched_files.append(matched_file)
+        if not os.path.exists(matched_files[0]):
+            raise FileNotFoundError(
+                f"No matched concepts for {curriculum_file}: expected "
+                f"{prefix}_covered_concepts_matched.csv or .parquet, run the pipeline first"
+            )
+        return CurriculumGraph(*matched_files, curriculum_file)
+
+    def concept_ordering(self) -> pd.DataFrame:
+        """When each concept is taught: first and last term and the ECTS covering it."""
+        terms = self.courses["term"].to_numpy()
+        first_term = self.covered_by.row_min(terms)
+        last_term = -self.covered_by.row_min(-terms)
+        df = self.concepts.assign(
+            first_term=np.where(np.isinf(first_term), np.nan, first_term),
+            last_term=np.where(np.isinf(last_term), np.nan, last_term),
+            covering_courses=self.covered_by.row_degrees(),
+            covering_ects=self.covered_by.matvec(np.nan_to_num(self.courses["ects"].to_numpy())),
+            requiring_courses=self.required_by.row_degrees(),
+        )
+        return df.sort_values(
+            ["first_term", "covering_courses"], ascending=[True, False], na_position="last"
+        ).reset_index(drop=True)
+
+    def coverage_gaps(self) -> pd.DataFrame:
+        """Prerequisite concepts that no course of the program covers."""
+        gaps = np.flatnonzero(
+            (self.required_by.row_degrees() > 0) & (self.covered_by.row_degrees() == 0)
+        )
+        course_names = self.courses["course_name"].to_numpy()
+        return pd.DataFrame(
+            {
+                "wikidata_qid": self.concepts["wikidata_qid"].to_numpy()[gaps],
+                "wikidata_label": self.concepts["wikidata_label"].to_numpy()[gaps],
+                "requiring_courses": self.required_by.row_degrees()[gaps],
+                "required_by": [list(course_names[self.required_by.row(i)]) for i in gaps],
+            }
+        ).sort_values("requiring_courses", ascending=False, ignore_index=True)
+
+    def prerequisite_violations(self) -> pd.DataFrame:
+        """Prerequisites of a course that are not covered in an earlier term.
+
+        `status` is "not covered" when no course covers the concept, and
+        "covered later" when it is first covered in the same or a later term.
+        """
+        terms = self.courses["term"].to_numpy()
+        first_term = self.covered_by.row_min(terms)
+
+        course_ids = np.repeat(np.arange(self.requires.shape[0]), self.requires.row_degrees())
+        concept_ids = self.requires.indices
+        violated = ~(first_term[concept_ids] < terms[course_ids])
+        course_ids, concept_ids = course_ids[violated], concept_ids[violated]
+
+        first_covered = first_term[concept_ids]
+        return pd.DataFrame(
+            {
+                "course_name": self.courses["course_name"].to_numpy()[course_ids],
+                "term": terms[course_ids],
+                "wikidata_qid": self.concepts["wikidata_qid"].to_numpy()[concept_ids],
+                "wikidata_label": self.concepts["wikidata_label"].to_numpy()[concept_ids],
+                "first_covered_term": np.where(np.isinf(first_covered), np.nan, first_covered),
+                "status": np.where(np.isinf(first_covered), "not covered", "covered later"),
+            }
+        ).sort_values(["term", "course_name"], ignore_index=True)
+
+    def concept_centrality(self) -> pd.DataFrame:
+        """Ranks concepts by PageRank over the concept dependency graph.
+
+        Concept A points to concept B when a course requires A and covers B,
+        weighted by the number of such courses.
+        """
+        n = self.covers.shape[1]
+        if n == 0:
+            return self.concepts.assign(
+                pagerank=[],
+                covering_courses=[],
+                requiring_courses=[],
+                enables=[],
+                depends_on=[],
+            )
+        course_ids = np.repeat(np.arange(self.requires.shape[0]), self.requires.row_degrees())
+        edges = pd.DataFrame({"course": course_ids, "source": self.requires.indices}).merge(
+            pd.DataFrame(
+                {
+                    "course": np.repeat(np.arange(self.covers.shape[0]), self.covers.row_degrees()),
+                    "target": self.covers.indices,
+                }
+            ),
+            on="course",
+        )
+        edges = edges[edges["source"] != edges["target"]]
+        # target <- source, so that one matvec pulls rank along incoming edges
+        incoming = CsrMatrix.from_edges(
+            edges["target"].to_numpy(), edges["source"].to_numpy(), (n, n)
+        )
+        out_weights = incoming.transpose().row_sums()
+
+        rank = np.full(n, 1 / max(n, 1))
+        dangling = out_weights == 0
+        for _ in range(PAGERANK_MAX_ITERATIONS):
+            spread = incoming.matvec(np.where(dangling, 0.0, rank / np.maximum(out_weights, 1e-12)))
+            new_rank = (1 - PAGERANK_DAMPING) / n + PAGERANK_DAMPING * (
+                spread + rank[dangling].sum() / n
+            )
+            converged = np.abs(new_rank - rank).sum() < PAGERANK_TOLERANCE
+            rank = new_rank
+            if converged:
+                break
+
+        return self.concepts.assign(
+            pagerank=rank,
+            covering_courses=self.covered_by.row_degrees(),
+            requiring_courses=self.required_by.row_degrees(),
+            enables=incoming.transpose().row_degrees(),
+            depends_on=incoming.row_degrees(),
+        ).sort_values("pagerank", ascending=False, ignore_index=True)
+
+    @staticmethod
+    def __read_matches(matched_file: Optional[str]) -> pd.DataFrame:
+        columns = ["course_name", "wikidata_qid", "wikidata_label"]
+        if not matched_file or not os.path.exists(matched_file):
+            return pd.DataFrame(columns=columns)
+        if matched_file.endswith(".parquet"):
+            df = pd.read_parquet(matched_file, columns=columns)
+        else:
+            df = pd.read_csv(matched_file, usecols=columns)
+        # Unmatched concepts have no node in the graph
+        return df.dropna(subset=["wikidata_qid"])
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Report coverage gaps, prerequisite ordering and central concepts of a curriculum."
+    )
+    parser.add_argument("curriculum", help="curriculum CSV next to its *_matched.csv outputs")
+    parser.add_argument("-o", "--output-dir", help="write each report as CSV into this directory")
+    args = parser.parse_args()
+
+    start = time.time()
+    try:
+        graph = CurriculumGraph.from_curriculum(args.curriculum)
+    except FileNotFoundError as e:
+        raise SystemExit(str(e))
+    reports = {
+        "concept_ordering": graph.concept_ordering(),
+        "coverage_gaps": graph.coverage_gaps(),
+        "prerequisite_violations": graph.prerequisite_violations(),
+        "concept_centrality": graph.concept_centrality(),
+    }
+    print(
+        f"Analyzed {len(graph.courses)} courses and {len(graph.concepts)} concepts "
+        f"in {(time.time() - start) * 1000:.1f}ms"
+    )
+
+    for name, report in reports.items():
+        if args.output_dir:
+            os.makedirs(args.output_dir, exist_ok=True)
+            report.to_csv(os.path.join(args.output_dir, f"{name}.csv"), index=False)
+        print(f"\n{name} ({len(report)} rows)")
+        print(report.head(10).to_string(index=False))
+
+
+if __name__ == "__main__":
+    main()
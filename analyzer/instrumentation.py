@@ -0,0 +1,235 @@
+import os
+import re
+import json
+import time
+import logging
+import functools
+import threading
+from bisect import bisect_left
+from contextlib import contextmanager
+from typing import Optional, Sequence
+
+# Upper bounds, in seconds, of the latency buckets
+TIMER_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+COUNT_BUCKETS = (1, 10, 100, 1000, 10000, 100000)
+PROMETHEUS_PREFIX = "curriculum_lens"
+
+# Attributes every LogRecord has; anything else was passed through `extra`
+LOG_RECORD_ATTRIBUTES = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {
+    "message",
+    "asctime",
+}
+
+
+class Metrics:
+    """Thread-safe registry of counters and histograms for one process.
+
+    Timers are histograms of durations in seconds, named `<name>_seconds`.
+    Counter pairs named `<name>.hits` / `<name>.misses` are reported with
+    their hit rate.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+        self.profiler = None
+        self.profile_dir = None
+
+    def increment(self, name: str, value: float = 1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def observe(self, name: str, value: float, buckets: Sequence[float] = COUNT_BUCKETS):
+        with self.lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = {
+                    "buckets": list(buckets),
+                    "counts": [0] * (len(buckets) + 1),
+                    "count": 0,
+                    "sum": 0.0,
+                    "max": 0.0,
+                }
+            histogram["counts"][bisect_left(histogram["buckets"], value)] += 1
+            histogram["count"] += 1
+            histogram["sum"] += value
+            histogram["max"] = max(histogram["max"], value)
+
+    @contextmanager
+    def timer(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(f"{name}_seconds", time.perf_counter() - start, TIMER_BUCKETS)
+
+    def timed(self, name: str):
+        """Decorator timing every call of the wrapped function under `name`."""
+
+        def decorator(function):
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                with self.timer(name):
+                    return function(*args, **kwargs)
+
+            return wrapper
+
+        return decorator
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            return json.loads(
+                json.dumps({"counters": self.counters, "histograms": self.histograms})
+            )
+
+    def merge(self, snapshot: dict):
+        """Adds the measurements of another process, e.g. a forked worker."""
+        with self.lock:
+            for name, value in snapshot["counters"].items():
+                self.counters[name] = self.counters.get(name, 0) + value
+            for name, other in snapshot["histograms"].items():
+                histogram = self.histograms.setdefault(
+                    name, {**other, "counts": [0] * len(other["counts"]), "count": 0, "sum": 0.0}
+                )
+                histogram["counts"] = [a + b for a, b in zip(histogram["counts"], other["counts"])]
+                histogram["count"] += other["count"]
+                histogram["sum"] += other["sum"]
+                histogram["max"] = max(histogram["max"], other["max"])
+
+    def reset(self):
+        with self.lock:
+            self.counters = {}
+            self.histograms = {}
+
+    def report(self) -> dict:
+        snapshot = self.snapshot()
+        counters = snapshot["counters"]
+        hit_rates = {}
+        for name in counters:
+            if name.endswith(".hits"):
+                prefix = name.removesuffix(".hits")
+                total = counters[name] + counters.get(f"{prefix}.misses", 0)
+                hit_rates[prefix] = counters[name] / total if total else 0.0
+
+        histograms = {}
+        for name, histogram in snapshot["histograms"].items():
+            cumulative = 0
+            buckets = {}
+            for bound, count in zip(histogram["buckets"] + ["+Inf"], histogram["counts"]):
+                cumulative += count
+                buckets[str(bound)] = cumulative
+            histograms[name] = {
+                "count": histogram["count"],
+                "sum": histogram["sum"],
+                "mean": histogram["sum"] / histogram["count"] if histogram["count"] else 0.0,
+                "max": histogram["max"],
+                "buckets": buckets,
+            }
+        return {"counters": counters, "hit_rates": hit_rates, "histograms": histograms}
+
+    def to_prometheus(self) -> str:
+        """Renders the metrics in the Prometheus text exposition format."""
+        report = self.report()
+        lines = []
+        for name, value in report["counters"].items():
+            metric = self.__prometheus_name(name) + "_total"
+            lines += [f"# TYPE {metric} counter", f"{metric} {value}"]
+        for name, value in report["hit_rates"].items():
+            metric = self.__prometheus_name(name) + "_hit_ratio"
+            lines += [f"# TYPE {metric} gauge", f"{metric} {value}"]
+        for name, histogram in report["histograms"].items():
+            metric = self.__prometheus_name(name)
+            lines.append(f"# TYPE {metric} histogram")
+            lines += [
+                f'{metric}_bucket{{le="{bound}"}} {count}'
+                for bound, count in histogram["buckets"].items()
+            ]
+            lines += [f"{metric}_sum {histogram['sum']}", f"{metric}_count {histogram['count']}"]
+        return "\n".join(lines) + "\n"
+
+    def write(self, output_file: str, output_format: str = "json"):
+        os.makedirs(os.path.dirname(output_file) or ".", exist_ok=True)
+        with open(output_file, "w", encoding="utf-8") as f:
+            if output_format == "prometheus":
+                f.write(self.to_prometheus())
+            else:
+                json.dump(self.report(), f, indent=2)
+
+    def configure_profiling(self, profiler: Optional[str], profile_dir: str):
+        if profiler not in (None, "cprofile", "pyinstrument"):
+            raise ValueError(f"Unknown profiler: {profiler}")
+        self.profiler = profiler
+        self.profile_dir = profile_dir
+
+    @contextmanager
+    def profile(self, name: str):
+        """Profiles the calling thread while the block runs, if profiling is enabled.
+
+        cProfile writes `<name>.prof` (pstats); pyinstrument writes `<name>.html`.
+        """
+        if self.profiler is None:
+            yield
+            return
+
+        os.makedirs(self.profile_dir, exist_ok=True)
+        output_file = os.path.join(self.profile_dir, re.sub(r"[^A-Za-z0-9_.-]", "_", name))
+        if self.profiler == "cprofile":
+            import cProfile
+
+            profiler = cProfile.Profile()
+            profiler.enable()
+            try:
+                yield
+            finally:
+                profiler.disable()
+                profiler.dump_stats(f"{output_file}.prof")
+        else:
+            from pyinstrument import Profiler
+
+            profiler = Profiler()
+            profiler.start()
+            try:
+                yield
+            finally:
+                profiler.stop()
+                with open(f"{output_file}.html", "w", encoding="utf-8") as f:
+                    f.write(profiler.output_html())
+
+    @staticmethod
+    def __prometheus_name(name: str) -> str:
+        return f"{PROMETHEUS_PREFIX}_" + re.sub(r"[^A-Za-z0-9_]", "_", name)
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line, including the fields passed through `extra`."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        entry.update(
+            (key, value)
+            for key, value in vars(record).items()
+            if key not in LOG_RECORD_ATTRIBUTES
+        )
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str, ensure_ascii=False)
+
+
+def configure_logging(level: str = "INFO", json_format: bool = False):
+    handler = logging.StreamHandler()
+    handler.setFormatter(
+        JsonFormatter()
+        if json_format
+        else logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s")
+    )
+    logging.basicConfig(level=level.upper(), handlers=[handler], force=True)
+
+
+# Shared by every module of this process
+metrics = Metrics()
@@ -1,63 +1,317 @@
-from neo4j import GraphDatabase
+import os
+import time
+import yaml
+import logging
+import pandas as pd
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Set, Tuple
+from instrumentation import COUNT_BUCKETS, metrics
 
 URI = "bolt://memgraph:7687"
 AUTH = ("testuser123", "t123")
 
+logger = logging.getLogger(__name__)
+
+INDEX_QUERIES = [
+    "CREATE INDEX ON :Course;",
+    "CREATE INDEX ON :Course(name);",
+    "CREATE INDEX ON :Course(curriculum);",
+    "CREATE INDEX ON :Concept;",
+    "CREATE INDEX ON :Concept(wikidata_qid);",
+]
+
+CONCEPTS_QUERY = """UNWIND $batch AS row
+    MERGE (c:Course {{name: row.course_name, curriculum: $curriculum}})
+    SET c:{curriculum_label}
+
+    MERGE (concept:Concept {{wikidata_qid: row.wikidata_qid}})
+    ON CREATE SET
+        concept.name = row.wikidata_label,
+        concept.description = row.wikidata_description,
+        concept.wikidata_url = row.wikidata_url
+
+    MERGE (c)-[:{relationship}]->(concept);"""
+
+COURSE_DETAILS_QUERY = """UNWIND $batch AS row
+    MATCH (c:Course {name: row.course_name, curriculum: $curriculum})
+    SET c.term = toInteger(row.semester),
+        c.ects = toInteger(row.ects);"""
+
+CURRENT_STATE_QUERY = """MATCH (c:Course {curriculum: $curriculum})
+    OPTIONAL MATCH (c)-[r:COVERS|HAS_PREREQUISITE]->(concept:Concept)
+    RETURN c.name AS course_name, c.term AS term, c.ects AS ects,
+        type(r) AS relationship, concept.wikidata_qid AS wikidata_qid;"""
+
+REMOVE_EDGES_QUERY = """UNWIND $batch AS row
+    MATCH (:Course {{name: row.course_name, curriculum: $curriculum}})
+        -[r:{relationship}]->(:Concept {{wikidata_qid: row.wikidata_qid}})
+    DELETE r;"""
+
+REMOVE_COURSES_QUERY = """UNWIND $batch AS course_name
+    MATCH (c:Course {name: course_name, curriculum: $curriculum})
+    DETACH DELETE c;"""
+
+REMOVE_ORPHAN_CONCEPTS_QUERY = """UNWIND $batch AS qid
+    MATCH (concept:Concept {wikidata_qid: qid})
+    WHERE NOT (concept)--()
+    DELETE concept;"""
+
+RELATIONSHIPS = ["COVERS", "HAS_PREREQUISITE"]
+
+
+@dataclass
+class GraphConfig:
+    batch_size: int
+
 
 class KnowledgeGraph:
-    def __init__(self, covered_concepts_file: str, prerequisites_concepts_file: str, curriculum_file:str):
-        self.add_covered_concepts(covered_concepts_file)
-        self.add_prerequisites_concepts(prerequisites_concepts_file)
-        self.add_course_details(curriculum_file)
-        self.clean()
-
-    def add_covered_concepts(self, covered_concepts_file: str):
-        query = f"""LOAD CSV FROM '{covered_concepts_file}' WITH HEADER AS row
-            MERGE (c:Course {{name: row.course_name}})
-
-            MERGE (concept:Concept {{wikidata_qid: row.wikidata_qid}})
-            ON CREATE SET
-                concept.name = row.wikidata_label,
-                concept.description = row.wikidata_description,
-                concept.wikidata_url = row.wikidata_url
-
-            MERGE (c)-[:COVERS]->(concept);"""
-        self.__execute_query(query)
-
-    def add_prerequisites_concepts(self, prerequisites_concepts_file: str):
-        query = f"""LOAD CSV FROM '{prerequisites_concepts_file}' WITH HEADER AS row
-            MERGE (c:Course {{name: row.course_name}})
-
-            MERGE (concept:Concept {{wikidata_qid: row.wikidata_qid}})
-            ON CREATE SET
-                concept.name = row.wikidata_label,
-                concept.description = row.wikidata_description,
-                concept.wikidata_url = row.wikidata_url
-
-            MERGE (c)-[:HAS_PREREQUISITE]->(concept);"""
-        self.__execute_query(query)
-    
-    def add_course_details(self, curriculum_file:str):
-        query = f"""LOAD CSV FROM '{curriculum_file}' WITH HEADER AS row
-            MATCH (c:Course {{name: row.course_name}})
-            SET c.term = toInteger(row.semester),
-                c.ects = toInteger(row.ects);
-            """
-        self.__execute_query(query)
-    
-    def clean(self):
-        self.__execute_query("MATCH (p) WHERE p.name = "" DETACH DELETE p;")
+    """Loads one curriculum into Memgraph.
+
+    Given the input files, the curriculum's part of the graph is brought in
+    line with them on construction, see `sync`. Without them only the
+    indexes are created, and rows can be streamed in with `add_concept_rows`
+    and `add_course_detail_rows`, followed by `remove_stale`.
+    """
+
+    def __init__(
+        self,
+        covered_concepts_file: Optional[str] = None,
+        prerequisites_concepts_file: Optional[str] = None,
+        curriculum_file: Optional[str] = None,
+        driver=None,
+        batch_size: int = 1000,
+        curriculum: str = None,
+    ):
+        # One pooled driver is reused by every query of this loader
+        self.owns_driver = driver is None
+        if driver is None:
+            from neo4j import GraphDatabase
+
+            driver = GraphDatabase.driver(URI, auth=AUTH)
+        self.driver = driver
+        self.batch_size = batch_size
+        # Courses of each curriculum carry its name as a property and a label
+        self.curriculum = curriculum or os.path.basename(curriculum_file).removesuffix(".csv")
+        self.curriculum_label = "`" + self.curriculum.replace("`", "``") + "`"
+
+        self.create_indexes()
+        if covered_concepts_file is not None:
+            self.sync(covered_concepts_file, prerequisites_concepts_file, curriculum_file)
+
+    @staticmethod
+    def load_config(config_file_path: str) -> GraphConfig:
+        with open(config_file_path, "r") as f:
+            data = yaml.safe_load(f)
+        return GraphConfig(**data)
+
+    def close(self):
+        if self.owns_driver:
+            self.driver.close()
+
+    def create_indexes(self):
+        for query in INDEX_QUERIES:
+            self.__execute_query(query)
+
+    def sync(
+        self, covered_concepts_file: str, prerequisites_concepts_file: str, curriculum_file: str
+    ):
+        """Applies the difference between the matched outputs and the graph.
+
+        The curriculum's current courses, edges and course details are read
+        and only added or removed edges, removed courses, changed details and
+        concepts left without any edge are written, all in one transaction.
+        Unmatched concepts are dropped before anything is sent.
+        """
+        concept_rows = {}
+        for relationship, matched_file in zip(
+            RELATIONSHIPS, [covered_concepts_file, prerequisites_concepts_file]
+        ):
+            for row in self.__read_rows(
+                matched_file,
+                ["course_name", "wikidata_qid", "wikidata_label", "wikidata_description", "wikidata_url"],
+            ):
+                if row["wikidata_qid"]:
+                    concept_rows[(row["course_name"], relationship, row["wikidata_qid"])] = row
+        details = {
+            row["course_name"]: (self.__to_int(row["semester"]), self.__to_int(row["ects"]))
+            for row in self.__read_rows(curriculum_file, ["course_name", "semester", "ects"])
+        }
+
+        self.__apply(self.__sync, concept_rows, details)
+
+    def remove_stale(self, edges: Set[Tuple[str, str, str]]):
+        """Removes what a streamed load no longer contains.
+
+        `edges` are the (course_name, relationship, wikidata_qid) triples
+        added by `add_concept_rows` during the load. The curriculum's other
+        edges, its courses without any of these edges and the concepts left
+        without any edge are deleted, so a streamed load ends in the same
+        graph as `sync`.
+        """
+        self.__apply(self.__remove_stale, edges)
+
+    def __apply(self, write, *args):
+        start = time.time()
+        with self.driver.session() as session:
+            changes = session.execute_write(write, *args)
+        for change, count in changes.items():
+            metrics.increment(f"graph.{change}", count)
+        rows = sum(changes.values())
+        metrics.increment("graph.rows_written", rows)
+        elapsed = time.time() - start
+        logger.info(
+            "Synced %s in %.2fs (%.0f rows/s, batches of %d): %s",
+            self.curriculum,
+            elapsed,
+            rows / max(elapsed, 1e-9),
+            self.batch_size,
+            ", ".join(f"{count} {change.replace('_', ' ')}" for change, count in changes.items()),
+            extra={
+                "curriculum": self.curriculum,
+                "rows": rows,
+                "seconds": elapsed,
+                "batch_size": self.batch_size,
+                **changes,
+            },
+        )
+
+    def __sync(
+        self,
+        tx,
+        concept_rows: Dict[Tuple[str, str, str], dict],
+        details: Dict[str, Tuple[Optional[int], Optional[int]]],
+    ) -> Dict[str, int]:
+        current_edges, current_details = self.__current_state(tx)
+
+        # Only courses with at least one matched concept have a node
+        courses = {course_name for course_name, _, _ in concept_rows}
+        added_edges = [edge for edge in concept_rows if edge not in current_edges]
+        changed_details = [
+            {"course_name": course_name, "semester": term, "ects": ects}
+            for course_name, (term, ects) in details.items()
+            if course_name in courses and current_details.get(course_name) != (term, ects)
+        ]
+
+        changes = self.__remove(tx, current_edges, current_details, concept_rows.keys())
+        for relationship in RELATIONSHIPS:
+            self.__run_batches(
+                tx,
+                CONCEPTS_QUERY.format(
+                    relationship=relationship, curriculum_label=self.curriculum_label
+                ),
+                [concept_rows[edge] for edge in added_edges if edge[1] == relationship],
+            )
+        self.__run_batches(tx, COURSE_DETAILS_QUERY, changed_details)
+        return {
+            "edges_added": len(added_edges),
+            **changes,
+            "details_updated": len(changed_details),
+        }
+
+    def __remove_stale(self, tx, edges: Set[Tuple[str, str, str]]) -> Dict[str, int]:
+        return self.__remove(tx, *self.__current_state(tx), edges)
+
+    def __current_state(self, tx) -> Tuple[Set[Tuple[str, str, str]], Dict[str, tuple]]:
+        current_edges = set()
+        current_details = {}
+        for record in tx.run(CURRENT_STATE_QUERY, curriculum=self.curriculum).data():
+            current_details[record["course_name"]] = (record["term"], record["ects"])
+            if record["relationship"] is not None:
+                current_edges.add(
+                    (record["course_name"], record["relationship"], record["wikidata_qid"])
+                )
+        return current_edges, current_details
+
+    def __remove(self, tx, current_edges, current_details, edges) -> Dict[str, int]:
+        """Deletes the current edges and courses missing from `edges`."""
+        courses = {course_name for course_name, _, _ in edges}
+        removed_edges = [edge for edge in current_edges if edge not in edges]
+        removed_courses = [c for c in current_details if c not in courses]
+        for relationship in RELATIONSHIPS:
+            self.__run_batches(
+                tx,
+                REMOVE_EDGES_QUERY.format(relationship=relationship),
+                [
+                    {"course_name": course_name, "wikidata_qid": qid}
+                    for course_name, edge_relationship, qid in removed_edges
+                    if edge_relationship == relationship
+                ],
+            )
+        self.__run_batches(tx, REMOVE_COURSES_QUERY, removed_courses)
+        # Concepts are shared between curricula; only those left without any edge go
+        self.__run_batches(
+            tx, REMOVE_ORPHAN_CONCEPTS_QUERY, list({qid for _, _, qid in removed_edges})
+        )
+        return {"edges_removed": len(removed_edges), "courses_removed": len(removed_courses)}
+
+    def add_concept_rows(self, rows: List[dict], relationship: str):
+        query = CONCEPTS_QUERY.format(
+            relationship=relationship, curriculum_label=self.curriculum_label
+        )
+        # Unmatched concepts have no node in the graph
+        self.__load_batches(query, [row for row in rows if row["wikidata_qid"]])
+
+    def add_course_detail_rows(self, rows: List[dict]):
+        self.__load_batches(COURSE_DETAILS_QUERY, rows)
+
+    def __read_rows(self, csv_file: str, columns: List[str]) -> List[dict]:
+        df = pd.read_csv(csv_file, usecols=columns)
+        # Same null handling as LOAD CSV: missing strings become ""
+        text_columns = df.select_dtypes(include="object").columns
+        df[text_columns] = df[text_columns].fillna("")
+        return df.astype(object).where(df.notna(), None).to_dict("records")
+
+    def __run_batches(self, tx, query: str, rows: List):
+        for i in range(0, len(rows), self.batch_size):
+            batch = rows[i : i + self.batch_size]
+            start = time.time()
+            with metrics.timer("graph.write_batch"):
+                tx.run(query, batch=batch, curriculum=self.curriculum).consume()
+            metrics.observe("graph.batch_rows", len(batch), COUNT_BUCKETS)
+            logger.debug("Wrote a batch of %d rows in %.3fs", len(batch), time.time() - start)
+
+    @staticmethod
+    def __to_int(value) -> Optional[int]:
+        # Same conversion as toInteger() in Cypher
+        return None if value is None else int(float(value))
+
+    def __load_batches(self, query: str, rows: List[dict]):
+        start = time.time()
+        with self.driver.session() as session:
+            for i in range(0, len(rows), self.batch_size):
+                batch = rows[i : i + self.batch_size]
+                batch_start = time.time()
+                with metrics.timer("graph.write_batch"):
+                    session.execute_write(
+                        lambda tx: tx.run(
+                            query, batch=batch, curriculum=self.curriculum
+                        ).consume()
+                    )
+                metrics.observe("graph.batch_rows", len(batch), COUNT_BUCKETS)
+                logger.debug(
+                    "Wrote a batch of %d rows in %.3fs", len(batch), time.time() - batch_start
+                )
+        metrics.increment("graph.rows_written", len(rows))
+        elapsed = time.time() - start
+        logger.info(
+            "Loaded %d rows in %.2fs (%.0f rows/s, batches of %d)",
+            len(rows),
+            elapsed,
+            len(rows) / max(elapsed, 1e-9),
+            self.batch_size,
+            extra={"rows": len(rows), "seconds": elapsed, "batch_size": self.batch_size},
+        )
 
+    @metrics.timed("graph.query")
     def __execute_query(self, query):
         try:
-            with GraphDatabase.driver(URI, auth=AUTH) as client:
-                with client.session() as session:
-                    print("Running query:", query)
-                    result = session.run(query)
-                    print(result.single())
+            with self.driver.session() as session:
+                logger.debug("Running query: %s", query)
+                result = session.run(query)
+                logger.debug("Query result: %s", result.single())
 
-                    session.run("FREE MEMORY")
+                session.run("FREE MEMORY")
 
         except BaseException as e:
-            print("Failed to execute transaction")
+            logger.error("Failed to execute transaction: %s", query)
             raise e
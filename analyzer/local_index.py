@@ -0,0 +1,155 @@
+import os
+import logging
+import numpy as np
+import pandas as pd
+from typing import List
+from embedding_cache import EmbeddingCache
+from instrumentation import metrics
+
+WIKIDATA_ENTITY_PREFIX = "http://www.wikidata.org/entity/"
+
+logger = logging.getLogger(__name__)
+
+
+class LocalWikidataIndex:
+    """Offline vector index over the Wikidata entities shipped with the repo.
+
+    Entity embeddings live in a memory-mapped matrix grouped by inverted list
+    (IVF): a query only scans the lists of its `n_probe` closest centroids.
+    """
+
+    def __init__(
+        self,
+        index_dir: str,
+        embeddings: EmbeddingCache,
+        educational_concepts_file: str,
+        concepts_file: str,
+        disciplines_file: str,
+        discipline_embeddings_file: str,
+        n_lists: int = 128,
+        n_probe: int = 8,
+    ):
+        # One index per embedding model, as the vectors are not interchangeable
+        self.index_dir = os.path.join(index_dir, embeddings.model_key)
+        self.embeddings = embeddings
+        self.n_lists = n_lists
+        self.n_probe = n_probe
+
+        if not os.path.exists(self.__path("vectors.npy")):
+            self.build(
+                educational_concepts_file,
+                concepts_file,
+                disciplines_file,
+                discipline_embeddings_file,
+            )
+        self.load()
+
+    def load(self):
+        self.entities = pd.read_csv(
+            self.__path("entities.csv"), keep_default_na=False
+        )
+        self.vectors = np.load(self.__path("vectors.npy"), mmap_mode="r")
+        self.centroids = np.load(self.__path("centroids.npy"))
+        self.list_offsets = np.load(self.__path("list_offsets.npy"))
+
+    def build(
+        self,
+        educational_concepts_file: str,
+        concepts_file: str,
+        disciplines_file: str,
+        discipline_embeddings_file: str,
+    ):
+        logger.info("Building local Wikidata index in %s...", self.index_dir)
+        disciplines = pd.read_csv(disciplines_file).rename(
+            columns={
+                "discipline": "qid",
+                "disciplineLabel": "label",
+                "disciplineDescription": "description",
+            }
+        )
+        educational_concepts = pd.read_csv(educational_concepts_file).rename(
+            columns={"item": "qid", "itemLabel": "label", "itemDescription": "description"}
+        )
+        concepts = pd.read_csv(concepts_file).rename(
+            columns={
+                "conceptQID": "qid",
+                "conceptName": "label",
+                "itemDescription": "description",
+            }
+        )
+        entities = pd.concat(
+            [
+                df[["qid", "label", "description"]]
+                for df in (disciplines, educational_concepts, concepts)
+            ],
+            ignore_index=True,
+        )
+        entities["qid"] = entities["qid"].str.removeprefix(WIKIDATA_ENTITY_PREFIX)
+        entities = entities.fillna("").drop_duplicates("qid").reset_index(drop=True)
+
+        texts = [
+            self.entity_text(label, description)
+            for label, description in zip(entities.label, entities.description)
+        ]
+        # Disciplines come first (their QIDs are unique) and reuse the
+        # precomputed embeddings when they match the configured model
+        vectors = self.embeddings.encode_with_precomputed(texts, discipline_embeddings_file)
+        self.embeddings.save()
+
+        centroids, assignments = self.__kmeans(vectors, min(self.n_lists, len(vectors)))
+        order = np.argsort(assignments, kind="stable")
+        list_offsets = np.concatenate(
+            [[0], np.cumsum(np.bincount(assignments, minlength=len(centroids)))]
+        )
+
+        os.makedirs(self.index_dir, exist_ok=True)
+        entities.iloc[order].to_csv(self.__path("entities.csv"), index=False)
+        np.save(self.__path("centroids.npy"), centroids)
+        np.save(self.__path("list_offsets.npy"), list_offsets)
+        np.save(self.__path("vectors.npy"), vectors[order])
+        logger.info(
+            "Indexed %d Wikidata entities in %d lists.",
+            len(entities),
+            len(centroids),
+            extra={"entities": len(entities), "lists": len(centroids)},
+        )
+
+    @metrics.timed("local_index.search")
+    def search(self, query_vectors: np.ndarray, k: int) -> List[List[int]]:
+        """Returns, for each normalized query vector, the row ids of its k nearest entities."""
+        probes = np.argsort(-(query_vectors @ self.centroids.T), axis=1)[:, : self.n_probe]
+        results = []
+        for query_vector, lists in zip(query_vectors, probes):
+            rows = np.concatenate(
+                [
+                    np.arange(self.list_offsets[l], self.list_offsets[l + 1])
+                    for l in lists
+                ]
+            )
+            scores = self.vectors[rows] @ query_vector
+            top = np.argsort(-scores)[:k]
+            results.append(rows[top].tolist())
+        return results
+
+    def entity(self, row: int) -> tuple:
+        entity = self.entities.iloc[row]
+        return entity.qid, entity.label, entity.description
+
+    @staticmethod
+    def entity_text(label: str, description: str) -> str:
+        return f"{label}: {description}" if description else label
+
+    def __kmeans(self, vectors: np.ndarray, n_clusters: int, n_iterations: int = 20):
+        rng = np.random.default_rng(0)
+        centroids = vectors[rng.choice(len(vectors), n_clusters, replace=False)]
+        for _ in range(n_iterations):
+            assignments = np.argmax(vectors @ centroids.T, axis=1)
+            for c in range(n_clusters):
+                members = vectors[assignments == c]
+                if len(members):
+                    centroid = members.mean(axis=0)
+                    centroids[c] = centroid / max(np.linalg.norm(centroid), 1e-12)
+        return centroids, np.argmax(vectors @ centroids.T, axis=1)
+
+    def __path(self, name: str) -> str:
+        return os.path.join(self.index_dir, name)
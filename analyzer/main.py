@@ -1,7 +1,203 @@
+import time
+
+# Measured before the remaining imports so that import regressions show up
+STARTUP_START = time.time()
+
+import os
+import glob
+import logging
+import argparse
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Tuple
 from concept_extraction import EducationalConceptExtractor
+from gemini_client import GeminiClient
+from instrumentation import configure_logging, metrics
+from knowledge_graph import KnowledgeGraph
+from rate_limit import TokenBucket
+from wikidata import WikidataMatcher
 
 CURRICULUM_CSV = "/data/en_Informatyka_i_Systemy_Inteligentne_curriculum.csv"
+GEMINI_CONFIG = "/config/gemini_config.yaml"
+WIKIDATA_CONFIG = "/config/wikidata_config.yaml"
+GRAPH_CONFIG = "/config/graph_config.yaml"
+
+logger = logging.getLogger(__name__)
+
+# Loaded once in the parent process and inherited by the forked workers
+shared = {}
+
+
+def find_curricula(paths: List[str]) -> List[str]:
+    """Expands directories and glob patterns into curriculum CSV files."""
+    curricula = []
+    for path in paths:
+        if os.path.isdir(path):
+            curricula += sorted(glob.glob(os.path.join(path, "*_curriculum.csv")))
+        else:
+            curricula += sorted(glob.glob(path))
+    return list(dict.fromkeys(curricula))
+
+
+def build_local_index():
+    WikidataMatcher(WIKIDATA_CONFIG).local_index
+
+
+def analyze(curriculum_file: str) -> Tuple[Dict[str, float], dict]:
+    """Returns the stage timings and the metrics measured by this call."""
+    if shared["forked"]:
+        # Forked workers inherit the parent's counters; report only their own
+        metrics.reset()
+    if shared["embedding_threads"]:
+        shared["embedding_backend"].set_threads(shared["embedding_threads"])
+
+    extractor = EducationalConceptExtractor(
+        curriculum_file,
+        gemini_client=shared["gemini_client"]
+        or GeminiClient(GEMINI_CONFIG, rate_limiter=shared["rate_limiter"]),
+        wikidata_matcher=shared["wikidata_matcher"]
+        or WikidataMatcher(
+            WIKIDATA_CONFIG,
+            embedding_backend=shared["embedding_backend"],
+            rate_limiter=shared["wikidata_rate_limiter"],
+        ),
+        graph_batch_size=shared["graph_batch_size"],
+        streaming=shared["streaming"],
+        chunk_size=shared["chunk_size"],
+    )
+    return extractor.timings, metrics.snapshot()
+
+
+def print_summary(timings: Dict[str, Dict[str, float]]):
+    stages = list(dict.fromkeys(stage for t in timings.values() for stage in t))
+    name_width = max(len("curriculum"), *(len(os.path.basename(c)) for c in timings))
+    header = f"{'curriculum':<{name_width}}" + "".join(f"{s:>26}" for s in stages + ["total"])
+    print(header)
+    print("-" * len(header))
+    for curriculum_file, stage_timings in timings.items():
+        print(
+            f"{os.path.basename(curriculum_file):<{name_width}}"
+            + "".join(f"{stage_timings.get(s, 0):>25.1f}s" for s in stages)
+            + f"{sum(stage_timings.values()):>25.1f}s"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Extract, match and load the concepts of one or more curricula."
+    )
+    parser.add_argument(
+        "curricula",
+        nargs="*",
+        default=[CURRICULUM_CSV],
+        help="curriculum CSV files, glob patterns or directories of *_curriculum.csv files",
+    )
+    parser.add_argument(
+        "-w",
+        "--workers",
+        type=int,
+        default=os.cpu_count(),
+        help="number of curricula processed in parallel",
+    )
+    parser.add_argument(
+        "--streaming",
+        action="store_true",
+        help="stream courses through all stages in chunks, writing Parquet outputs",
+    )
+    parser.add_argument("--chunk-size", type=int, default=50, help="courses per streamed chunk")
+    parser.add_argument(
+        "--graph-batch-size",
+        type=int,
+        help=f"rows per Memgraph write, overrides batch_size in {GRAPH_CONFIG}",
+    )
+    parser.add_argument("--log-level", default="INFO")
+    parser.add_argument("--log-json", action="store_true", help="log one JSON object per line")
+    parser.add_argument("--metrics-file", help="write counters and latency histograms here")
+    parser.add_argument(
+        "--metrics-format", choices=["json", "prometheus"], default="json"
+    )
+    parser.add_argument(
+        "--profile",
+        choices=["cprofile", "pyinstrument"],
+        help="profile every stage of every curriculum",
+    )
+    parser.add_argument("--profile-dir", default="/data/profiles")
+    args = parser.parse_args()
+
+    configure_logging(args.log_level, args.log_json)
+    metrics.configure_profiling(args.profile, args.profile_dir)
+
+    curricula = find_curricula(args.curricula)
+    if not curricula:
+        logger.error("No curricula found in %s.", args.curricula)
+        return
+    workers = max(1, min(args.workers, len(curricula)))
+    logger.info("Analysis in progress... %d curricula, %d workers", len(curricula), workers)
+
+    logger.info("Startup took %.2fs", time.time() - STARTUP_START)
+    start = time.time()
+    gemini_config = GeminiClient.load_config(GEMINI_CONFIG)
+    wikidata_config = WikidataMatcher.load_config(WIKIDATA_CONFIG)
+    # One request budget per API for all workers
+    shared["rate_limiter"] = TokenBucket(
+        gemini_config.requests_per_minute, gemini_config.burst, shared=True
+    )
+    shared["wikidata_rate_limiter"] = TokenBucket(
+        wikidata_config.requests_per_minute, wikidata_config.http_concurrency, shared=True
+    )
+    shared["embedding_backend"] = None
+    shared["embedding_threads"] = None
+    shared["gemini_client"] = None
+    shared["wikidata_matcher"] = None
+    shared["forked"] = workers > 1
+    shared["streaming"] = args.streaming
+    shared["chunk_size"] = args.chunk_size
+    shared["graph_batch_size"] = (
+        args.graph_batch_size or KnowledgeGraph.load_config(GRAPH_CONFIG).batch_size
+    )
+    if workers > 1:
+        # Loads the embedding model, builds the local index and migrates the
+        # Wikidata cache once, before forking
+        matcher = WikidataMatcher(WIKIDATA_CONFIG)
+        if matcher.embedding_backend.preload_before_fork:
+            matcher.embedding_backend.load()
+        else:
+            # Building the index loads the model, which the workers must not
+            # inherit; a child process builds it instead
+            builder = multiprocessing.get_context("fork").Process(target=build_local_index)
+            builder.start()
+            builder.join()
+            if builder.exitcode:
+                raise SystemExit("Building the local Wikidata index failed.")
+        matcher.local_index
+        shared["embedding_backend"] = matcher.embedding_backend
+        shared["embedding_threads"] = wikidata_config.embedding_threads or max(
+            1, (os.cpu_count() or 1) // workers
+        )
+
+    if workers == 1:
+        # One client and one matcher, with its model, index and re-ranker
+        # loaded on first use, serve every curriculum
+        shared["gemini_client"] = GeminiClient(GEMINI_CONFIG, rate_limiter=shared["rate_limiter"])
+        shared["wikidata_matcher"] = WikidataMatcher(
+            WIKIDATA_CONFIG, rate_limiter=shared["wikidata_rate_limiter"]
+        )
+        results = [analyze(curriculum_file) for curriculum_file in curricula]
+    else:
+        with ProcessPoolExecutor(
+            max_workers=workers, mp_context=multiprocessing.get_context("fork")
+        ) as executor:
+            results = list(executor.map(analyze, curricula))
+            for _, worker_metrics in results:
+                metrics.merge(worker_metrics)
+    timings = {curriculum_file: t for curriculum_file, (t, _) in zip(curricula, results)}
+
+    print_summary(timings)
+    logger.info("Analyzed %d curricula in %.1fs", len(curricula), time.time() - start)
+    if args.metrics_file:
+        metrics.write(args.metrics_file, args.metrics_format)
+        logger.info("Metrics written to %s", args.metrics_file)
+
 
 if __name__ == "__main__":
-    print("Analysis in progres...")
-    extractor = EducationalConceptExtractor(CURRICULUM_CSV)
\ No newline at end of file
+    main()
@@ -0,0 +1,71 @@
+import os
+import json
+import hashlib
+from enum import Enum
+from typing import Iterable
+
+# Number of recorded courses after which the manifest is written to disk
+SAVE_INTERVAL = 50
+
+
+class PipelineStage(Enum):
+    COVERED_EXTRACTION = "covered_extraction"
+    COVERED_MATCHING = "covered_matching"
+    PREREQUISITES_EXTRACTION = "prerequisites_extraction"
+    PREREQUISITES_MATCHING = "prerequisites_matching"
+
+
+class StageManifest:
+    """Per-course input hashes of every pipeline stage, persisted as JSON.
+
+    A course is up to date for a stage when its recorded hash equals the hash
+    of its current inputs. Recorded courses are written every `SAVE_INTERVAL`
+    records and on `save`; a course lost in between is recomputed on the next
+    run.
+    """
+
+    def __init__(self, manifest_file: str):
+        self.manifest_file = manifest_file
+        self.stages = self.load()
+        self.unsaved = 0
+
+    def load(self) -> dict:
+        if os.path.exists(self.manifest_file):
+            with open(self.manifest_file, "r", encoding="utf-8") as f:
+                return json.load(f)
+        return {}
+
+    def save(self):
+        tmp_file = f"{self.manifest_file}.tmp"
+        with open(tmp_file, "w", encoding="utf-8") as f:
+            json.dump(self.stages, f, indent=2, ensure_ascii=False)
+        os.replace(tmp_file, self.manifest_file)
+        self.unsaved = 0
+
+    @staticmethod
+    def content_hash(*parts) -> str:
+        content = json.dumps(parts, ensure_ascii=False, default=str)
+        return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+    def has_stage(self, stage: PipelineStage) -> bool:
+        return stage.value in self.stages
+
+    def is_current(self, stage: PipelineStage, key: str, content_hash: str) -> bool:
+        return self.stages.get(stage.value, {}).get(key) == content_hash
+
+    def record(self, stage: PipelineStage, key: str, content_hash: str):
+        self.stages.setdefault(stage.value, {})[key] = content_hash
+        self.unsaved += 1
+        if self.unsaved >= SAVE_INTERVAL:
+            self.save()
+
+    def retain(self, stage: PipelineStage, keys: Iterable[str]):
+        keys = set(keys)
+        self.stages[stage.value] = {
+            k: v for k, v in self.stages.get(stage.value, {}).items() if k in keys
+        }
+        self.save()
+
+    def reset(self, stage: PipelineStage):
+        self.stages.pop(stage.value, None)
+        self.save()
@@ -0,0 +1,43 @@
+import time
+import random
+import threading
+import multiprocessing
+
+
+class TokenBucket:
+    """Thread-safe token bucket allowing `rate_per_minute` calls with bursts of `burst`.
+
+    A `shared` bucket keeps its state in shared memory, so one budget is
+    enforced across all processes forked after it was created.
+    """
+
+    def __init__(self, rate_per_minute: float, burst: int, shared: bool = False):
+        self.rate = rate_per_minute / 60
+        self.capacity = burst
+        # [available tokens, last refill time]
+        if shared:
+            context = multiprocessing.get_context("fork")
+            self.state = context.Array("d", [float(burst), time.monotonic()], lock=False)
+            self.lock = context.Lock()
+        else:
+            self.state = [float(burst), time.monotonic()]
+            self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                tokens, updated_at = self.state[0], self.state[1]
+                now = time.monotonic()
+                tokens = min(self.capacity, tokens + (now - updated_at) * self.rate)
+                self.state[1] = now
+                if tokens >= 1:
+                    self.state[0] = tokens - 1
+                    return
+                self.state[0] = tokens
+                wait = (1 - tokens) / self.rate
+            time.sleep(wait)
+
+
+def backoff_delay(trial_nr: int, base: float, maximum: float) -> float:
+    """Exponential backoff with full jitter for the given (1-based) trial."""
+    return random.uniform(0, min(maximum, base * 2 ** (trial_nr - 1)))
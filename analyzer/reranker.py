@@ -0,0 +1,222 @@
+import logging
+import numpy as np
+import pandas as pd
+from typing import List, Tuple
+from embedding_cache import EmbeddingCache
+from instrumentation import metrics
+from local_index import WIKIDATA_ENTITY_PREFIX, LocalWikidataIndex
+from wikidata_cache import WikidataEntity
+
+logger = logging.getLogger(__name__)
+
+
+class CandidateReranker:
+    """Scores Wikidata candidates against a concept and the courses it occurs in.
+
+    score = query_weight * sim(candidate, concept)
+          + course_weight * sim(candidate, course)
+          + field_weight * field fit
+
+    The field fit is how close the course is to the best of the candidate's
+    fields of study, counting only the `course_field_top_k` fields closest
+    to the course, i.e. its inferred fields. It is 0 for candidates outside
+    all of them.
+    """
+
+    def __init__(
+        self,
+        embeddings: EmbeddingCache,
+        fields_of_study_file: str,
+        relationships_file: str,
+        educational_concepts_file: str,
+        concepts_file: str,
+        disciplines_file: str,
+        discipline_embeddings_file: str,
+        query_weight: float,
+        course_weight: float,
+        field_weight: float,
+        course_field_top_k: int,
+    ):
+        self.embeddings = embeddings
+        self.query_weight = query_weight
+        self.course_weight = course_weight
+        self.field_weight = field_weight
+        self.course_field_top_k = course_field_top_k
+        self.load(
+            fields_of_study_file,
+            relationships_file,
+            educational_concepts_file,
+            concepts_file,
+            disciplines_file,
+            discipline_embeddings_file,
+        )
+
+    def load(
+        self,
+        fields_of_study_file: str,
+        relationships_file: str,
+        educational_concepts_file: str,
+        concepts_file: str,
+        disciplines_file: str,
+        discipline_embeddings_file: str,
+    ):
+        disciplines = pd.read_csv(disciplines_file).rename(
+            columns={"discipline": "qid", "disciplineLabel": "label", "disciplineDescription": "description"}
+        )
+        educational_concepts = pd.read_csv(educational_concepts_file)
+        concepts = pd.read_csv(concepts_file)
+        fields = pd.concat(
+            [
+                disciplines[["qid", "label", "description"]],
+                pd.read_csv(fields_of_study_file).rename(
+                    columns={"fieldQID": "qid", "fieldName": "label"}
+                ),
+                educational_concepts.rename(columns={"subject": "qid", "subjectLabel": "label"}),
+                concepts.rename(columns={"fieldQID": "qid", "fieldName": "label"}),
+            ],
+            ignore_index=True,
+        )[["qid", "label", "description"]]
+        fields["qid"] = fields["qid"].str.removeprefix(WIKIDATA_ENTITY_PREFIX)
+        # Disciplines come first, so their precomputed embeddings line up
+        fields = fields.fillna("").drop_duplicates("qid").reset_index(drop=True)
+        self.field_ids = pd.Index(fields["qid"])
+
+        texts = [
+            LocalWikidataIndex.entity_text(label, description)
+            for label, description in zip(fields["label"], fields["description"])
+        ]
+        self.field_vectors = self.embeddings.encode_with_precomputed(
+            texts, discipline_embeddings_file
+        )
+
+        memberships = pd.concat(
+            [
+                pd.read_csv(relationships_file),
+                educational_concepts.rename(columns={"item": "conceptQID", "subject": "fieldQID"}),
+                concepts,
+                # Every field belongs to itself
+                pd.DataFrame({"conceptQID": fields["qid"], "fieldQID": fields["qid"]}),
+            ],
+            ignore_index=True,
+        )[["conceptQID", "fieldQID"]].astype(str)
+        for column in memberships:
+            memberships[column] = memberships[column].str.removeprefix(WIKIDATA_ENTITY_PREFIX)
+        memberships["field"] = self.field_ids.get_indexer(memberships["fieldQID"])
+        memberships = memberships[memberships["field"] >= 0].drop_duplicates()
+        self.fields_by_concept = {
+            qid: group.to_numpy()
+            for qid, group in memberships.groupby("conceptQID")["field"]
+        }
+        logger.info(
+            "Loaded %d fields of study and %d concept memberships.",
+            len(self.field_ids),
+            len(memberships),
+        )
+
+    @metrics.timed("wikidata.rerank")
+    def score(
+        self,
+        queries: List[str],
+        course_names: List[List[str]],
+        candidates: List[List[WikidataEntity]],
+    ) -> List[Tuple[np.ndarray, np.ndarray, np.ndarray]]:
+        """Scores the candidates of many concepts in one pass.
+
+        Returns, per concept, its (n_candidates,) query similarities and its
+        (n_candidates, n_courses) course similarities and combined scores.
+        """
+        candidate_texts = [
+            LocalWikidataIndex.entity_text(entity.label, entity.description)
+            for entities in candidates
+            for entity in entities
+        ]
+        flat_courses = [course_name for names in course_names for course_name in names]
+        vectors = self.embeddings.encode(queries + flat_courses + candidate_texts)
+        query_vectors = vectors[: len(queries)]
+        course_vectors = vectors[len(queries) : len(queries) + len(flat_courses)]
+        candidate_vectors = vectors[len(queries) + len(flat_courses) :]
+
+        # Every (candidate, course) combination of each concept
+        n_candidates = np.array([len(entities) for entities in candidates])
+        n_courses = np.array([len(names) for names in course_names])
+        candidate_offsets = np.concatenate([[0], np.cumsum(n_candidates)])
+        course_offsets = np.concatenate([[0], np.cumsum(n_courses)])
+        combo_candidate = np.concatenate(
+            [
+                np.repeat(np.arange(candidate_offsets[i], candidate_offsets[i + 1]), n_courses[i])
+                for i in range(len(queries))
+            ]
+        ).astype(np.int64)
+        combo_course = np.concatenate(
+            [
+                np.tile(np.arange(course_offsets[i], course_offsets[i + 1]), n_candidates[i])
+                for i in range(len(queries))
+            ]
+        ).astype(np.int64)
+
+        query_similarities = np.einsum(
+            "ij,ij->i",
+            candidate_vectors,
+            query_vectors[np.repeat(np.arange(len(queries)), n_candidates)],
+        )
+        course_similarities = np.einsum(
+            "ij,ij->i", candidate_vectors[combo_candidate], course_vectors[combo_course]
+        )
+        field_fit = self.__field_fit(
+            [entity.qid for entities in candidates for entity in entities],
+            course_vectors,
+            combo_candidate,
+            combo_course,
+        )
+        scores = (
+            self.query_weight * query_similarities[combo_candidate]
+            + self.course_weight * course_similarities
+            + self.field_weight * field_fit
+        )
+
+        results = []
+        combo_offset = 0
+        for i in range(len(queries)):
+            shape = (n_candidates[i], n_courses[i])
+            size = shape[0] * shape[1]
+            results.append(
+                (
+                    query_similarities[candidate_offsets[i] : candidate_offsets[i + 1]],
+                    course_similarities[combo_offset : combo_offset + size].reshape(shape),
+                    scores[combo_offset : combo_offset + size].reshape(shape),
+                )
+            )
+            combo_offset += size
+        return results
+
+    def __field_fit(
+        self,
+        candidate_qids: List[str],
+        course_vectors: np.ndarray,
+        combo_candidate: np.ndarray,
+        combo_course: np.ndarray,
+    ) -> np.ndarray:
+        # (n_courses, n_fields) similarities, kept only for each course's top fields
+        course_fields = course_vectors @ self.field_vectors.T
+        top_k = min(self.course_field_top_k, course_fields.shape[1])
+        kth = np.partition(course_fields, -top_k, axis=1)[:, -top_k][:, None]
+        course_fields = np.where(course_fields >= kth, np.maximum(course_fields, 0), 0)
+
+        # Ragged candidate -> fields lists, expanded to every combination
+        candidate_fields = [
+            self.fields_by_concept.get(qid, np.empty(0, dtype=np.int64)) for qid in candidate_qids
+        ]
+        degrees = np.array([len(fields) for fields in candidate_fields], dtype=np.int64)
+        flat_fields = np.concatenate([np.empty(0, dtype=np.int64), *candidate_fields])
+        field_offsets = np.concatenate([[0], np.cumsum(degrees)])
+
+        combo_degrees = degrees[combo_candidate]
+        combo_ids = np.repeat(np.arange(len(combo_candidate)), combo_degrees)
+        within = np.arange(len(combo_ids)) - np.repeat(
+            np.cumsum(combo_degrees) - combo_degrees, combo_degrees
+        )
+        fields = flat_fields[np.repeat(field_offsets[combo_candidate], combo_degrees) + within]
+
+        field_fit = np.zeros(len(combo_candidate))
+        np.maximum.at(field_fit, combo_ids, course_fields[combo_course[combo_ids], fields])
+        return field_fit
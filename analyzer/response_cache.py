@@ -0,0 +1,104 @@
+import os
+import time
+import hashlib
+import sqlite3
+import threading
+from typing import Optional
+from instrumentation import metrics
+
+# Number of pending access-time updates written to the store in one commit
+TOUCH_BATCH_SIZE = 100
+
+
+class ResponseCache:
+    """Size-bounded, content-addressed SQLite store of raw LLM responses.
+
+    Entries are evicted least-recently-used once `max_entries` is exceeded.
+    Access times of cache hits are buffered and written in batches, on `put`
+    and on `flush`, so reads do not commit. The store may be shared by
+    several processes, so eviction counts the entries in the store itself.
+    """
+
+    def __init__(self, cache_file: str, max_entries: int):
+        self.cache_file = cache_file
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.touched = {}
+
+        os.makedirs(os.path.dirname(cache_file) or ".", exist_ok=True)
+        self.connection = sqlite3.connect(cache_file, timeout=30, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute(
+            """CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                response TEXT NOT NULL,
+                last_used REAL NOT NULL
+            )"""
+        )
+        self.connection.execute(
+            "CREATE INDEX IF NOT EXISTS responses_last_used ON responses (last_used)"
+        )
+        self.connection.commit()
+
+    @staticmethod
+    def key(prompt: str, model: str, temperature: float, prompt_version: str) -> str:
+        content = "\0".join([model, str(temperature), prompt_version, prompt])
+        return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Optional[str]:
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT response FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                metrics.increment("cache.gemini_response.misses")
+                return None
+            self.hits += 1
+            metrics.increment("cache.gemini_response.hits")
+            self.touched[key] = time.time()
+            if len(self.touched) >= TOUCH_BATCH_SIZE:
+                self.__write_touched()
+                self.connection.commit()
+            return row[0]
+
+    def put(self, key: str, response: str):
+        with self.lock:
+            self.__write_touched()
+            inserted = self.connection.execute(
+                "INSERT OR IGNORE INTO responses (key, response, last_used) VALUES (?, ?, ?)",
+                (key, response, time.time()),
+            ).rowcount
+            size = self.__size() if inserted else 0
+            if size > self.max_entries:
+                self.connection.execute(
+                    """DELETE FROM responses WHERE key IN (
+                        SELECT key FROM responses ORDER BY last_used LIMIT ?
+                    )""",
+                    (size - self.max_entries,),
+                )
+            self.connection.commit()
+
+    def flush(self):
+        """Writes the buffered access times of cache hits."""
+        with self.lock:
+            if self.touched:
+                self.__write_touched()
+                self.connection.commit()
+
+    def stats(self) -> str:
+        with self.lock:
+            size = self.__size()
+        return f"{self.hits} hits, {self.misses} misses, {size} entries"
+
+    def __size(self) -> int:
+        return self.connection.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+
+    def __write_touched(self):
+        self.connection.executemany(
+            "UPDATE responses SET last_used = MAX(last_used, ?) WHERE key = ?",
+            [(last_used, key) for key, last_used in self.touched.items()],
+        )
+        self.touched.clear()
@@ -0,0 +1,421 @@
+import os
+import json
+import math
+import time
+import uuid
+import asyncio
+import logging
+import argparse
+import pandas as pd
+from aiohttp import web
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List
+from concept_extraction import EducationalConceptExtractor, matched_row
+from gemini_client import GeminiClient
+from instrumentation import configure_logging, metrics
+from knowledge_graph import AUTH, URI, KnowledgeGraph
+from main import GEMINI_CONFIG, GRAPH_CONFIG, WIKIDATA_CONFIG
+from wikidata import WikidataMatcher
+
+PORT = 6000
+# Curricula are only read and written below this directory
+DATA_DIR = "/data"
+
+logger = logging.getLogger(__name__)
+
+
+def json_safe(value):
+    """Replaces the NaNs pandas leaves in result rows, which JSON cannot carry."""
+    if isinstance(value, float) and math.isnan(value):
+        return None
+    if isinstance(value, dict):
+        return {k: json_safe(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [json_safe(v) for v in value]
+    return value
+
+
+class Job:
+    """One submitted analysis and the events it published so far."""
+
+    def __init__(self, kind: str, params: dict):
+        self.id = uuid.uuid4().hex
+        self.kind = kind
+        self.params = params
+        self.status = "queued"
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+        self.result = None
+        self.error = None
+        self.events = []
+        # Replaced by a fresh event on every publish, so waiters wake up once
+        self.updated = asyncio.Event()
+
+    @property
+    def done(self) -> bool:
+        return self.status in ("succeeded", "failed")
+
+    def publish(self, event: dict):
+        self.events.append(json_safe(event))
+        self.updated.set()
+        self.updated = asyncio.Event()
+
+    def summary(self) -> dict:
+        return {
+            "job_id": self.id,
+            "kind": self.kind,
+            "params": self.params,
+            "status": self.status,
+            "created": self.created,
+            "started": self.started,
+            "finished": self.finished,
+            "events": len(self.events),
+            "result": self.result,
+            "error": self.error,
+        }
+
+
+class AnalyzerService:
+    """Resident analyzer behind an asyncio HTTP API.
+
+    The Gemini client, the Wikidata matcher with its embedding model, local
+    index and caches, and the Memgraph driver are created once and shared by
+    all jobs. Jobs run one at a time on a worker thread, so the event loop
+    keeps answering status polls and event streams meanwhile.
+    """
+
+    def __init__(
+        self,
+        gemini_client: GeminiClient,
+        wikidata_matcher: WikidataMatcher,
+        graph_driver,
+        max_jobs: int = 100,
+        data_dir: str = DATA_DIR,
+        graph_batch_size: int = 1000,
+    ):
+        self.gemini_client = gemini_client
+        self.wikidata_matcher = wikidata_matcher
+        self.graph_driver = graph_driver
+        self.graph_batch_size = graph_batch_size
+        self.max_jobs = max_jobs
+        self.data_dir = os.path.realpath(data_dir)
+        self.jobs: Dict[str, Job] = OrderedDict()
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="analyzer-job")
+        self.warm = False
+
+    def application(self) -> web.Application:
+        app = web.Application()
+        app.add_routes(
+            [
+                web.post("/curricula", self.submit_curriculum),
+                web.post("/courses", self.submit_course),
+                web.get("/jobs", self.list_jobs),
+                web.get("/jobs/{job_id}", self.get_job),
+                web.get("/jobs/{job_id}/events", self.stream_events),
+                web.get("/health", self.health),
+                web.get("/metrics", self.get_metrics),
+            ]
+        )
+        app.on_startup.append(self.warm_up)
+        app.on_cleanup.append(self.shutdown)
+        return app
+
+    async def warm_up(self, app: web.Application):
+        """Loads the embedding model and the local index before the first job."""
+
+        def load():
+            start = time.time()
+            self.wikidata_matcher.embeddings.encode(["warm up"])
+            self.wikidata_matcher.local_index
+            self.warm = True
+            logger.info("Service warmed up in %.2fs", time.time() - start)
+
+        def report(future: asyncio.Future):
+            if not future.cancelled() and future.exception():
+                logger.error(
+                    "Warm-up failed, jobs load models on first use",
+                    exc_info=future.exception(),
+                )
+
+        asyncio.get_running_loop().run_in_executor(self.executor, load).add_done_callback(report)
+
+    async def shutdown(self, app: web.Application):
+        self.executor.shutdown(wait=True)
+        self.wikidata_matcher.save_embeddings()
+        self.graph_driver.close()
+
+    async def submit_curriculum(self, request: web.Request) -> web.Response:
+        params = await self.__read_json(request)
+        curriculum_file = self.__curriculum_file(params.get("curriculum_file"))
+        params = {
+            "curriculum_file": curriculum_file,
+            "streaming": bool(params.get("streaming", False)),
+            "chunk_size": self.__chunk_size(params.get("chunk_size", 50)),
+        }
+        return self.__accepted(self.__submit("curriculum", params, self.__analyze_curriculum))
+
+    async def submit_course(self, request: web.Request) -> web.Response:
+        """Analyzes one course.
+
+        With a `curriculum_file`, the course is added to or replaced in that
+        curriculum and only what changed is recomputed and reloaded. Without
+        one, its matched concepts are returned without writing anything.
+        """
+        params = await self.__read_json(request)
+        course = params.get("course")
+        if not isinstance(course, dict) or not course.get("course_name"):
+            raise web.HTTPBadRequest(text="Expected a course object with a course_name")
+        curriculum_file = params.get("curriculum_file")
+        if curriculum_file is None:
+            return self.__accepted(
+                self.__submit("course", {"course": course}, self.__analyze_course)
+            )
+        curriculum_file = self.__curriculum_file(curriculum_file)
+        params = {"curriculum_file": curriculum_file, "course": course}
+        return self.__accepted(self.__submit("course_update", params, self.__update_course))
+
+    async def list_jobs(self, request: web.Request) -> web.Response:
+        return web.json_response(
+            [{k: v for k, v in job.summary().items() if k != "result"} for job in self.jobs.values()]
+        )
+
+    async def get_job(self, request: web.Request) -> web.Response:
+        return web.json_response(self.__job(request).summary())
+
+    async def stream_events(self, request: web.Request) -> web.StreamResponse:
+        """Streams the events of a job as JSON lines, from the first one until it ends."""
+        job = self.__job(request)
+        response = web.StreamResponse(headers={"Content-Type": "application/x-ndjson"})
+        await response.prepare(request)
+        sent = 0
+        while True:
+            if sent < len(job.events):
+                await response.write((json.dumps(job.events[sent]) + "\n").encode("utf-8"))
+                sent += 1
+                continue
+            if job.done:
+                break
+            await job.updated.wait()
+        await response.write_eof()
+        return response
+
+    async def health(self, request: web.Request) -> web.Response:
+        return web.json_response(
+            {
+                "status": "ok",
+                "warm": self.warm,
+                "jobs": {
+                    status: sum(job.status == status for job in self.jobs.values())
+                    for status in ["queued", "running", "succeeded", "failed"]
+                },
+            }
+        )
+
+    async def get_metrics(self, request: web.Request) -> web.Response:
+        return web.Response(text=metrics.to_prometheus(), content_type="text/plain")
+
+    def __submit(self, kind: str, params: dict, run: Callable[[dict, Callable], dict]) -> Job:
+        loop = asyncio.get_running_loop()
+        job = Job(kind, params)
+        self.jobs[job.id] = job
+        self.__forget_old_jobs()
+
+        def publish(event: dict):
+            loop.call_soon_threadsafe(job.publish, event)
+
+        def finish(status: str, result: dict = None, error: str = None):
+            job.status, job.result, job.error = status, json_safe(result), error
+            job.finished = time.time()
+            job.publish({"event": "finished", "status": status, "error": error})
+
+        def execute():
+            loop.call_soon_threadsafe(self.__start, job)
+            try:
+                result = run(params, publish)
+            except Exception as e:
+                logger.exception("Job %s failed", job.id)
+                loop.call_soon_threadsafe(finish, "failed", None, f"{type(e).__name__}: {e}")
+                return
+            loop.call_soon_threadsafe(finish, "succeeded", result)
+
+        logger.info("Queued %s job %s", kind, job.id, extra={"job_id": job.id, "kind": kind})
+        self.executor.submit(execute)
+        return job
+
+    @staticmethod
+    def __start(job: Job):
+        job.status = "running"
+        job.started = time.time()
+        job.publish({"event": "started"})
+
+    def __forget_old_jobs(self):
+        finished = [job_id for job_id, job in self.jobs.items() if job.done]
+        for job_id in finished[: max(0, len(self.jobs) - self.max_jobs)]:
+            del self.jobs[job_id]
+
+    def __analyze_curriculum(self, params: dict, publish: Callable[[dict], None]) -> dict:
+        extractor = EducationalConceptExtractor(
+            params["curriculum_file"],
+            gemini_client=self.gemini_client,
+            wikidata_matcher=self.wikidata_matcher,
+            graph_driver=self.graph_driver,
+            graph_batch_size=self.graph_batch_size,
+            streaming=params["streaming"],
+            chunk_size=params["chunk_size"],
+            progress=publish,
+        )
+        return {"timings": extractor.timings}
+
+    def __update_course(self, params: dict, publish: Callable[[dict], None]) -> dict:
+        curriculum_file = params["curriculum_file"]
+        course = params["course"]
+        curriculum = pd.read_csv(curriculum_file, index_col=0)
+        unknown_columns = set(course) - set(curriculum.columns)
+        if unknown_columns:
+            raise ValueError(f"Unknown course fields {sorted(unknown_columns)}")
+
+        existing = curriculum["course_name"] == course["course_name"]
+        if existing.any():
+            for column, value in course.items():
+                curriculum.loc[existing, column] = value
+        else:
+            curriculum = pd.concat([curriculum, pd.DataFrame([course])], ignore_index=True)
+        tmp_file = f"{curriculum_file}.tmp"
+        curriculum.to_csv(tmp_file)
+        os.replace(tmp_file, curriculum_file)
+
+        return self.__analyze_curriculum(
+            {"curriculum_file": curriculum_file, "streaming": False, "chunk_size": 50}, publish
+        )
+
+    def __analyze_course(self, params: dict, publish: Callable[[dict], None]) -> dict:
+        course = params["course"]
+        course_name = course["course_name"]
+        concepts = {}
+        for column, stage, extract in [
+            ("program_content", "covered", self.gemini_client.extract_covered_concepts),
+            ("prerequisites", "prerequisites", self.gemini_client.extract_prerequisite_concepts),
+        ]:
+            content = course.get(column)
+            extracted = extract(course_name, content) if content else []
+            if extracted is None:
+                raise RuntimeError(f"Extraction of {stage} concepts failed for {course_name}")
+            concepts[stage] = [c for c in dict.fromkeys(extracted) if c != "none"]
+            publish(
+                {
+                    "event": "course",
+                    "stage": f"{stage}_extraction",
+                    "course_name": course_name,
+                    "rows": [{"course_name": course_name, f"{stage}_concepts": concepts[stage]}],
+                }
+            )
+
+        pairs = list(
+            dict.fromkeys((concept, course_name) for stage in concepts.values() for concept in stage)
+        )
+        entities = dict(zip(pairs, self.wikidata_matcher.search_entities(pairs) if pairs else []))
+        self.wikidata_matcher.save_embeddings()
+        result = {"course_name": course_name}
+        for stage, stage_concepts in concepts.items():
+            rows: List[dict] = [
+                matched_row(concept, course_name, entities[(concept, course_name)])
+                for concept in stage_concepts
+            ]
+            result[f"{stage}_concepts"] = rows
+            publish(
+                {
+                    "event": "course",
+                    "stage": f"{stage}_matching",
+                    "course_name": course_name,
+                    "rows": rows,
+                }
+            )
+        return result
+
+    def __curriculum_file(self, path) -> str:
+        """Resolves a requested curriculum, which must be a CSV file inside `data_dir`."""
+        curriculum_file = os.path.realpath(path) if isinstance(path, str) and path else None
+        if (
+            curriculum_file is None
+            or not curriculum_file.startswith(self.data_dir + os.sep)
+            or not curriculum_file.endswith(".csv")
+            or not os.path.isfile(curriculum_file)
+        ):
+            raise web.HTTPBadRequest(
+                text=f"No curriculum file {path!r}, expected a CSV file in {self.data_dir}"
+            )
+        return curriculum_file
+
+    @staticmethod
+    def __chunk_size(value) -> int:
+        """Parses a requested number of courses per streamed chunk."""
+        try:
+            chunk_size = int(value) if not isinstance(value, bool) else 0
+        except (TypeError, ValueError):
+            chunk_size = 0
+        if chunk_size <= 0:
+            raise web.HTTPBadRequest(
+                text=f"Invalid chunk_size {value!r}, expected a positive integer"
+            )
+        return chunk_size
+
+    def __job(self, request: web.Request) -> Job:
+        job = self.jobs.get(request.match_info["job_id"])
+        if job is None:
+            raise web.HTTPNotFound(text="Unknown job")
+        return job
+
+    @staticmethod
+    async def __read_json(request: web.Request) -> dict:
+        try:
+            params = await request.json()
+        except json.JSONDecodeError:
+            raise web.HTTPBadRequest(text="Expected a JSON body")
+        if not isinstance(params, dict):
+            raise web.HTTPBadRequest(text="Expected a JSON object")
+        return params
+
+    @staticmethod
+    def __accepted(job: Job) -> web.Response:
+        return web.json_response(
+            {
+                "job_id": job.id,
+                "status": job.status,
+                "status_url": f"/jobs/{job.id}",
+                "events_url": f"/jobs/{job.id}/events",
+            },
+            status=202,
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Serve curriculum and course analyses over HTTP with warm models and caches."
+    )
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=PORT)
+    parser.add_argument("--max-jobs", type=int, default=100, help="finished jobs kept for polling")
+    parser.add_argument("--data-dir", default=DATA_DIR, help="directory the curricula must be in")
+    parser.add_argument("--log-level", default="INFO")
+    parser.add_argument("--log-json", action="store_true", help="log one JSON object per line")
+    args = parser.parse_args()
+    configure_logging(args.log_level, args.log_json)
+
+    from neo4j import GraphDatabase
+
+    service = AnalyzerService(
+        GeminiClient(GEMINI_CONFIG),
+        WikidataMatcher(WIKIDATA_CONFIG),
+        # Pooled connections, reused by every graph load
+        GraphDatabase.driver(URI, auth=AUTH),
+        args.max_jobs,
+        args.data_dir,
+        KnowledgeGraph.load_config(GRAPH_CONFIG).batch_size,
+    )
+    web.run_app(service.application(), host=args.host, port=args.port)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+import os
+import queue
+import threading
+from typing import Dict, Iterable, Iterator, List
+
+# Marks the end of a pipelined stream
+_DONE = object()
+
+
+class _Failure:
+    def __init__(self, error: BaseException):
+        self.error = error
+
+
+def pipelined(items: Iterable, maxsize: int = 2) -> Iterator:
+    """Produces `items` on a background thread into a bounded queue.
+
+    The consumer gets each item as soon as it is ready, while the producer
+    runs at most `maxsize` items ahead. Chaining calls therefore overlaps
+    the stages of a pipeline with a bounded amount of data in flight.
+    Errors raised by the producer are re-raised in the consumer.
+    """
+    items_queue = queue.Queue(maxsize)
+
+    def produce():
+        try:
+            for item in items:
+                items_queue.put(item)
+        except BaseException as e:
+            items_queue.put(_Failure(e))
+        finally:
+            items_queue.put(_DONE)
+
+    threading.Thread(target=produce, daemon=True).start()
+    while True:
+        item = items_queue.get()
+        if item is _DONE:
+            return
+        if isinstance(item, _Failure):
+            raise item.error
+        yield item
+
+
+class ParquetTableWriter:
+    """Appends rows to a Parquet file, one row group per `write`.
+
+    Columns are strings, or lists of strings for `list_columns`. The file is
+    written under a temporary name and moved into place on `close`, so
+    readers never see a partial file.
+    """
+
+    def __init__(self, output_file: str, columns: List[str], list_columns: Iterable[str] = ()):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        self.pa = pa
+        self.output_file = output_file
+        self.tmp_file = f"{output_file}.tmp"
+        self.schema = pa.schema(
+            [
+                (column, pa.list_(pa.string()) if column in list_columns else pa.string())
+                for column in columns
+            ]
+        )
+        self.writer = pq.ParquetWriter(self.tmp_file, self.schema)
+
+    def write(self, rows: List[Dict]):
+        if rows:
+            self.writer.write_table(self.pa.Table.from_pylist(rows, schema=self.schema))
+
+    def close(self):
+        self.writer.close()
+        os.replace(self.tmp_file, self.output_file)
+
+    def __enter__(self) -> "ParquetTableWriter":
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.writer.close()
+            os.remove(self.tmp_file)
@@ -0,0 +1,69 @@
+import os
+import sys
+import pytest
+
+# The analyzer modules are imported as top-level modules, as in the container
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from knowledge_graph import CURRENT_STATE_QUERY
+
+
+class StubResult:
+    def __init__(self, records=None):
+        self.records = records or []
+
+    def data(self):
+        return self.records
+
+    def single(self):
+        return self.records[0] if self.records else None
+
+    def consume(self):
+        pass
+
+
+class StubDriver:
+    """Stands in for a neo4j driver, recording every query and its parameters.
+
+    The curriculum's current courses and edges, as read by `sync` and
+    `remove_stale`, are taken from `state`.
+    """
+
+    def __init__(self, state=None):
+        self.state = state or []
+        self.queries = []
+        self.transactions = 0
+        self.closed = False
+
+    def session(self):
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def run(self, query, **params):
+        self.queries.append((query, params))
+        if query == CURRENT_STATE_QUERY:
+            return StubResult(self.state)
+        return StubResult()
+
+    def execute_write(self, write, *args):
+        self.transactions += 1
+        return write(self, *args)
+
+    def close(self):
+        self.closed = True
+
+    def batches(self, query_start: str):
+        """The `batch` parameters of the queries starting with `query_start`."""
+        return [
+            params["batch"] for query, params in self.queries if query.startswith(query_start)
+        ]
+
+
+@pytest.fixture
+def graph_driver():
+    return StubDriver()
@@ -0,0 +1,31 @@
+from concept_extraction import extraction_rows, has_content, matched_rows
+from wikidata_cache import WikidataEntity
+
+
+def test_courses_without_prerequisites_have_no_row():
+    assert extraction_rows("Logic", [], "prerequisites_concepts") == []
+    assert extraction_rows("Logic", ["none"], "prerequisites_concepts") == []
+    assert extraction_rows("Logic", [], "covered_concepts") == [
+        {"course_name": "Logic", "covered_concepts": []}
+    ]
+    assert not has_content(float("nan"))
+    assert not has_content("  ")
+
+
+def test_matched_rows_keep_every_extracted_concept():
+    rows = [
+        {"course_name": "Logic", "concept": ["set", "proof", "set"]},
+        {"course_name": "Algebra", "concept": float("nan")},
+    ]
+    entities = {
+        ("set", "Logic"): WikidataEntity("Q36161", "set"),
+        ("proof", "Logic"): None,
+    }
+
+    matched = matched_rows(rows, "concept", entities)
+
+    assert [(row["concept"], row["wikidata_qid"]) for row in matched] == [
+        ("set", "Q36161"),
+        ("proof", None),
+        ("set", "Q36161"),
+    ]
@@ -0,0 +1,90 @@
+import re
+import time
+import yaml
+import threading
+import pytest
+import gemini_client
+from types import SimpleNamespace
+from gemini_client import GeminiClient
+from rate_limit import TokenBucket
+
+COURSES = [(f"Course {i}", f"Description of course {i}") for i in range(8)]
+
+
+class FakeGenAI:
+    """Stands in for genai.Client, answering with the course named in the prompt."""
+
+    def __init__(self, fail: bool = False, delay: float = 0.0):
+        self.models = self
+        self.fail = fail
+        self.delay = delay
+        self.calls = 0
+        self.active = 0
+        self.max_active = 0
+        self.lock = threading.Lock()
+
+    def generate_content(self, model: str, contents: str, config: dict):
+        with self.lock:
+            self.calls += 1
+            self.active += 1
+            self.max_active = max(self.max_active, self.active)
+        try:
+            if self.fail:
+                raise RuntimeError("quota exceeded")
+            time.sleep(self.delay)
+            # The examples in the template come before the course itself
+            course_name = re.findall(r"Course Title: (.*)", contents)[-1]
+            return SimpleNamespace(text=f"{course_name}; Shared Concept")
+        finally:
+            with self.lock:
+                self.active -= 1
+
+
+@pytest.fixture
+def config_file(tmp_path):
+    config = {
+        "model": "gemini-2.0-flash",
+        "temperature": 0.2,
+        "max_nr_of_trials": 3,
+        "prompt_version": "v1.0",
+        "prompts_file": "extraction_prompts.json",
+        "concurrency": 4,
+        "requests_per_minute": 60,
+        "burst": 100,
+        "backoff_base_seconds": 2,
+        "backoff_max_seconds": 60,
+        "response_cache_file": str(tmp_path / "responses.sqlite"),
+        "response_cache_max_entries": 100,
+        "packing": False,
+        "pack_task_types": True,
+        "pack_token_budget": 6000,
+        "pack_max_courses": 8,
+    }
+    config_file = tmp_path / "gemini_config.yaml"
+    config_file.write_text(yaml.safe_dump(config))
+    return str(config_file)
+
+
+def test_batch_extraction_runs_concurrently_in_order_and_is_cached(config_file):
+    genai = FakeGenAI(delay=0.05)
+    client = GeminiClient(config_file, client=genai, rate_limiter=TokenBucket(1e9, 1000))
+
+    results = list(client.extract_covered_concepts_batch(COURSES))
+
+    assert results == [[name.lower(), "shared concept"] for name, _ in COURSES]
+    assert genai.calls == len(COURSES)
+    assert 1 < genai.max_active <= 4
+
+    assert list(client.extract_covered_concepts_batch(COURSES)) == results
+    assert genai.calls == len(COURSES)
+
+
+def test_failed_request_gives_up_without_a_final_backoff(config_file, monkeypatch):
+    sleeps = []
+    monkeypatch.setattr(gemini_client.time, "sleep", sleeps.append)
+    genai = FakeGenAI(fail=True)
+    client = GeminiClient(config_file, client=genai, rate_limiter=TokenBucket(1e9, 1000))
+
+    assert client.extract_covered_concepts(*COURSES[0]) is None
+    assert genai.calls == 3
+    assert len(sleeps) == 2
@@ -0,0 +1,157 @@
+import pandas as pd
+from knowledge_graph import (
+    COURSE_DETAILS_QUERY,
+    REMOVE_COURSES_QUERY,
+    REMOVE_ORPHAN_CONCEPTS_QUERY,
+    KnowledgeGraph,
+)
+
+MATCHED_COLUMNS = [
+    "course_name",
+    "concept",
+    "wikidata_qid",
+    "wikidata_label",
+    "wikidata_description",
+    "wikidata_url",
+]
+
+
+def state_record(course_name, relationship=None, qid=None, term=1, ects=5):
+    return {
+        "course_name": course_name,
+        "term": term,
+        "ects": ects,
+        "relationship": relationship,
+        "wikidata_qid": qid,
+    }
+
+
+def matched_row(course_name, qid):
+    label = None if qid is None else f"label of {qid}"
+    url = None if qid is None else f"https://www.wikidata.org/wiki/{qid}"
+    return [course_name, f"concept {qid}", qid, label, label, url]
+
+
+def write_inputs(tmp_path, covered, prerequisites):
+    files = []
+    for name, rows in [("covered", covered), ("prerequisites", prerequisites)]:
+        files.append(tmp_path / f"curriculum_{name}_matched.csv")
+        pd.DataFrame(rows, columns=MATCHED_COLUMNS).to_csv(files[-1], index=False)
+    files.append(tmp_path / "curriculum.csv")
+    pd.DataFrame(
+        [["Algorithms", 1, 5], ["Databases", 2, 6], ["Ethics", 3, 2]],
+        columns=["course_name", "semester", "ects"],
+    ).to_csv(files[-1])
+    return [str(f) for f in files]
+
+
+def edge_batches(driver, relationship, removed=False):
+    prefix = "UNWIND $batch AS row\n    MATCH (:Course" if removed else "UNWIND $batch AS row\n    MERGE"
+    return [
+        row
+        for query, params in driver.queries
+        if query.startswith(prefix) and relationship in query
+        for row in params["batch"]
+    ]
+
+
+def test_sync_writes_only_the_difference(tmp_path, graph_driver):
+    graph_driver.state = [
+        state_record("Algorithms", "COVERS", "Q1"),
+        state_record("Algorithms", "COVERS", "Q2"),
+        state_record("Old course", "COVERS", "Q9"),
+    ]
+    files = write_inputs(
+        tmp_path,
+        covered=[
+            matched_row("Algorithms", "Q1"),
+            matched_row("Algorithms", "Q3"),
+            matched_row("Databases", "Q4"),
+            matched_row("Databases", None),
+        ],
+        prerequisites=[matched_row("Databases", "Q1")],
+    )
+
+    graph = KnowledgeGraph(*files, driver=graph_driver, curriculum="curriculum")
+    graph.close()
+
+    assert graph_driver.transactions == 1
+    assert not graph_driver.closed
+    assert [row["wikidata_qid"] for row in edge_batches(graph_driver, "COVERS")] == ["Q3", "Q4"]
+    assert [row["wikidata_qid"] for row in edge_batches(graph_driver, "HAS_PREREQUISITE")] == ["Q1"]
+    assert sorted(
+        (row["course_name"], row["wikidata_qid"])
+        for row in edge_batches(graph_driver, "COVERS", removed=True)
+    ) == [("Algorithms", "Q2"), ("Old course", "Q9")]
+    assert graph_driver.batches(REMOVE_COURSES_QUERY) == [["Old course"]]
+    assert sorted(graph_driver.batches(REMOVE_ORPHAN_CONCEPTS_QUERY)[0]) == ["Q2", "Q9"]
+    # Algorithms keeps its details; the course without a matched concept has no node
+    assert graph_driver.batches(COURSE_DETAILS_QUERY) == [
+        [{"course_name": "Databases", "semester": 2, "ects": 6}]
+    ]
+
+
+def test_sync_of_an_up_to_date_graph_writes_nothing(tmp_path, graph_driver):
+    graph_driver.state = [state_record("Algorithms", "COVERS", "Q1")]
+    files = write_inputs(tmp_path, covered=[matched_row("Algorithms", "Q1")], prerequisites=[])
+
+    KnowledgeGraph(*files, driver=graph_driver, curriculum="curriculum")
+
+    assert all(
+        query.startswith(("CREATE INDEX", "FREE MEMORY", "MATCH"))
+        for query, _ in graph_driver.queries
+    )
+
+
+def test_remove_stale_keeps_the_streamed_edges(graph_driver):
+    graph_driver.state = [
+        state_record("Algorithms", "COVERS", "Q1"),
+        state_record("Algorithms", "HAS_PREREQUISITE", "Q2"),
+        state_record("Old course", "COVERS", "Q3"),
+    ]
+    graph = KnowledgeGraph(driver=graph_driver, curriculum="curriculum")
+
+    graph.remove_stale({("Algorithms", "COVERS", "Q1")})
+
+    assert edge_batches(graph_driver, "COVERS", removed=True) == [
+        {"course_name": "Old course", "wikidata_qid": "Q3"}
+    ]
+    assert edge_batches(graph_driver, "HAS_PREREQUISITE", removed=True) == [
+        {"course_name": "Algorithms", "wikidata_qid": "Q2"}
+    ]
+    assert graph_driver.batches(REMOVE_COURSES_QUERY) == [["Old course"]]
+    assert sorted(graph_driver.batches(REMOVE_ORPHAN_CONCEPTS_QUERY)[0]) == ["Q2", "Q3"]
+
+
+def test_rows_are_loaded_in_parameterized_batches(graph_driver):
+    graph = KnowledgeGraph(driver=graph_driver, batch_size=2, curriculum="My `curriculum`")
+    rows = [
+        dict(zip(MATCHED_COLUMNS, matched_row(f"Course {i}", qid)))
+        for i, qid in enumerate(["Q1", None, "Q2", "Q3", "Q4", None, "Q5"])
+    ]
+
+    graph.add_concept_rows(rows, "COVERS")
+    graph.close()
+
+    loads = [
+        (query, params)
+        for query, params in graph_driver.queries
+        if query.startswith("UNWIND $batch AS row\n    MERGE")
+    ]
+    assert [[row["wikidata_qid"] for row in params["batch"]] for _, params in loads] == [
+        ["Q1", "Q2"],
+        ["Q3", "Q4"],
+        ["Q5"],
+    ]
+    assert graph_driver.transactions == 3
+    # Values are sent as parameters; only the escaped label is part of the query
+    assert all(params["curriculum"] == "My `curriculum`" for _, params in loads)
+    assert all("SET c:`My ``curriculum```" in query for query, _ in loads)
+    assert not graph_driver.closed
+
+
+def test_batch_size_is_read_from_the_config(tmp_path):
+    config_file = tmp_path / "graph_config.yaml"
+    config_file.write_text("batch_size: 250\n")
+
+    assert KnowledgeGraph.load_config(str(config_file)).batch_size == 250
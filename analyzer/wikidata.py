@@ -1,157 +1,551 @@
-import os
-import json
 import time
+import yaml
+import logging
 import requests
-from typing import List, Optional
-from sentence_transformers import SentenceTransformer
-from sklearn.metrics.pairwise import cosine_similarity
+import numpy as np
+from enum import Enum
+from dataclasses import dataclass
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
+from requests.adapters import HTTPAdapter
+from embedding_backends import create_embedding_backend
+from embedding_cache import EmbeddingCache
+from fuzzy_index import FuzzyConceptIndex, is_misspelling, normalize_concept
+from instrumentation import metrics
+from local_index import WIKIDATA_ENTITY_PREFIX, LocalWikidataIndex
+from rate_limit import TokenBucket, backoff_delay
+from reranker import CandidateReranker
+from wikidata_cache import NOT_CACHED, WikidataEntity, open_wikidata_cache
 
+logger = logging.getLogger(__name__)
 
-class WikidataEntity:
-    def __init__(self, qid: str, label: str, description: str = ""):
-        self.qid = qid
-        self.label = label
-        self.description = description
-        self.url = f"https://www.wikidata.org/wiki/{qid}"
 
-    def __str__(self):
-        return f"Qid: {self.qid}, label: {self.label}, description: {self.description}"
+@dataclass
+class WikidataConfig:
+    mode: str
+    online_fallback: bool
+    embedding_model: str
+    embedding_backend: str
+    onnx_model_dir: str
+    embedding_threads: int
+    embedding_cache_dir: str
+    index_dir: str
+    educational_concepts_file: str
+    concepts_file: str
+    disciplines_file: str
+    discipline_embeddings_file: str
+    nr_of_candidates: int
+    n_lists: int
+    n_probe: int
+    cache_backend: str
+    cache_file: str
+    legacy_cache_file: str
+    negative_cache_ttl_days: float
+    search_url: str
+    sparql_url: str
+    user_agent: str
+    http_timeout_seconds: float
+    http_concurrency: int
+    requests_per_minute: float
+    sparql_batch_size: int
+    backoff_base_seconds: float
+    backoff_max_seconds: float
+    fields_of_study_file: str
+    relationships_file: str
+    rerank_query_weight: float
+    rerank_course_weight: float
+    rerank_field_weight: float
+    course_field_top_k: int
+    fuzzy_matching: bool
+    fuzzy_threshold: float
 
-    def __repr__(self):
-        return f"WikidataEntity('{self.qid}', '{self.label}', '{self.description}')"
 
-    def to_dict(self):
-        return {"qid": self.qid, "label": self.label, "description": self.description}
+class WikidataUnavailableError(RuntimeError):
+    """Raised when a Wikidata endpoint keeps failing after all trials."""
+
+
+class MatcherMode(Enum):
+    LOCAL = "local"
+    ONLINE = "online"
 
-    @staticmethod
-    def from_dict(data):
-        return WikidataEntity(data["qid"], data["label"], data.get("description", ""))
+
+def _same_entity(a: WikidataEntity, b: WikidataEntity) -> bool:
+    return a.qid == b.qid
 
 
 class WikidataMatcher:
     def __init__(
-        self, cache_file: str = "/data/wikidata_cache.json"
+        self,
+        config_file: str = "/config/wikidata_config.yaml",
+        embedding_backend=None,
+        rate_limiter: TokenBucket = None,
+        session: requests.Session = None,
     ):
-        self.cache_file = cache_file
-        self.cache = self.load_cache()
+        self.config_file_path = config_file
+        self.config = self.load_config(config_file)
+        self.mode = MatcherMode(self.config.mode)
+        self.cache = open_wikidata_cache(
+            self.config.cache_backend,
+            self.config.cache_file,
+            self.config.negative_cache_ttl_days * 24 * 3600,
+            self.config.legacy_cache_file,
+        )
         self.max_nr_of_trials = 3
         self.query_similarity_threshold = 0.5
         self.course_similarity_threshold = 0.1
-        self.embedding_model = SentenceTransformer("all-MiniLM-L6-v2")
-
-    def load_cache(self):
-        if os.path.exists(self.cache_file):
-            with open(self.cache_file, "r", encoding="utf-8") as f:
-                data = json.load(f)
-            return {k: WikidataEntity.from_dict(v) for k, v in data.items()}
-        else:
-            return {}
+        self.session = session or self.__create_session()
+        self.rate_limiter = rate_limiter or TokenBucket(
+            self.config.requests_per_minute, self.config.http_concurrency
+        )
+        # The embedding model and the local index are loaded on first use, so
+        # runs answered entirely from the cache never pay for them
+        self.embedding_backend = embedding_backend or create_embedding_backend(
+            self.config.embedding_backend,
+            self.config.embedding_model,
+            self.config.onnx_model_dir,
+            self.config.embedding_threads,
+        )
+        self._local_index = None
+        self._reranker = None
+        self._near_duplicate_indexes = None
+        self.embeddings = EmbeddingCache(
+            lambda: self.embedding_backend,
+            self.embedding_backend.cache_name,
+            self.config.embedding_cache_dir,
+        )
 
-    def save_cache(self):
-        with open(self.cache_file, "w", encoding="utf-8") as f:
-            json.dump(
-                {k: v.to_dict() for k, v in self.cache.items()},
-                f,
-                indent=2,
-                ensure_ascii=False,
+    def __create_session(self) -> requests.Session:
+        # Keep-alive connections to the search API and the SPARQL endpoint,
+        # one per concurrent request
+        session = requests.Session()
+        session.headers["User-Agent"] = self.config.user_agent
+        adapter = HTTPAdapter(
+            pool_connections=2, pool_maxsize=self.config.http_concurrency
+        )
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        return session
+
+    @property
+    def local_index(self) -> LocalWikidataIndex:
+        if self._local_index is None and self.mode == MatcherMode.LOCAL:
+            self._local_index = LocalWikidataIndex(
+                self.config.index_dir,
+                self.embeddings,
+                self.config.educational_concepts_file,
+                self.config.concepts_file,
+                self.config.disciplines_file,
+                self.config.discipline_embeddings_file,
+                self.config.n_lists,
+                self.config.n_probe,
             )
+        return self._local_index
+
+    @property
+    def reranker(self) -> CandidateReranker:
+        if self._reranker is None:
+            self._reranker = CandidateReranker(
+                self.embeddings,
+                self.config.fields_of_study_file,
+                self.config.relationships_file,
+                self.config.educational_concepts_file,
+                self.config.concepts_file,
+                self.config.disciplines_file,
+                self.config.discipline_embeddings_file,
+                self.config.rerank_query_weight,
+                self.config.rerank_course_weight,
+                self.config.rerank_field_weight,
+                self.config.course_field_top_k,
+            )
+        return self._reranker
+
+    @property
+    def near_duplicate_indexes(self) -> List[FuzzyConceptIndex]:
+        """Concepts resolved by a search before, and the labels of the local index entities."""
+        if self._near_duplicate_indexes is None:
+            start = time.time()
+            concept_index = FuzzyConceptIndex(self.config.fuzzy_threshold)
+            for query, entity in self.cache.items():
+                concept_index.add(query, entity, _same_entity)
+            # Both know every word of either, to tell typos from other words
+            label_index = FuzzyConceptIndex(self.config.fuzzy_threshold, concept_index.tokens)
+            if self.mode == MatcherMode.LOCAL:
+                entities = self.local_index.entities
+                for entity in self._filter_entities(
+                    [
+                        WikidataEntity(qid, label, description)
+                        for qid, label, description in zip(
+                            entities["qid"], entities["label"], entities["description"]
+                        )
+                    ]
+                ):
+                    label_index.add(entity.label, entity, _same_entity)
+            self._near_duplicate_indexes = [concept_index, label_index]
+            logger.info(
+                "Indexed %d resolved concepts and %d labels for near-duplicate matching in %.2fs",
+                len(concept_index),
+                len(label_index),
+                time.time() - start,
+            )
+        return self._near_duplicate_indexes
+
+    @staticmethod
+    def load_config(config_file: str) -> WikidataConfig:
+        with open(config_file, "r") as f:
+            data = yaml.safe_load(f)
+        return WikidataConfig(**data)
+
+    def matching_settings(self) -> dict:
+        """Every setting that can change which entity a concept resolves to."""
+        config = self.config
+        return {
+            "mode": config.mode,
+            "online_fallback": config.online_fallback,
+            "embeddings": self.embedding_backend.cache_name,
+            "educational_concepts_file": config.educational_concepts_file,
+            "nr_of_candidates": config.nr_of_candidates,
+            "n_lists": config.n_lists,
+            "n_probe": config.n_probe,
+            "query_similarity_threshold": self.query_similarity_threshold,
+            "course_similarity_threshold": self.course_similarity_threshold,
+            "rerank_query_weight": config.rerank_query_weight,
+            "rerank_course_weight": config.rerank_course_weight,
+            "rerank_field_weight": config.rerank_field_weight,
+            "course_field_top_k": config.course_field_top_k,
+            "fuzzy_matching": config.fuzzy_matching,
+            "fuzzy_threshold": config.fuzzy_threshold,
+        }
+
+    def save_embeddings(self):
+        self.embeddings.save()
 
     def search_entity(self, query: str, course_name: str) -> Optional[WikidataEntity]:
+        return self.search_entities([(query, course_name)])[0]
+
+    def search_entities(
+        self, pairs: List[Tuple[str, str]]
+    ) -> List[Optional[WikidataEntity]]:
+        """Resolves (concept, course_name) pairs in one batched pass.
+
+        Concepts go through cheaper tiers first: the exact cache, then the
+        normalized form and the closest trigram match among resolved concepts
+        and Wikidata labels. Candidates are only retrieved for the rest, once
+        per distinct normalized concept, and the candidates of all concepts
+        are scored against all of their courses at once.
+        """
+        unique_pairs = list(dict.fromkeys(pairs))
+        courses_by_query = {}
+        for query, course_name in unique_pairs:
+            courses_by_query.setdefault(query, []).append(course_name)
+
         # Check local cache first
-        if query in self.cache:
-            return self.cache[query]
+        resolved = {}
+        missed_queries = []
+        for query, course_names in courses_by_query.items():
+            with metrics.timer("cache.wikidata.get"):
+                cached = self.cache.get(query)
+            if cached is NOT_CACHED:
+                metrics.increment("cache.wikidata.misses")
+                missed_queries.append(query)
+            else:
+                metrics.increment("cache.wikidata.hits")
+                resolved.update({(query, course_name): cached for course_name in course_names})
+
+        # Near-duplicates of resolved concepts and labels skip the search, and
+        # variants of one concept within the batch are searched once. Only
+        # searched concepts are cached; near-duplicates are matched again
+        # by the same cheap lookups on every run
+        search_queries = []
+        variants = {}
+        duplicates = []
+        near_duplicates = (
+            self._match_near_duplicates(missed_queries, courses_by_query)
+            if self.config.fuzzy_matching and missed_queries
+            else {}
+        )
+        for query in missed_queries:
+            entity = near_duplicates.get(query)
+            if entity:
+                self.__resolve(query, entity, courses_by_query, resolved)
+            elif variants.setdefault(normalize_concept(query), query) == query:
+                search_queries.append(query)
+            else:
+                duplicates.append(query)
 
-        # If not found, query Wikidata API
-        entities = self._search_wikidata(query, course_name)
+        candidates = {}
+        if self.mode == MatcherMode.LOCAL and search_queries:
+            candidates = dict(zip(search_queries, self._search_local(search_queries)))
 
-        if entities:
-            entity = entities[0]  # Take the best matching entity
+        matches_by_query = dict.fromkeys(search_queries)
+        matches_by_query.update(self._rank_candidates(candidates, courses_by_query))
+        online_queries = [
+            query
+            for query in search_queries
+            if not matches_by_query[query]
+            and (self.mode == MatcherMode.ONLINE or self.config.online_fallback)
+        ]
+
+        # If not found, query Wikidata API for all remaining concepts at once
+        online_candidates = (
+            self._search_wikidata_batch(online_queries) if online_queries else {}
+        )
+        matches_by_query.update(self._rank_candidates(online_candidates, courses_by_query))
+
+        searched = set()
+        for query, entity in matches_by_query.items():
+            # Unmatched queries are cached too, as negative results, unless the
+            # API could not be reached
+            if entity or query not in online_queries or query in online_candidates:
+                searched.add(query)
+                with metrics.timer("cache.wikidata.put"):
+                    self.cache.put(query, entity)
+                # New matches are near-duplicate targets for later batches
+                if entity and self._near_duplicate_indexes is not None:
+                    self._near_duplicate_indexes[0].add(query, entity, _same_entity)
+                self.__resolve(query, entity, courses_by_query, resolved)
+            else:
+                resolved.update({(query, course_name): None for course_name in courses_by_query[query]})
+                metrics.increment("wikidata.unmatched")
+
+        for query in duplicates:
+            representative = variants[normalize_concept(query)]
+            if representative in searched:
+                self.__resolve(query, matches_by_query[representative], courses_by_query, resolved)
+            else:
+                resolved.update({(query, course_name): None for course_name in courses_by_query[query]})
+        metrics.increment("wikidata.tier.batch_variants", len(duplicates))
+
+        with metrics.timer("cache.wikidata.flush"):
+            self.cache.flush()
+        logger.info(
+            "Resolved %d concepts: %d unique (concept, course) pairs, "
+            "%d unique concepts, %d cached, %d near-duplicates, %d variants, "
+            "%d lookups performed.",
+            len(pairs),
+            len(unique_pairs),
+            len(courses_by_query),
+            len(courses_by_query) - len(missed_queries),
+            len(near_duplicates),
+            len(duplicates),
+            len(search_queries),
+            extra={
+                "concepts": len(pairs),
+                "unique_pairs": len(unique_pairs),
+                "unique_concepts": len(courses_by_query),
+                "cached": len(courses_by_query) - len(missed_queries),
+                "near_duplicates": len(near_duplicates),
+                "variants": len(duplicates),
+                "lookups": len(search_queries),
+            },
+        )
+        return [resolved[pair] for pair in pairs]
+
+    def _match_near_duplicates(
+        self, queries: List[str], courses_by_query: Dict[str, List[str]]
+    ) -> Dict[str, WikidataEntity]:
+        """Resolves concepts by their normalized form, then by trigram similarity.
+
+        The normalized form is looked up among resolved concepts and labels.
+        Trigram similarity only matches resolved concepts that the query
+        misspells: words that appear in neither index may differ by a typo,
+        known words must be equal, as in generic vs genetic programming. Like
+        a search result, a near-duplicate must be as similar to the query as
+        `query_similarity_threshold`, and the near-duplicates of a concept are
+        re-ranked against its courses in this batch, as the entity stored for
+        another course may not fit these.
+        """
+        concept_index, label_index = self.near_duplicate_indexes
+        candidates = {}
+        tiers = {}
+        for query in queries:
+            entities = [
+                entity for entity in (concept_index.get(query), label_index.get(query)) if entity
+            ]
+            if entities:
+                tiers[query] = "normalized"
+                candidates[query] = list({entity.qid: entity for entity in entities}.values())
+                continue
+            metrics.increment("wikidata.tier.normalized.misses")
+            entity, _ = concept_index.search(
+                query, lambda key, target: is_misspelling(key, target, concept_index.tokens)
+            )
             if entity:
-                self.cache[query] = entity
-            self.save_cache()
-            return entity
-        else:
-            return None
-
-    def _search_wikidata(self, query: str, course_name:str) -> List[WikidataEntity]:
-        search_url = "https://www.wikidata.org/w/api.php"
-        params = {
-            "action": "query",
-            "list": "search",
-            "srsearch": query,
-            "format": "json",
-            "srlimit": 5,
-            "srnamespace": "0",
-        }
-        trial_nr = 1
-        while trial_nr <= self.max_nr_of_trials:
-            response = requests.get(search_url, params=params)
-            if response.status_code != 200:
-                trial_nr += 1
-                print("sleeping...")
-                time.sleep(5)
+                tiers[query] = "fuzzy"
+                candidates[query] = [entity]
+            else:
+                metrics.increment("wikidata.tier.fuzzy.misses")
+        if not candidates:
+            return {}
+
+        matches = {}
+        scored = self.reranker.score(
+            list(candidates),
+            [courses_by_query[query] for query in candidates],
+            list(candidates.values()),
+        )
+        for (query, query_candidates), (query_similarities, _, scores) in zip(
+            candidates.items(), scored
+        ):
+            accepted = query_similarities >= self.query_similarity_threshold
+            best = int(np.argmax(np.where(accepted, scores.mean(axis=1), -np.inf)))
+            tier = tiers[query]
+            if not accepted[best]:
+                metrics.increment(f"wikidata.tier.{tier}.misses")
                 continue
-                # response.raise_for_status()
+            metrics.increment(f"wikidata.tier.{tier}.hits")
+            matches[query] = query_candidates[best]
+            logger.debug("Resolved %r by a %s near-duplicate: %r", query, tier, matches[query].label)
+        return matches
 
-            data = response.json()
-            if "query" not in data or "search" not in data["query"]:
-                return []
+    def __resolve(
+        self,
+        query: str,
+        entity: Optional[WikidataEntity],
+        courses_by_query: Dict[str, List[str]],
+        resolved: dict,
+    ):
+        resolved.update({(query, course_name): entity for course_name in courses_by_query[query]})
+        metrics.increment("wikidata.matched" if entity else "wikidata.unmatched")
 
-            titles = [item["title"] for item in data["query"]["search"]]
-            entities = self._get_entities_details(titles)
+    @metrics.timed("wikidata.search_local")
+    def _search_local(self, queries: List[str]) -> List[List[WikidataEntity]]:
+        query_embeddings = self.embeddings.encode(queries)
+        rows = self.local_index.search(query_embeddings, self.config.nr_of_candidates)
 
-            if not entities:
-                return []
-            
+        candidates = []
+        for query, query_rows in zip(queries, rows):
+            entities = [WikidataEntity(*self.local_index.entity(row)) for row in query_rows]
             filtered_entities = self._filter_entities(entities)
-            print(f"Filtered: {filtered_entities}")
-
             if not filtered_entities:
-                print(f"No valid Wikidata entities after filtering for query '{query}'.")
-                return []
-
-            return [self._get_best_match(query, course_name, filtered_entities)]
-
-    def _get_best_match(
-        self, query: str, course_name:str, candidates: List[WikidataEntity]
-    ) -> WikidataEntity | None:
-        query_embedding = self.embedding_model.encode(f"{query}")
-        course_embedding = self.embedding_model.encode(f"{course_name}")
-
-        scored = []
-        for idx, entity in enumerate(candidates):
-            text = (
-                f"{entity.label}: {entity.description}"
-                if entity.description
-                else entity.label
-            )
+                logger.debug("No valid local Wikidata entities after filtering for query %r.", query)
+            candidates.append(filtered_entities)
+        return candidates
 
-            candidate_embedding = self.embedding_model.encode(text)
-            query_similarity = cosine_similarity([query_embedding], [candidate_embedding])[0][
-                0
-            ]
-            course_similarity = cosine_similarity([course_embedding], [candidate_embedding])[0][
-                0
+    @metrics.timed("wikidata.search_online")
+    def _search_wikidata_batch(self, queries: List[str]) -> Dict[str, List[WikidataEntity]]:
+        """Searches Wikidata for many concepts with as few round trips as possible.
+
+        The searches run concurrently under the rate limit, then the candidates
+        of all concepts are resolved by SPARQL queries of `sparql_batch_size`
+        QIDs each. Concepts whose lookup failed are left out of the result.
+        """
+        titles = {}
+        with ThreadPoolExecutor(max_workers=self.config.http_concurrency) as executor:
+            searches = {query: executor.submit(self._search_titles, query) for query in queries}
+            for query, search in searches.items():
+                try:
+                    titles[query] = search.result()
+                except WikidataUnavailableError as e:
+                    logger.warning("Skipping %r: %s", query, e)
+
+            qids = list(dict.fromkeys(qid for query_titles in titles.values() for qid in query_titles))
+            chunks = [
+                qids[i : i + self.config.sparql_batch_size]
+                for i in range(0, len(qids), self.config.sparql_batch_size)
             ]
-            if query_similarity >= self.query_similarity_threshold or course_similarity >= self.course_similarity_threshold:
-                scored.append((entity, query_similarity, course_similarity, idx))
-        print(scored)
-        # Sort descending by similarity
-        scored.sort(key=lambda x: x[3])
-        if len(scored) == 0: return None
-
-        best_match, best_query_score, best_course_score, idx = scored[0]
-        print(
-            f"Best match for '{query}' = '{best_match.label}' (score: {best_query_score:.2f})"
+            details = {}
+            failed_qids = set()
+            for chunk, lookup in zip(
+                chunks, [executor.submit(self._get_entities_details, chunk) for chunk in chunks]
+            ):
+                try:
+                    details.update((entity.qid, entity) for entity in lookup.result())
+                except WikidataUnavailableError as e:
+                    logger.warning("Skipping %d candidates: %s", len(chunk), e)
+                    failed_qids.update(chunk)
+
+        candidates = {}
+        for query, query_titles in titles.items():
+            if failed_qids.intersection(query_titles):
+                continue
+            candidates[query] = self._filter_entities(
+                [details[qid] for qid in query_titles if qid in details]
+            )
+            if not candidates[query]:
+                logger.debug("No valid Wikidata entities after filtering for query %r.", query)
+        logger.info(
+            "Searched Wikidata for %d concepts with %d SPARQL queries.",
+            len(queries),
+            len(chunks),
+            extra={"concepts": len(queries), "sparql_queries": len(chunks)},
         )
+        return candidates
 
-        return best_match
+    @metrics.timed("wikidata.search_request")
+    def _search_titles(self, query: str) -> List[str]:
+        """Returns the QIDs of the top search results for `query`, in rank order."""
+        data = self._request(
+            "search",
+            self.config.search_url,
+            {
+                "action": "query",
+                "list": "search",
+                "srsearch": query,
+                "format": "json",
+                "srlimit": self.config.nr_of_candidates,
+                "srnamespace": "0",
+            },
+        )
+        if "query" not in data or "search" not in data["query"]:
+            return []
+        return [item["title"] for item in data["query"]["search"]]
+
+    def _rank_candidates(
+        self, candidates: Dict[str, List[WikidataEntity]], courses_by_query: Dict[str, List[str]]
+    ) -> Dict[str, Optional[WikidataEntity]]:
+        """Best match of every concept that has candidates, scored in one batch."""
+        queries = [query for query, query_candidates in candidates.items() if query_candidates]
+        if not queries:
+            return {}
+        matches = self._get_best_matches_batch(
+            queries,
+            [courses_by_query[query] for query in queries],
+            [candidates[query] for query in queries],
+        )
+        return dict(zip(queries, matches))
+
+    @metrics.timed("wikidata.best_match")
+    def _get_best_matches_batch(
+        self,
+        queries: List[str],
+        course_names: List[List[str]],
+        candidates: List[List[WikidataEntity]],
+    ) -> List[Optional[WikidataEntity]]:
+        """Picks the best candidate of each concept over all of its courses.
 
+        A candidate is acceptable if it is similar enough to the concept or to
+        any of the courses; the acceptable candidate with the highest mean
+        re-ranker score over the courses wins, ties going to the better search
+        rank. A concept resolves to one entity whatever the order of its
+        courses, as the cache stores one entity per concept.
+        """
+        scored = self.reranker.score(queries, course_names, candidates)
+        best_matches = []
+        for query, query_candidates, (query_similarities, course_similarities, scores) in zip(
+            queries, candidates, scored
+        ):
+            accepted = (query_similarities >= self.query_similarity_threshold) | (
+                course_similarities >= self.course_similarity_threshold
+            ).any(axis=1)
+            mean_scores = scores.mean(axis=1)
+            # argmax returns the first, i.e. best ranked, of equal scores
+            best = int(np.argmax(np.where(accepted, mean_scores, -np.inf)))
+            if not accepted[best]:
+                best_matches.append(None)
+                continue
+
+            best_match = query_candidates[best]
+            logger.debug(
+                "Best match for %r = %r (score: %.2f)", query, best_match.label, mean_scores[best]
+            )
+            best_matches.append(best_match)
+        return best_matches
+
+    @metrics.timed("wikidata.sparql")
     def _get_entities_details(self, qids: List[str]) -> List[WikidataEntity]:
         if not qids:
             return []
 
-        sparql_url = "https://query.wikidata.org/sparql"
         ids_formatted = " ".join(f"wd:{qid}" for qid in qids)
         query = f"""
         SELECT DISTINCT ?item ?itemLabel ?itemDescription
@@ -164,30 +558,64 @@ class WikidataMatcher:
             SERVICE wikibase:label {{ bd:serviceParam wikibase:language "[AUTO_LANGUAGE],en". }}
         }}
         """
-        trial_nr = 1
-        while trial_nr <= self.max_nr_of_trials:
-            r = requests.get(sparql_url, params={"format": "json", "query": query})
-            if r.status_code != 200:
-                trial_nr += 1
-                print("sleeping sparql ...")
-                time.sleep(5)
-                continue
+        # POST keeps large VALUES lists clear of URL length limits
+        data = self._request(
+            "sparql", self.config.sparql_url, {"format": "json", "query": query}, post=True
+        )
+        entities = {}
+        for item in data["results"]["bindings"]:
+            label = item.get("itemLabel", {}).get("value", "")
+            description = item.get("itemDescription", {}).get("value", "")
+            qid = item.get("item", {}).get("value").replace(WIKIDATA_ENTITY_PREFIX, "")
+            entities[qid] = WikidataEntity(qid, label, description)
+
+        return [entities[qid] for qid in qids if qid in entities]
 
-            data = r.json()
-            entities = {}
+    def _request(self, endpoint: str, url: str, params: dict, post: bool = False) -> dict:
+        """Sends a rate-limited request over the pooled session and returns its JSON.
 
-            for item in data["results"]["bindings"]:
-                label = item.get("itemLabel", {}).get("value", "")
-                description = item.get("itemDescription", {}).get("value", "")
-                qid = (
-                    item.get("item", {})
-                    .get("value")
-                    .replace("http://www.wikidata.org/entity/", "")
+        Failed attempts are retried with backoff; WikidataUnavailableError is
+        raised once `max_nr_of_trials` attempts failed.
+        """
+        error = None
+        for trial_nr in range(1, self.max_nr_of_trials + 1):
+            self.rate_limiter.acquire()
+            metrics.increment(f"wikidata.{endpoint}_requests")
+            try:
+                if post:
+                    response = self.session.post(
+                        url, data=params, timeout=self.config.http_timeout_seconds
+                    )
+                else:
+                    response = self.session.get(
+                        url, params=params, timeout=self.config.http_timeout_seconds
+                    )
+                if response.status_code == 200:
+                    return response.json()
+                error = f"HTTP {response.status_code}"
+            except (requests.RequestException, ValueError) as e:
+                error = e
+
+            metrics.increment(f"wikidata.{endpoint}_errors")
+            logger.warning(
+                "Wikidata %s request failed (trial %d/%d): %s",
+                endpoint,
+                trial_nr,
+                self.max_nr_of_trials,
+                error,
+            )
+            if trial_nr < self.max_nr_of_trials:
+                time.sleep(
+                    backoff_delay(
+                        trial_nr,
+                        self.config.backoff_base_seconds,
+                        self.config.backoff_max_seconds,
+                    )
                 )
-                entities[qid] = WikidataEntity(qid, label, description)
+        raise WikidataUnavailableError(
+            f"Wikidata {endpoint} failed after {self.max_nr_of_trials} trials: {error}"
+        )
 
-            return [entities[qid] for qid in qids if qid in entities]
-    
     def _filter_entities(self, entities: List[WikidataEntity]) -> List[WikidataEntity]:
         filtered = []
         for e in entities:
@@ -0,0 +1,242 @@
+import os
+import json
+import time
+import logging
+import sqlite3
+import threading
+from abc import ABC, abstractmethod
+from typing import Iterator, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+class WikidataEntity:
+    def __init__(self, qid: str, label: str, description: str = ""):
+        self.qid = qid
+        self.label = label
+        self.description = description
+        self.url = f"https://www.wikidata.org/wiki/{qid}"
+
+    def __str__(self):
+        return f"Qid: {self.qid}, label: {self.label}, description: {self.description}"
+
+    def __repr__(self):
+        return f"WikidataEntity('{self.qid}', '{self.label}', '{self.description}')"
+
+    def to_dict(self):
+        return {"qid": self.qid, "label": self.label, "description": self.description}
+
+    @staticmethod
+    def from_dict(data):
+        return WikidataEntity(data["qid"], data["label"], data.get("description", ""))
+
+
+# Returned by WikidataCache.get for queries that were never resolved
+NOT_CACHED = object()
+# Number of buffered SQLite cache writes committed together
+WRITE_BATCH_SIZE = 500
+
+
+class WikidataCache(ABC):
+    """Query -> WikidataEntity store.
+
+    `get` returns the cached entity, None for a cached negative result, or
+    NOT_CACHED. Negative results expire after `negative_ttl_seconds`. Writes
+    may be buffered until `flush`.
+    """
+
+    def __init__(self, negative_ttl_seconds: float):
+        self.negative_ttl_seconds = negative_ttl_seconds
+
+    @abstractmethod
+    def get(self, query: str):
+        pass
+
+    @abstractmethod
+    def put(self, query: str, entity: Optional[WikidataEntity]):
+        pass
+
+    @abstractmethod
+    def items(self) -> Iterator[Tuple[str, WikidataEntity]]:
+        """Every cached query that resolved to an entity."""
+
+    @abstractmethod
+    def flush(self):
+        pass
+
+    def is_expired(self, cached_at: float) -> bool:
+        return time.time() - cached_at > self.negative_ttl_seconds
+
+
+class JsonWikidataCache(WikidataCache):
+    """The original single-file JSON cache, rewritten only on `flush`."""
+
+    def __init__(self, cache_file: str, negative_ttl_seconds: float):
+        super().__init__(negative_ttl_seconds)
+        self.cache_file = cache_file
+        self.data = self.load()
+        self.dirty = False
+
+    def load(self) -> dict:
+        if os.path.exists(self.cache_file):
+            with open(self.cache_file, "r", encoding="utf-8") as f:
+                return json.load(f)
+        return {}
+
+    def get(self, query: str):
+        if query not in self.data:
+            return NOT_CACHED
+        data = self.data[query]
+        if data.get("qid") is None:
+            return None if not self.is_expired(data["cached_at"]) else NOT_CACHED
+        return WikidataEntity.from_dict(data)
+
+    def put(self, query: str, entity: Optional[WikidataEntity]):
+        self.data[query] = (
+            entity.to_dict() if entity else {"qid": None, "cached_at": time.time()}
+        )
+        self.dirty = True
+
+    def items(self) -> Iterator[Tuple[str, WikidataEntity]]:
+        for query, data in self.data.items():
+            if data.get("qid") is not None:
+                yield query, WikidataEntity.from_dict(data)
+
+    def flush(self):
+        if not self.dirty:
+            return
+        tmp_file = f"{self.cache_file}.tmp"
+        with open(tmp_file, "w", encoding="utf-8") as f:
+            json.dump(self.data, f, indent=2, ensure_ascii=False)
+        os.replace(tmp_file, self.cache_file)
+        self.dirty = False
+
+
+class SqliteWikidataCache(WikidataCache):
+    """Indexed SQLite cache: one row per query, written in O(1).
+
+    Writes are buffered and committed together on `flush`, or once
+    `WRITE_BATCH_SIZE` are pending. WAL mode and a busy timeout let several
+    processes share the same file. The legacy JSON cache is imported once,
+    when the database is created.
+    """
+
+    def __init__(
+        self, cache_file: str, negative_ttl_seconds: float, legacy_cache_file: str = None
+    ):
+        super().__init__(negative_ttl_seconds)
+        self.cache_file = cache_file
+        self.lock = threading.Lock()
+        self.pending = {}
+
+        os.makedirs(os.path.dirname(cache_file) or ".", exist_ok=True)
+        self.connection = sqlite3.connect(cache_file, timeout=30, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute(
+            """CREATE TABLE IF NOT EXISTS entities (
+                query TEXT PRIMARY KEY,
+                qid TEXT,
+                label TEXT,
+                description TEXT,
+                cached_at REAL NOT NULL
+            )"""
+        )
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS migrations (source TEXT PRIMARY KEY)"
+        )
+        self.connection.commit()
+
+        if legacy_cache_file and os.path.exists(legacy_cache_file):
+            self.migrate(legacy_cache_file)
+
+    def migrate(self, legacy_cache_file: str):
+        source = os.path.abspath(legacy_cache_file)
+        with self.lock, self.connection:
+            migrated = self.connection.execute(
+                "INSERT OR IGNORE INTO migrations (source) VALUES (?)", (source,)
+            ).rowcount
+            if not migrated:
+                return
+            with open(legacy_cache_file, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            now = time.time()
+            self.connection.executemany(
+                """INSERT OR IGNORE INTO entities (query, qid, label, description, cached_at)
+                VALUES (?, ?, ?, ?, ?)""",
+                (
+                    (query, v["qid"], v["label"], v.get("description", ""), now)
+                    for query, v in data.items()
+                ),
+            )
+        logger.info(
+            "Migrated %d cached Wikidata entities from %s.", len(data), legacy_cache_file
+        )
+
+    def get(self, query: str):
+        with self.lock:
+            row = self.pending.get(query) or self.connection.execute(
+                "SELECT qid, label, description, cached_at FROM entities WHERE query = ?",
+                (query,),
+            ).fetchone()
+        if row is None:
+            return NOT_CACHED
+        qid, label, description, cached_at = row
+        if qid is None:
+            return None if not self.is_expired(cached_at) else NOT_CACHED
+        return WikidataEntity(qid, label, description or "")
+
+    def put(self, query: str, entity: Optional[WikidataEntity]):
+        with self.lock:
+            self.pending[query] = (
+                entity.qid if entity else None,
+                entity.label if entity else None,
+                entity.description if entity else None,
+                time.time(),
+            )
+            if len(self.pending) >= WRITE_BATCH_SIZE:
+                self.__write_pending()
+
+    def items(self) -> Iterator[Tuple[str, WikidataEntity]]:
+        with self.lock:
+            rows = {
+                query: (qid, label, description)
+                for query, qid, label, description in self.connection.execute(
+                    "SELECT query, qid, label, description FROM entities WHERE qid IS NOT NULL"
+                )
+            }
+            rows.update(
+                (query, (qid, label, description))
+                for query, (qid, label, description, _) in self.pending.items()
+            )
+        for query, (qid, label, description) in rows.items():
+            if qid is not None:
+                yield query, WikidataEntity(qid, label, description or "")
+
+    def flush(self):
+        with self.lock:
+            self.__write_pending()
+
+    def close(self):
+        self.flush()
+        self.connection.close()
+
+    def __write_pending(self):
+        if not self.pending:
+            return
+        with self.connection:
+            self.connection.executemany(
+                """INSERT OR REPLACE INTO entities (query, qid, label, description, cached_at)
+                VALUES (?, ?, ?, ?, ?)""",
+                ((query, *row) for query, row in self.pending.items()),
+            )
+        self.pending.clear()
+
+
+def open_wikidata_cache(
+    backend: str, cache_file: str, negative_ttl_seconds: float, legacy_cache_file: str
+) -> WikidataCache:
+    if backend == "sqlite":
+        return SqliteWikidataCache(cache_file, negative_ttl_seconds, legacy_cache_file)
+    if backend == "json":
+        return JsonWikidataCache(cache_file, negative_ttl_seconds)
+    raise ValueError(f"Unknown Wikidata cache backend: {backend}")